@@ -0,0 +1,227 @@
+import bisect
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+ARCHIVE_DIR = 'chat_archive'
+# A sparse index entry is written for the first record at least this many
+# bytes past the previous one, so a lookup scans at most about one block.
+INDEX_BLOCK_BYTES = 4096
+MAX_OPEN_SEGMENTS = 256
+
+# Segment record: content length, id, direction (0 if the sender is the
+# first user of the conversation key, 1 otherwise), timestamp length, then
+# the UTF-8 timestamp and content.
+RECORD = struct.Struct('!IqBB')
+# Index entry: (first id, offset) of a block, or (COMMIT_MARKER, end) once
+# the records before end are durable. Message ids start at 1.
+INDEX_ENTRY = struct.Struct('!qQ')
+COMMIT_MARKER = 0
+
+
+def segment_base(directory, conversation):
+    digest = hashlib.sha1('\0'.join(conversation).encode('utf-8')).hexdigest()
+    return os.path.join(directory, digest[:2], digest)
+
+
+def fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Segment:
+    # One conversation's archived messages: a .seg file of records in id
+    # order and a .idx file of block entries and commit markers. Nothing
+    # past the last commit marker is ever read, so a crash mid-append leaves
+    # at most some garbage there for the next append to overwrite; the .seg
+    # file never shrinks, which keeps existing mappings safe to read.
+    #
+    # Readers map the committed part of the .seg file and decode straight
+    # out of the mapping; when the .idx file grows (an append, maybe from
+    # another process) the next read maps it again.
+    def __init__(self, base):
+        self.seg_path = base + '.seg'
+        self.idx_path = base + '.idx'
+        self.lock = threading.Lock()
+        self.idx_size = 0
+        self.committed_idx_size = 0
+        self.state = (None, 0, [], [])  # mapping, committed size, block ids, block offsets
+        self.appended = None  # tail() after the last append in this process
+
+    def refresh(self):
+        try:
+            idx_size = os.stat(self.idx_path).st_size
+        except FileNotFoundError:
+            idx_size = 0
+        with self.lock:
+            if idx_size != self.idx_size:
+                self.load(idx_size)
+            return self.state
+
+    def load(self, idx_size):
+        try:
+            with open(self.idx_path, 'rb') as f:
+                data = f.read(idx_size)
+        except FileNotFoundError:
+            data = b''
+        ids = []
+        offsets = []
+        committed = 0
+        committed_blocks = 0
+        committed_idx_size = 0
+        entries = INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size])
+        for position, (first_id, offset) in enumerate(entries, 1):
+            if first_id == COMMIT_MARKER:
+                committed = offset
+                committed_blocks = len(ids)
+                committed_idx_size = position * INDEX_ENTRY.size
+            else:
+                ids.append(first_id)
+                offsets.append(offset)
+        del ids[committed_blocks:], offsets[committed_blocks:]
+        # Old mappings are left to the garbage collector: a concurrent
+        # reader may still be decoding from one.
+        mapping = None
+        if committed:
+            with open(self.seg_path, 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), committed, access=mmap.ACCESS_READ)
+        self.idx_size = idx_size
+        self.committed_idx_size = committed_idx_size
+        self.state = (mapping, committed, ids, offsets)
+
+    def read_before(self, before_id, limit):
+        # Returns up to `limit` (id, direction, content, timestamp) tuples
+        # with id < before_id, newest first.
+        mapping, size, ids, offsets = self.refresh()
+        if mapping is None:
+            return []
+        view = memoryview(mapping)
+        found = []
+        block = bisect.bisect_left(ids, before_id) - 1
+        while block >= 0 and len(found) < limit:
+            end = offsets[block + 1] if block + 1 < len(offsets) else size
+            records = [record for record in self.scan(view, offsets[block], end) if record[0] < before_id]
+            records.reverse()
+            found.extend(records)
+            block -= 1
+        return [(message_id, direction, str(view[content_start:content_end], 'utf-8'),
+                 str(view[timestamp_start:content_start], 'utf-8'))
+                for message_id, direction, timestamp_start, content_start, content_end in found[:limit]]
+
+    def scan(self, view, offset, end):
+        # Yields (id, direction, timestamp start, content start, content end)
+        # for the records in [offset, end).
+        while offset < end:
+            content_length, message_id, direction, timestamp_length = RECORD.unpack_from(view, offset)
+            content_start = offset + RECORD.size + timestamp_length
+            content_end = content_start + content_length
+            yield message_id, direction, offset + RECORD.size, content_start, content_end
+            offset = content_end
+
+    def tail(self):
+        # Returns (committed size, offset of the last block, last id) for
+        # the appender, dropping index entries a crash left uncommitted.
+        if self.appended is not None:
+            return self.appended
+        mapping, size, ids, offsets = self.refresh()
+        with self.lock:
+            if self.idx_size != self.committed_idx_size:
+                with open(self.idx_path, 'r+b') as f:
+                    f.truncate(self.committed_idx_size)
+                    os.fsync(f.fileno())
+                self.idx_size = self.committed_idx_size
+        if mapping is None:
+            return 0, None, 0
+        last_id = 0
+        for message_id, _, _, _, _ in self.scan(memoryview(mapping), offsets[-1], size):
+            last_id = message_id
+        return size, offsets[-1], last_id
+
+    def append(self, records, size, indexed_offset):
+        # records are (id, direction, content, timestamp) in id order, all
+        # newer than what the segment holds. Both files are fsynced before
+        # returning, so the rows can then be deleted from SQLite.
+        chunks = []
+        index = []
+        offset = size
+        for message_id, direction, content, timestamp in records:
+            if indexed_offset is None or offset - indexed_offset >= INDEX_BLOCK_BYTES:
+                index.append(INDEX_ENTRY.pack(message_id, offset))
+                indexed_offset = offset
+            timestamp = timestamp.encode('utf-8')
+            content = content.encode('utf-8')
+            chunks.append(RECORD.pack(len(content), message_id, direction, len(timestamp)))
+            chunks.append(timestamp)
+            chunks.append(content)
+            offset += RECORD.size + len(timestamp) + len(content)
+        index.append(INDEX_ENTRY.pack(COMMIT_MARKER, offset))
+
+        directory = os.path.dirname(self.seg_path)
+        created = not os.path.exists(self.seg_path)
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.seg_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, b''.join(chunks), size)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        with open(self.idx_path, 'ab') as f:
+            f.write(b''.join(index))
+            f.flush()
+            os.fsync(f.fileno())
+        if created:
+            fsync_directory(directory)
+        self.appended = (offset, indexed_offset, records[-1][0])
+
+
+class MessageArchive:
+    # Cold tier for 1:1 messages. Compaction appends read messages to their
+    # conversation's segment; history reads that run past the live table
+    # continue here. Only one process may append, but any number may read.
+    def __init__(self, directory=ARCHIVE_DIR, max_open=MAX_OPEN_SEGMENTS):
+        self.directory = directory
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.segments = collections.OrderedDict()  # conversation: Segment
+        self.reads = 0
+
+    def segment(self, conversation):
+        with self.lock:
+            segment = self.segments.get(conversation)
+            if segment is None:
+                segment = Segment(segment_base(self.directory, conversation))
+                self.segments[conversation] = segment
+                while len(self.segments) > self.max_open:
+                    self.segments.popitem(last=False)
+            else:
+                self.segments.move_to_end(conversation)
+            return segment
+
+    def read_before(self, conversation, before_id, limit):
+        # Returns (id, sender, receiver, content, timestamp) rows, newest
+        # first, in the same shape as the live history query.
+        rows = []
+        for message_id, direction, content, timestamp in self.segment(conversation).read_before(before_id, limit):
+            sender, receiver = conversation if direction == 0 else conversation[::-1]
+            rows.append((message_id, sender, receiver, content, timestamp))
+        if rows:
+            self.reads += 1
+        return rows
+
+    def append(self, conversation, rows):
+        # rows are (id, sender, receiver, content, timestamp) in id order.
+        # Ids the segment already holds (archived, but not yet deleted from
+        # SQLite when a previous run stopped) are skipped.
+        segment = self.segment(conversation)
+        size, indexed_offset, last_id = segment.tail()
+        records = [(message_id, 0 if sender == conversation[0] else 1, content, timestamp)
+                   for message_id, sender, receiver, content, timestamp in rows if message_id > last_id]
+        if records:
+            segment.append(records, size, indexed_offset)
+        return len(records)
@@ -0,0 +1,110 @@
+import collections
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# scrypt work factor: about 16 MB and tens of milliseconds per hash.
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+HASH_PREFIX = 'scrypt$'
+# hashlib releases the GIL while hashing, so a thread per core uses every
+# core without slowing the threads that deliver messages.
+HASH_WORKERS = os.cpu_count() or 2
+SESSION_CACHE_TTL = 300
+SESSION_CACHE_SIZE = 100000
+
+
+def hash_password(password, salt=None):
+    salt = salt if salt is not None else secrets.token_bytes(SALT_SIZE)
+    key = hashlib.scrypt(password.encode('utf-8'), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return f"{HASH_PREFIX}{SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${key.hex()}"
+
+
+def check_password(password, stored):
+    if not stored.startswith(HASH_PREFIX):
+        # Plaintext row from before passwords were hashed.
+        return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+    n, r, p, salt, key = stored[len(HASH_PREFIX):].split('$')
+    candidate = hashlib.scrypt(password.encode('utf-8'), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p))
+    return hmac.compare_digest(candidate, bytes.fromhex(key))
+
+
+def needs_rehash(stored):
+    return not stored.startswith(HASH_PREFIX)
+
+
+def resolved(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class PasswordHasher:
+    # Runs the KDF on a fixed pool so a login storm queues up here instead of
+    # tying up connection handlers or database workers. Successful logins are
+    # remembered for SESSION_CACHE_TTL seconds as a keyed HMAC of the
+    # password (never the password itself), so a reconnect checks in
+    # microseconds without running the KDF again.
+    def __init__(self, workers=HASH_WORKERS, ttl=SESSION_CACHE_TTL, cache_size=SESSION_CACHE_SIZE):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache_key = secrets.token_bytes(32)
+        self.lock = threading.Lock()
+        self.verified = collections.OrderedDict()  # username: (tag, expires_at)
+        self.cache_hits = 0
+        self.hashes = 0
+
+    def hash(self, password):
+        self.hashes += 1
+        return self.executor.submit(hash_password, password)
+
+    def verify(self, username, password, stored):
+        # Returns a future of whether password matches the stored value.
+        if stored is None or password is None:
+            return resolved(False)
+        if self.is_cached(username, password):
+            self.cache_hits += 1
+            return resolved(True)
+        if needs_rehash(stored):
+            return resolved(self.remember(username, password, check_password(password, stored)))
+        self.hashes += 1
+        return self.executor.submit(lambda: self.remember(username, password, check_password(password, stored)))
+
+    def session_tag(self, username, password):
+        message = username.encode('utf-8') + b'\0' + password.encode('utf-8')
+        return hmac.new(self.cache_key, message, hashlib.sha256).digest()
+
+    def is_cached(self, username, password):
+        with self.lock:
+            entry = self.verified.get(username)
+        if entry is None:
+            return False
+        tag, expires_at = entry
+        if expires_at < time.monotonic():
+            self.forget(username)
+            return False
+        return hmac.compare_digest(tag, self.session_tag(username, password))
+
+    def remember(self, username, password, verified):
+        if verified:
+            entry = (self.session_tag(username, password), time.monotonic() + self.ttl)
+            with self.lock:
+                self.verified[username] = entry
+                self.verified.move_to_end(username)
+                while len(self.verified) > self.cache_size:
+                    self.verified.popitem(last=False)
+        return verified
+
+    def forget(self, username):
+        with self.lock:
+            self.verified.pop(username, None)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
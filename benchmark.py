@@ -0,0 +1,203 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import time
+
+from codec import CODEC_JSON, CODECS
+from headless_client import HeadlessClient
+
+FANOUT_PATTERNS = ('pair', 'random', 'hot', 'room')
+HOT_USERS = 10
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def summarize_latencies(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'p50': percentile(samples, 0.50),
+        'p99': percentile(samples, 0.99),
+        'p999': percentile(samples, 0.999),
+        'max': samples[-1] if samples else None
+    }
+
+
+def username_for(config, index):
+    return f"{config['prefix']}_{index}"
+
+
+def room_name(config):
+    return f"{config['prefix']}_room"
+
+
+def pick_receiver(config, index, rng):
+    users = config['users']
+    if config['fanout'] == 'pair':
+        return username_for(config, index ^ 1 if index ^ 1 < users else 0)
+    if config['fanout'] == 'hot':
+        return username_for(config, rng.randrange(min(HOT_USERS, users)))
+    return username_for(config, rng.randrange(users))
+
+
+class SimulatedUser:
+    def __init__(self, config, index, stats):
+        self.config = config
+        self.index = index
+        self.stats = stats
+        self.client = HeadlessClient(config['host'], config['port'], username_for(config, index), 'benchmark',
+                                     compression=config['compression'], codec=config['codec'])
+        self.pending_acks = {}
+        self.next_client_id = 0
+
+    async def connect(self):
+        await self.client.connect()
+        await self.client.register_or_login()
+        if self.config['fanout'] == 'room':
+            await self.client.enter_room(room_name(self.config))
+
+    async def receive_loop(self):
+        while True:
+            message = await self.client.recv()
+            if message is None:
+                return
+            now = time.time()
+            if message.get('type') in ('message', 'room_message'):
+                # Content starts with the sender's wall-clock send time;
+                # everything runs on one host so the clocks agree.
+                sent_at = float(message['content'].split(' ', 1)[0])
+                self.stats['delivery'].append((now - sent_at) * 1000)
+                self.stats['delivered'] += 1
+            elif message.get('type') == 'ack':
+                sent_at = self.pending_acks.pop(message.get('client_id'), None)
+                if sent_at is not None:
+                    self.stats['ack'].append((now - sent_at) * 1000)
+                    self.stats['acked'] += 1
+
+    async def send_loop(self, stop_at):
+        rng = random.Random(self.index)
+        interval = 1.0 / self.config['rate']
+        padding = 'x' * self.config['size']
+        # Spread the first send over one interval so users don't fire in lockstep.
+        await asyncio.sleep(rng.random() * interval)
+        while time.time() < stop_at:
+            sent_at = time.time()
+            client_id = self.next_client_id
+            self.next_client_id += 1
+            self.pending_acks[client_id] = sent_at
+            if self.config['fanout'] == 'room':
+                self.client.send_room_message(room_name(self.config), f"{sent_at:.6f} {padding}", client_id)
+            else:
+                receiver = pick_receiver(self.config, self.index, rng)
+                self.client.send_message(receiver, f"{sent_at:.6f} {padding}", client_id)
+            self.stats['sent'] += 1
+            await self.client.drain()
+            await asyncio.sleep(interval)
+
+
+async def run_users(config, indices, barrier):
+    stats = {'sent': 0, 'acked': 0, 'delivered': 0, 'errors': 0, 'delivery': [], 'ack': []}
+    users = [SimulatedUser(config, index, stats) for index in indices]
+
+    login_started = time.time()
+    connect_results = await asyncio.gather(*(user.connect() for user in users), return_exceptions=True)
+    connected = []
+    for user, result in zip(users, connect_results):
+        if isinstance(result, Exception):
+            stats['errors'] += 1
+        else:
+            connected.append(user)
+
+    stats['login_seconds'] = time.time() - login_started
+
+    receivers = [asyncio.ensure_future(user.receive_loop()) for user in connected]
+    # Every worker logs in all of its users before anyone starts sending, so
+    # slow logins never eat into the measured window.
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait, config['login_timeout'])
+    stop_at = time.time() + config['duration']
+    await asyncio.gather(*(user.send_loop(stop_at) for user in connected), return_exceptions=True)
+    # Give in-flight messages a chance to arrive before counting.
+    await asyncio.sleep(config['drain'])
+
+    for task in receivers:
+        task.cancel()
+    stats['bytes_received'] = sum(user.client.decoder.bytes_received for user in connected)
+    await asyncio.gather(*(user.client.close() for user in connected), return_exceptions=True)
+    return stats
+
+
+def run_worker(config, indices, barrier, results):
+    results.put(asyncio.run(run_users(config, indices, barrier)))
+
+
+def run_benchmark(config):
+    processes = max(1, min(config['processes'], config['users']))
+    slices = [list(range(worker, config['users'], processes)) for worker in range(processes)]
+    barrier = multiprocessing.Barrier(processes)
+    result_queue = multiprocessing.Queue()
+
+    workers = [multiprocessing.Process(target=run_worker, args=(config, indices, barrier, result_queue))
+               for indices in slices]
+    for worker in workers:
+        worker.start()
+    results = [result_queue.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    totals = {'sent': 0, 'acked': 0, 'delivered': 0, 'errors': 0, 'bytes_received': 0}
+    delivery = []
+    acks = []
+    for stats in results:
+        for key in totals:
+            totals[key] += stats[key]
+        delivery.extend(stats['delivery'])
+        acks.extend(stats['ack'])
+
+    return {
+        'config': config,
+        **totals,
+        'login_seconds': max(stats['login_seconds'] for stats in results),
+        'throughput_msgs_per_sec': totals['delivered'] / config['duration'],
+        'delivery_latency_ms': summarize_latencies(delivery),
+        'ack_latency_ms': summarize_latencies(acks)
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the chat server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--users', type=int, default=100, help="number of simulated users")
+    parser.add_argument('--processes', type=int, default=1, help="worker processes to spread users over")
+    parser.add_argument('--rate', type=float, default=1.0, help="messages per second sent by each user")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of sending")
+    parser.add_argument('--login-timeout', type=float, default=120.0,
+                        help="seconds allowed for all users to log in before sending starts")
+    parser.add_argument('--drain', type=float, default=2.0, help="seconds to wait for in-flight messages")
+    parser.add_argument('--size', type=int, default=32, help="padding bytes added to each message")
+    parser.add_argument('--fanout', choices=FANOUT_PATTERNS, default='pair',
+                        help="pair: fixed partner, random: any user, hot: a few popular users, "
+                             "room: everyone in one room")
+    parser.add_argument('--compression', action='store_true', help="negotiate deflate compression with the server")
+    parser.add_argument('--codec', choices=sorted(CODECS), default=CODEC_JSON, help="frame encoding to negotiate")
+    parser.add_argument('--prefix', default='bench', help="username prefix for simulated users")
+    parser.add_argument('--output', help="also write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = vars(args).copy()
+    output = config.pop('output')
+    report = json.dumps(run_benchmark(config), indent=2)
+    print(report)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report + '\n')
@@ -0,0 +1,187 @@
+import collections
+import tkinter as tk
+from datetime import datetime
+
+# Messages kept rendered in the Text widget at once. Older ones move to an
+# in-memory ring of up to CHAT_RING_SIZE entries and are re-rendered in pages
+# of CHAT_PAGE_SIZE when the user scrolls back to them.
+CHAT_WINDOW_SIZE = 300
+CHAT_RING_SIZE = 5000
+CHAT_PAGE_SIZE = 50
+
+
+class ChatView:
+    # Windowed view of one conversation inside a ScrolledText. Line 1 holds
+    # the title; each message is "\n<name> (<time>): <content>" after it.
+    #
+    # Entries are [id, sender, content, timestamp, is_self] lists. The
+    # widget only ever holds window_size of them: scrolling to the top
+    # brings a page back from `older` (or from the server once the ring is
+    # empty) and parks the newest rendered entries in `newer`; scrolling to
+    # the bottom does the reverse.
+    def __init__(self, text, title, request_older, window_size=CHAT_WINDOW_SIZE, ring_size=CHAT_RING_SIZE,
+                 page_size=CHAT_PAGE_SIZE):
+        self.text = text
+        self.request_older = request_older
+        self.window_size = window_size
+        self.ring_size = ring_size
+        self.page_size = page_size
+        self.rendered = collections.deque()
+        self.older = collections.deque()
+        self.newer = collections.deque()
+        self.line_count = 0  # text lines used by rendered entries
+        self.cursor = None  # 'before' id for the next server page
+        self.oldest_id = None  # nothing below this id is held locally
+        self.more = True
+        self.loading = False
+        self.check_scheduled = False
+
+        self.text.configure(state='normal')
+        self.text.delete('1.0', tk.END)
+        self.text.insert(tk.END, title)
+        self.text.configure(state='disabled', yscrollcommand=self.on_scroll)
+
+    def append(self, entries):
+        self.note_ids(entries)
+        if self.newer:
+            # The user is reading further back; render these once they
+            # scroll down, unless so many pile up that jumping is cheaper.
+            self.newer.extend(entries)
+            if len(self.newer) > self.ring_size:
+                self.show_latest()
+            return
+        self.render_bottom(entries)
+        self.text.see(tk.END)
+
+    def add_history_page(self, messages, cursor, more, username):
+        self.loading = False
+        entries = [[msg['id'], msg['sender'], msg['content'], msg['timestamp'], msg['sender'] == username]
+                   for msg in messages]
+        if self.oldest_id is not None:
+            # Messages that arrived live while the page was in flight.
+            entries = [entry for entry in entries if entry[0] < self.oldest_id]
+        if cursor is not None:
+            self.cursor = cursor
+        self.more = more
+        self.note_ids(entries)
+        if entries:
+            self.render_top(entries)
+        elif more:
+            self.load_older()
+
+    def acknowledge(self, entry, message_id):
+        entry[0] = message_id
+
+    def load_older(self):
+        if self.loading:
+            return
+        if self.older:
+            count = min(self.page_size, len(self.older))
+            entries = [self.older.pop() for _ in range(count)]
+            entries.reverse()
+            self.render_top(entries)
+        elif self.more:
+            self.loading = True
+            self.request_older(self.cursor)
+
+    def load_newer(self):
+        count = min(self.page_size, len(self.newer))
+        self.render_bottom([self.newer.popleft() for _ in range(count)])
+
+    def show_latest(self):
+        entries = list(self.rendered) + list(self.newer)
+        self.rendered.clear()
+        self.newer.clear()
+        self.text.configure(state='normal')
+        self.text.delete('1.end', 'end-1c')
+        self.text.configure(state='disabled')
+        self.line_count = 0
+        self.park_older(entries[:-self.window_size])
+        self.render_bottom(entries[-self.window_size:])
+        self.text.see(tk.END)
+
+    def render_bottom(self, entries):
+        if not entries:
+            return
+        self.insert('end-1c', entries)
+        self.rendered.extend(entries)
+        excess = len(self.rendered) - self.window_size
+        if excess > 0:
+            top_line = int(self.text.index('@0,0').split('.')[0])
+            evicted = [self.rendered.popleft() for _ in range(excess)]
+            lines = sum(self.line_span(entry) for entry in evicted)
+            self.delete('1.end', f'{1 + lines}.end', lines)
+            self.text.yview(f'{max(top_line - lines, 1)}.0')
+            self.park_older(evicted)
+
+    def render_top(self, entries):
+        # Keeps whatever the user was looking at in place, so arriving at the
+        # top doesn't immediately trigger the next page.
+        top_line = max(int(self.text.index('@0,0').split('.')[0]), 2)
+        was_empty = not self.rendered
+        added = self.insert('1.end', entries)
+        self.rendered.extendleft(reversed(entries))
+        if was_empty:
+            self.text.see(tk.END)
+        else:
+            self.text.yview(f'{top_line + added}.0')
+        excess = len(self.rendered) - self.window_size
+        if excess > 0:
+            evicted = [self.rendered.pop() for _ in range(excess)]
+            lines = sum(self.line_span(entry) for entry in evicted)
+            self.delete(f'{1 + self.line_count - lines}.end', 'end-1c', lines)
+            self.newer.extendleft(evicted)
+
+    def park_older(self, entries):
+        self.older.extend(entries)
+        while len(self.older) > self.ring_size:
+            dropped = self.older.popleft()
+            if dropped[0] is not None:
+                # Gone locally, so the server has to send it again.
+                self.cursor = self.oldest_id = dropped[0] + 1
+                self.more = True
+
+    def insert(self, index, entries):
+        chunks = []
+        lines = 0
+        for entry in entries:
+            _, sender, content, timestamp, is_self = entry
+            display_time = timestamp.split()[1][:5] if isinstance(timestamp, str) else datetime.now().strftime('%H:%M')
+            name = "You" if is_self else sender
+            chunks.extend(('\n', (), f"{name} ({display_time}): ", "self" if is_self else "other", content, ()))
+            lines += self.line_span(entry)
+        self.text.configure(state='normal')
+        self.text.insert(index, *chunks)
+        self.text.configure(state='disabled')
+        self.line_count += lines
+        return lines
+
+    def delete(self, start, end, lines):
+        self.text.configure(state='normal')
+        self.text.delete(start, end)
+        self.text.configure(state='disabled')
+        self.line_count -= lines
+
+    def line_span(self, entry):
+        return entry[2].count('\n') + 1
+
+    def note_ids(self, entries):
+        for entry in entries:
+            if entry[0] is not None and (self.oldest_id is None or entry[0] < self.oldest_id):
+                self.oldest_id = entry[0]
+
+    def on_scroll(self, first, last):
+        self.text.vbar.set(first, last)
+        if not self.check_scheduled:
+            self.check_scheduled = True
+            self.text.after_idle(self.check_edges)
+
+    def check_edges(self):
+        self.check_scheduled = False
+        if not self.text.winfo_exists():
+            return
+        first, last = self.text.yview()
+        if first <= 0.0:
+            self.load_older()
+        elif last >= 1.0 and self.newer:
+            self.load_newer()
@@ -3,11 +3,36 @@ from tkinter import ttk, scrolledtext, messagebox
 import socket
 import threading
 import json
+import queue
+import random
+import time
+import argparse
 from datetime import datetime
 
+from chat_view import ChatView
+from codec import CODEC_BINARY, CODEC_JSON, JSON_CODEC, CodecError, get_codec
+from protocol import (COMPRESSION_DEFLATE, IDLE_TIMEOUT, PING, PING_INTERVAL, PONG, FrameDecoder, FrameError,
+                      compress_frame, encode_frame, recv_frame)
+
+# The receiver thread only decodes frames; the Tk main loop drains them every
+# UI_PUMP_INTERVAL ms, handling at most UI_BATCH_SIZE per pass so a flood of
+# messages can't starve input and redraw events.
+UI_PUMP_INTERVAL = 50
+UI_BATCH_SIZE = 500
+# Rooms share the contacts list with users, told apart by this prefix.
+ROOM_PREFIX = '#'
+# After a drop the client reconnects on its own, waiting a random delay up
+# to an exponentially growing cap, so clients dropped together (say, by a
+# server restart) don't all come back at once.
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+CONNECT_TIMEOUT = 5
+# How often (ms) the newest delivery shown is acknowledged to the server.
+SYNC_ACK_INTERVAL = 1000
+
 
 class ModernUI(tk.Tk):
-    def __init__(self):
+    def __init__(self, ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT):
         super().__init__()
 
         self.title("Chat App")
@@ -34,10 +59,34 @@ class ModernUI(tk.Tk):
         self.show_login_frame()
 
         self.client_socket = None
+        self.server_address = None
         self.connected = False
         self.username = ""
+        self.password = ""
+        self.session_token = None
+        self.last_seq = 0  # newest delivery shown
+        self.acked_seq = 0
+        self.reconnecting = False
+        self.reconnect_attempt = 0
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.last_received = time.monotonic()  # set by the receiver thread
         self.active_users = []
+        self.rooms = []
+        self.compress = False
+        self.codec = JSON_CODEC
+        self.presence_version = 0
         self.current_chat = None
+        self.pending_sends = {}  # client_id: chat entry waiting for its ack
+        self.search_query = None
+        self.search_cursor = None
+        self.search_hits = []
+        self.search_window = None
+        self.next_client_id = 0
+        self.events = queue.Queue()
+        self.after(UI_PUMP_INTERVAL, self.pump_events)
+        self.after(SYNC_ACK_INTERVAL, self.send_sync_ack)
+        self.after(int(self.ping_interval * 1000), self.check_heartbeat)
 
     def show_login_frame(self):
         if self.current_frame:
@@ -98,6 +147,21 @@ class ModernUI(tk.Tk):
         contacts_frame = ttk.Frame(paned_window, style='TFrame')
         contacts_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=False)
 
+        room_frame = ttk.Frame(contacts_frame)
+        room_frame.pack(fill=tk.X, padx=10, pady=(10, 0))
+        self.room_entry = ttk.Entry(room_frame, width=12)
+        self.room_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        ttk.Button(room_frame, text="Join", width=6, command=lambda: self.room_request('join_room')).pack(side=tk.LEFT)
+        ttk.Button(room_frame, text="Create", width=7, command=lambda: self.room_request('create_room')).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Button(room_frame, text="Leave", width=6, command=lambda: self.room_request('leave_room')).pack(side=tk.LEFT, padx=(5, 0))
+
+        search_frame = ttk.Frame(contacts_frame)
+        search_frame.pack(fill=tk.X, padx=10, pady=(10, 0))
+        self.search_entry = ttk.Entry(search_frame, width=12)
+        self.search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        self.search_entry.bind('<Return>', lambda event: self.search())
+        ttk.Button(search_frame, text="Search", width=7, command=self.search).pack(side=tk.LEFT)
+
         # Add the user listbox here
         self.users_listbox = tk.Listbox(contacts_frame, font=('Helvetica', 10), activestyle='dotbox')
         self.users_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
@@ -133,6 +197,8 @@ class ModernUI(tk.Tk):
 
         self.chat_history = scrolledtext.ScrolledText(self.chat_pane, wrap=tk.WORD, bg='white', font=('Helvetica', 10), highlightthickness=0, bd=0)
         self.chat_history.pack(fill=tk.BOTH, expand=True, padx=15, pady=(0, 10))
+        self.chat_history.tag_configure("self", foreground=self.accent_color, font=('Helvetica', 10, 'bold'))
+        self.chat_history.tag_configure("other", foreground="#E91E63", font=('Helvetica', 10, 'bold'))
         self.chat_history.configure(state='disabled')
 
         input_frame = ttk.Frame(self.chat_pane)
@@ -150,88 +216,322 @@ class ModernUI(tk.Tk):
 
     def connect_to_server(self):
         try:
-            host = self.server_entry.get()
-            port = int(self.port_entry.get())
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((host, port))
-
-            receiver_thread = threading.Thread(target=self.receive_messages)
-            receiver_thread.daemon = True
-            receiver_thread.start()
+            self.server_address = (self.server_entry.get(), int(self.port_entry.get()))
+            self.attach_socket(socket.create_connection(self.server_address))
             return True
         except Exception as e:
             messagebox.showerror("Connection Error", f"Could not connect to server: {e}")
             return False
 
+    def attach_socket(self, client_socket):
+        self.client_socket = client_socket
+        self.last_received = time.monotonic()
+        receiver_thread = threading.Thread(target=self.receive_messages, args=(client_socket,))
+        receiver_thread.daemon = True
+        receiver_thread.start()
+
+    def auth_request(self, action):
+        # 'sync' asks for a session that can be resumed after a drop.
+        return {'action': action, 'username': self.username, 'password': self.password, 'sync': True,
+                'compression': [COMPRESSION_DEFLATE], 'codec': [CODEC_BINARY, CODEC_JSON]}
+
     def login(self):
-        username = self.username_entry.get()
-        password = self.password_entry.get()
-        if not username or not password:
-            messagebox.showerror("Error", "Username and password are required.")
-            return
-        if self.connect_to_server():
-            auth_data = {'action': 'login', 'username': username, 'password': password}
-            self.client_socket.send(json.dumps(auth_data).encode('utf-8'))
-            self.username = username
+        self.authenticate('login')
 
     def register(self):
+        self.authenticate('register')
+
+    def authenticate(self, action):
         username = self.username_entry.get()
         password = self.password_entry.get()
         if not username or not password:
             messagebox.showerror("Error", "Username and password are required.")
             return
         if self.connect_to_server():
-            auth_data = {'action': 'register', 'username': username, 'password': password}
-            self.client_socket.send(json.dumps(auth_data).encode('utf-8'))
             self.username = username
+            self.password = password
+            self.session_token = None
+            self.client_socket.sendall(encode_frame(self.auth_request(action)))
 
     def logout(self):
-        if self.client_socket:
-            self.client_socket.close()
+        self.reconnecting = False
+        self.session_token = None
+        self.close_socket()
         self.connected = False
         self.show_login_frame()
 
-    def receive_messages(self):
+    def close_socket(self):
+        # Its receiver thread still reports the close, but events from a
+        # socket that is no longer client_socket are ignored.
+        if self.client_socket:
+            self.client_socket.close()
+        self.client_socket = None
+
+    def receive_messages(self, client_socket):
+        # Runs on a background thread, so it never touches Tk: every decoded
+        # frame goes onto the event queue for pump_events.
+        decoder = FrameDecoder()
+        # The auth response is JSON; frames after it use the codec it names.
+        codec = JSON_CODEC
         while True:
             try:
-                data = self.client_socket.recv(4096).decode('utf-8')
-                if not data:
+                data = recv_frame(client_socket, decoder)
+                if data is None:
+                    self.events.put({'type': 'connection_lost', 'socket': client_socket})
                     break
-                message = json.loads(data)
+                self.last_received = time.monotonic()
+                message = codec.decode(data)
                 if message.get('status') == 'success':
-                    if message.get('message') in ['Login successful', 'Registration successful']:
-                        self.connected = True
-                        self.after(100, self.show_chat_frame)
-                        if 'unread_messages' in message:
-                            for msg in message['unread_messages']:
-                                self.display_message(msg['sender'], msg['content'], msg['timestamp'], is_self=False)
-                elif message.get('status') == 'error':
-                    messagebox.showerror("Error", message.get('message', 'Unknown error'))
-                elif message.get('type') == 'active_users':
-                    self.active_users = message.get('users', [])
-                    self.after(100, self.update_users_list)
-                elif message.get('type') == 'message':
-                    sender = message.get('sender')
-                    content = message.get('content')
-                    timestamp = message.get('timestamp')
-                    if self.current_chat == sender:
-                        self.display_message(sender, content, timestamp, is_self=False)
-            except json.JSONDecodeError:
+                    codec = get_codec(message.get('codec'))
+                self.events.put(message)
+            except (json.JSONDecodeError, CodecError):
                 continue
-            except ConnectionError:
-                messagebox.showerror("Connection Lost", "Lost connection to the server.")
-                self.after(100, self.show_login_frame)
+            except (OSError, FrameError):
+                self.events.put({'type': 'connection_lost', 'socket': client_socket})
                 break
             except Exception as e:
                 print(f"Error receiving messages: {e}")
                 break
 
-    def update_users_list(self):
-        if hasattr(self, 'users_listbox'):
+    def schedule_reconnect(self):
+        # Full jitter: anywhere between no wait and the current cap.
+        cap = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** self.reconnect_attempt)
+        self.reconnect_attempt += 1
+        self.after(int(random.uniform(0, cap) * 1000), self.reconnect)
+
+    def reconnect(self):
+        if not self.reconnecting:
+            return
+        if self.session_token is not None:
+            # Skips the password check; the server replays what came after
+            # last_seq.
+            request = {'action': 'resume', 'username': self.username, 'session': self.session_token,
+                       'seq': self.last_seq, 'compression': [COMPRESSION_DEFLATE]}
+        else:
+            request = self.auth_request('login')
+        # Connecting can block for a while, so it happens off the Tk thread.
+        threading.Thread(target=self.open_reconnection, args=(request,), daemon=True).start()
+
+    def open_reconnection(self, request):
+        try:
+            client_socket = socket.create_connection(self.server_address, timeout=CONNECT_TIMEOUT)
+            client_socket.settimeout(None)
+            client_socket.sendall(encode_frame(request))
+        except OSError:
+            self.events.put({'type': 'reconnect_failed'})
+            return
+        self.events.put({'type': 'reconnected', 'socket': client_socket})
+
+    def send_sync_ack(self):
+        # Lets the server drop what it keeps for replay once it's shown here.
+        if self.connected and self.client_socket and self.last_seq > self.acked_seq:
+            try:
+                self.client_socket.sendall(self.encode({'type': 'sync_ack', 'seq': self.last_seq}))
+                self.acked_seq = self.last_seq
+            except OSError:
+                pass  # the receiver thread reports the drop
+        self.after(SYNC_ACK_INTERVAL, self.send_sync_ack)
+
+    def check_heartbeat(self):
+        # Pings the server once it has gone quiet. A connection that stays
+        # silent past idle_timeout is presumed dead even though the socket
+        # never reported it, and is shut down so the receiver thread reports
+        # the drop and the usual reconnect starts.
+        delay = self.ping_interval
+        if self.connected and self.client_socket:
+            idle = time.monotonic() - self.last_received
+            try:
+                if idle >= self.idle_timeout:
+                    self.client_socket.shutdown(socket.SHUT_RDWR)
+                elif idle >= self.ping_interval:
+                    self.client_socket.sendall(self.encode(PING))
+                    delay = min(self.ping_interval, self.idle_timeout - idle)
+                else:
+                    delay = self.ping_interval - idle
+            except OSError:
+                pass  # the receiver thread reports the drop
+        self.after(int(delay * 1000), self.check_heartbeat)
+
+    def pump_events(self):
+        pending = []
+        try:
+            for _ in range(UI_BATCH_SIZE):
+                event = self.events.get_nowait()
+                seq = event.get('seq')
+                if seq is not None:
+                    # Already shown before a resume replayed it.
+                    if seq <= self.last_seq:
+                        continue
+                    self.last_seq = seq
+                lines = self.message_lines(event)
+                if lines is not None:
+                    pending.extend(lines)
+                    continue
+                # Anything else may switch frames, so earlier lines are
+                # rendered first to keep them in order.
+                self.render_messages(pending)
+                pending = []
+                self.handle_event(event)
+        except queue.Empty:
+            pass
+        finally:
+            self.render_messages(pending)
+            # Straight back for more while a backlog remains, otherwise idle.
+            self.after(1 if not self.events.empty() else UI_PUMP_INTERVAL, self.pump_events)
+
+    def message_lines(self, message):
+        # Chat entries ([id, sender, content, timestamp, is_self]) a frame
+        # appends to the open chat, or None if it isn't an appending frame.
+        if message.get('type') == 'message':
+            if self.current_chat != message.get('sender'):
+                return []
+            return [[message.get('id'), message.get('sender'), message.get('content'), message.get('timestamp'), False]]
+        if message.get('type') == 'room_message':
+            if self.current_chat != ROOM_PREFIX + message.get('room', ''):
+                return []
+            return [[message.get('id'), message.get('sender'), message.get('content'), message.get('timestamp'), False]]
+        if message.get('type') == 'unread_page':
+            # A backlog covers every conversation; only the open one's
+            # entries belong in the view (and in its history cursor).
+            return [[msg['id'], msg['sender'], msg['content'], msg['timestamp'], False]
+                    for msg in message.get('messages', []) if msg.get('sender') == self.current_chat]
+        if message.get('type') == 'room_unread_page':
+            if self.current_chat != ROOM_PREFIX + message.get('room', ''):
+                return []
+            return [[msg['id'], msg['sender'], msg['content'], msg['timestamp'], False]
+                    for msg in message.get('messages', [])]
+        return None
+
+    def handle_event(self, message):
+        if message.get('status') == 'success':
+            if message.get('message') in ['Login successful', 'Registration successful', 'Session resumed']:
+                self.connected = True
+                self.compress = message.get('compression') == COMPRESSION_DEFLATE
+                self.codec = get_codec(message.get('codec'))
+                self.reconnect_attempt = 0
+                if message.get('message') == 'Session resumed':
+                    # The server has dropped everything up to last_seq.
+                    self.acked_seq = self.last_seq
+                else:
+                    self.session_token = message.get('session')
+                    self.last_seq = self.acked_seq = 0
+                if self.reconnecting:
+                    # The chat frame is still up; only the title changed.
+                    self.reconnecting = False
+                    self.title("Chat App")
+                else:
+                    self.show_chat_frame()
+        elif message.get('status') == 'error':
+            # The server hangs up after a failed auth.
+            self.close_socket()
+            if self.reconnecting and message.get('message') == 'Session expired':
+                # Too late to resume; log in with the saved password instead.
+                self.session_token = None
+                self.reconnect()
+                return
+            if self.reconnecting:
+                self.reconnecting = False
+                self.title("Chat App")
+                self.show_login_frame()
+            messagebox.showerror("Error", message.get('message', 'Unknown error'))
+        elif message.get('type') == 'ping':
+            if self.client_socket:
+                try:
+                    self.client_socket.sendall(self.encode(PONG))
+                except OSError:
+                    pass  # the receiver thread reports the drop
+        elif message.get('type') == 'presence_snapshot':
+            self.presence_version = message.get('version', 0)
+            self.active_users = message.get('users', [])
+            self.update_users_list()
+        elif message.get('type') == 'presence_delta':
+            # Deltas already covered by the snapshot are skipped.
+            if message.get('version', 0) > self.presence_version:
+                self.presence_version = message['version']
+                self.update_users_list((message.get('user_joined', []), message.get('user_left', [])))
+        elif message.get('type') == 'history_page':
+            if message.get('with') == self.current_chat and self.chat_view_open():
+                self.chat_view.add_history_page(message.get('messages', []), message.get('cursor'),
+                                                message.get('more', False), self.username)
+        elif message.get('type') == 'history_error':
+            messagebox.showerror("History", message.get('message', 'Unknown error'))
+        elif message.get('type') == 'ack':
+            entry = self.pending_sends.pop(message.get('client_id'), None)
+            if entry is not None and self.chat_view_open():
+                self.chat_view.acknowledge(entry, message.get('id'))
+        elif message.get('type') == 'room_list':
+            self.rooms = message.get('rooms', [])
+            self.update_users_list()
+        elif message.get('type') == 'room_joined':
+            if message.get('room') not in self.rooms:
+                self.rooms.append(message['room'])
+                self.update_users_list()
+        elif message.get('type') == 'room_left':
+            if message.get('room') in self.rooms:
+                self.rooms.remove(message['room'])
+                self.update_users_list()
+        elif message.get('type') == 'search_results':
+            if message.get('query') == self.search_query:
+                self.show_search_results(message)
+        elif message.get('type') == 'search_error':
+            messagebox.showerror("Search", message.get('message', 'Unknown error'))
+        elif message.get('type') == 'message_error':
+            self.pending_sends.pop(message.get('client_id'), None)
+            messagebox.showerror("Message", message.get('message', 'Unknown error'))
+        elif message.get('type') == 'room_error':
+            self.pending_sends.pop(message.get('client_id'), None)
+            messagebox.showerror("Room", f"{message.get('room')}: {message.get('message', 'Unknown error')}")
+        elif message.get('type') == 'connection_lost':
+            if message.get('socket') is not self.client_socket:
+                return
+            self.client_socket = None
+            was_connected = self.connected
+            self.connected = False
+            if was_connected or self.reconnecting:
+                self.reconnecting = True
+                self.title("Chat App (reconnecting...)")
+                self.schedule_reconnect()
+            else:
+                messagebox.showerror("Connection Lost", "Lost connection to the server.")
+                self.show_login_frame()
+        elif message.get('type') == 'reconnected':
+            if self.reconnecting:
+                self.attach_socket(message['socket'])
+            else:
+                message['socket'].close()
+        elif message.get('type') == 'reconnect_failed':
+            if self.reconnecting:
+                self.schedule_reconnect()
+
+    def update_users_list(self, delta=None):
+        if delta is not None:
+            joined, left = delta
+            for user in left:
+                if user in self.active_users:
+                    self.active_users.remove(user)
+            for user in joined:
+                if user not in self.active_users:
+                    self.active_users.append(user)
+        if not hasattr(self, 'users_listbox') or not self.users_listbox.winfo_exists():
+            return
+        if delta is None:
             self.users_listbox.delete(0, tk.END)
+            for room in self.rooms:
+                self.users_listbox.insert(tk.END, ROOM_PREFIX + room)
             for user in self.active_users:
                 if user != self.username:
                     self.users_listbox.insert(tk.END, user)
+            return
+        listed = list(self.users_listbox.get(0, tk.END))
+        for user in left:
+            if user in listed:
+                index = listed.index(user)
+                self.users_listbox.delete(index)
+                del listed[index]
+        for user in joined:
+            if user != self.username and user not in listed:
+                self.users_listbox.insert(tk.END, user)
+                listed.append(user)
 
     def on_user_select(self, event):
         if not hasattr(self, 'users_listbox'):
@@ -254,40 +554,120 @@ class ModernUI(tk.Tk):
             self.send_message_btn()
             return "break"
 
+    def encode(self, message):
+        frame = self.codec.encode_frame(message)
+        return compress_frame(frame) if self.compress else frame
+
     def send_message(self, receiver, content):
         if not self.connected or not self.client_socket:
             messagebox.showerror("Error", "Not connected to server.")
             return
-        message = {'type': 'message', 'receiver': receiver, 'content': content}
+        client_id = self.next_client_id
+        self.next_client_id += 1
+        if receiver.startswith(ROOM_PREFIX):
+            message = {'type': 'room_message', 'room': receiver[len(ROOM_PREFIX):], 'content': content,
+                       'client_id': client_id}
+        else:
+            message = {'type': 'message', 'receiver': receiver, 'content': content, 'client_id': client_id}
         try:
-            self.client_socket.send(json.dumps(message).encode('utf-8'))
+            self.client_socket.sendall(self.encode(message))
             timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            self.display_message(self.username, content, timestamp, is_self=True)
+            # The ack fills in the id, which the view needs to page history.
+            entry = [None, self.username, content, timestamp, True]
+            self.pending_sends[client_id] = entry
+            self.render_messages([entry])
         except Exception as e:
             messagebox.showerror("Error", f"Failed to send message: {e}")
 
-    def display_message(self, sender, content, timestamp, is_self=False):
-        if not hasattr(self, 'chat_history'):
+    def chat_view_open(self):
+        return hasattr(self, 'chat_view') and self.chat_view.text.winfo_exists()
+
+    def render_messages(self, entries):
+        if entries and self.chat_view_open():
+            self.chat_view.append(entries)
+
+    def room_request(self, request):
+        room = self.room_entry.get().strip()
+        if room and self.connected and self.client_socket:
+            try:
+                self.client_socket.sendall(self.encode({'type': request, 'room': room}))
+                self.room_entry.delete(0, tk.END)
+            except Exception as e:
+                messagebox.showerror("Error", f"Room request failed: {e}")
+
+    def search(self):
+        query = self.search_entry.get().strip()
+        if query and self.connected and self.client_socket:
+            self.search_query = query
+            self.search_hits = []
+            self.request_search(0)
+
+    def request_search(self, offset):
+        try:
+            self.client_socket.sendall(self.encode({'type': 'search', 'query': self.search_query, 'offset': offset}))
+        except Exception as e:
+            messagebox.showerror("Error", f"Search failed: {e}")
+
+    def show_search_results(self, message):
+        # One results window, reused across searches; "More" fetches the
+        # next ranked page and appends it.
+        if self.search_window is None or not self.search_window.winfo_exists():
+            self.search_window = tk.Toplevel(self)
+            self.search_window.geometry("600x400")
+            self.search_listbox = tk.Listbox(self.search_window, font=('Helvetica', 10))
+            self.search_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+            self.search_listbox.bind('<Double-Button-1>', self.open_search_hit)
+            self.search_more = ttk.Button(self.search_window, text="More",
+                                          command=lambda: self.request_search(self.search_cursor))
+            self.search_more.pack(pady=(0, 10))
+        self.search_window.title(f"Search: {self.search_query}")
+        if len(self.search_hits) == 0:
+            self.search_listbox.delete(0, tk.END)
+        for msg in message.get('messages', []):
+            other = msg['receiver'] if msg['sender'] == self.username else msg['sender']
+            name = "You" if msg['sender'] == self.username else msg['sender']
+            self.search_hits.append(other)
+            self.search_listbox.insert(tk.END, f"[{other}] {name} ({msg['timestamp']}): {msg['content']}")
+        if not self.search_hits:
+            self.search_listbox.insert(tk.END, "No messages found")
+        self.search_cursor = message.get('cursor')
+        self.search_more.configure(state='normal' if message.get('more') else 'disabled')
+
+    def open_search_hit(self, event):
+        selection = self.search_listbox.curselection()
+        if selection and selection[0] < len(self.search_hits):
+            self.current_chat = self.search_hits[selection[0]]
+            self.show_message_area(self.current_chat)
+
+    def request_history(self, user, before):
+        if user.startswith(ROOM_PREFIX):
+            # Rooms have no history API; the view only shows this session.
+            self.chat_view.add_history_page([], None, False, self.username)
             return
-        self.chat_history.configure(state='normal')
-        display_time = timestamp.split()[1][:5] if isinstance(timestamp, str) else datetime.now().strftime('%H:%M')
-        if self.chat_history.index('end-1c') != '1.0':
-            self.chat_history.insert(tk.END, '\n')
-        tag = "self" if is_self else "other"
-        name = "You" if is_self else sender
-        self.chat_history.insert(tk.END, f"{name} ({display_time}): ", tag)
-        self.chat_history.insert(tk.END, content)
-        self.chat_history.tag_configure("self", foreground=self.accent_color, font=('Helvetica', 10, 'bold'))
-        self.chat_history.tag_configure("other", foreground="#E91E63", font=('Helvetica', 10, 'bold'))
-        self.chat_history.see(tk.END)
-        self.chat_history.configure(state='disabled')
+        if self.connected and self.client_socket:
+            try:
+                self.client_socket.sendall(self.encode({'type': 'history', 'with': user, 'before': before}))
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to load chat history: {e}")
 
     def load_chat_history(self, user):
-        self.chat_history.configure(state='normal')
-        self.chat_history.delete('1.0', tk.END)
-        self.chat_history.insert(tk.END, f"Started chatting with {user}\n")
-        self.chat_history.configure(state='disabled')
+        # Only the latest page is fetched now; the view asks for earlier ones
+        # as the user scrolls up.
+        self.pending_sends.clear()
+        self.chat_view = ChatView(self.chat_history, f"Started chatting with {user}",
+                                  lambda before: self.request_history(user, before))
+        self.chat_view.load_older()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chat client")
+    parser.add_argument('--ping-interval', type=float, default=PING_INTERVAL,
+                        help="seconds of silence from the server before it is pinged")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="seconds of silence after which the connection is treated as lost")
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
-    app = ModernUI()
+    args = parse_args()
+    app = ModernUI(args.ping_interval, args.idle_timeout)
     app.mainloop()
\ No newline at end of file
@@ -0,0 +1,272 @@
+import calendar
+import json
+import struct
+import time
+
+from protocol import HEADER, encode_raw_frame
+
+CODEC_JSON = 'json'
+CODEC_BINARY = 'binary'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Binary payloads start with a one-byte tag. The hot frames get a fixed
+# struct header (ids, lengths, timestamp as seconds) followed by their UTF-8
+# strings, the content always last so its length is implied; everything
+# else is TAG_JSON followed by the usual JSON object.
+TAG_JSON = 0
+TAG_MESSAGE = 1  # server to client 1:1 message
+TAG_ROOM_MESSAGE = 2
+TAG_ACK = 3
+TAG_SEND = 4  # client to server 1:1 message
+TAG_ROOM_SEND = 5
+TAG_SEQUENCED = 6  # seq, then any other payload
+
+MESSAGE = struct.Struct('!BqIH')  # tag, id, timestamp, sender length
+ROOM_MESSAGE = struct.Struct('!BqIHH')  # tag, id, timestamp, room length, sender length
+ACK = struct.Struct('!BqBq')  # tag, id, client_id flag, client_id
+SEND = struct.Struct('!BBqH')  # tag, client_id flag, client_id, receiver or room length
+SEQUENCED = struct.Struct('!Bq')  # tag, seq
+
+# client_id is optional and may be null, so whether and how it is present
+# is packed alongside it.
+CLIENT_ID_ABSENT = 0
+CLIENT_ID_NULL = 1
+CLIENT_ID_INT = 2
+
+
+class CodecError(ValueError):
+    pass
+
+
+class Codec:
+    # Turns message dicts into frame payloads and back. One instance is shared
+    # by every connection that negotiated it, and fan-out hands the same dict
+    # to many connections in a row, so the last frame is kept and reused: a
+    # room message or presence delta is encoded once per codec, not per member.
+    name = None
+
+    def __init__(self):
+        self.last = (None, None)
+
+    def encode_frame(self, message):
+        last_message, last_frame = self.last
+        if last_message is message:
+            return last_frame
+        frame = encode_raw_frame(self.encode(message))
+        self.last = (message, frame)
+        return frame
+
+    def encode(self, message):
+        raise NotImplementedError
+
+    def sequence(self, frame, seq):
+        # Returns a copy of an encoded message frame that decodes with a
+        # 'seq' key added. Works on the bytes, so a room message is still
+        # encoded once however many members' streams number it.
+        raise NotImplementedError
+
+    def decode(self, payload):
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    name = CODEC_JSON
+
+    def encode(self, message):
+        return json.dumps(message).encode('utf-8')
+
+    def sequence(self, frame, seq):
+        return encode_raw_frame(frame[HEADER.size:-1] + b', "seq": %d}' % seq)
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+def pack_client_id(message):
+    if 'client_id' not in message:
+        return CLIENT_ID_ABSENT, 0
+    client_id = message['client_id']
+    if client_id is None:
+        return CLIENT_ID_NULL, 0
+    if type(client_id) is int:
+        return CLIENT_ID_INT, client_id
+    return None, None
+
+
+def unpack_client_id(message, flag, client_id):
+    if flag == CLIENT_ID_INT:
+        message['client_id'] = client_id
+    elif flag == CLIENT_ID_NULL:
+        message['client_id'] = None
+    elif flag != CLIENT_ID_ABSENT:
+        raise CodecError(f"Bad client_id flag {flag}")
+    return message
+
+
+class BinaryCodec(Codec):
+    # Only frames whose fields match the packed layout exactly are packed, so
+    # decode(encode(message)) always gives back the same dict; anything else
+    # (pages, presence, room control frames) falls back to embedded JSON.
+    name = CODEC_BINARY
+
+    def __init__(self):
+        super().__init__()
+        # Messages sent within the same second share a timestamp string, so
+        # the last conversion each way is remembered.
+        self.last_timestamp = (None, None)
+        self.last_seconds = (None, None)
+        self.encoders = {
+            'message': self.encode_message,
+            'room_message': self.encode_room_message,
+            'ack': self.encode_ack,
+        }
+
+    def encode(self, message):
+        encoder = self.encoders.get(message.get('type'))
+        if encoder is not None:
+            try:
+                payload = encoder(message)
+            except (struct.error, TypeError, UnicodeEncodeError):
+                payload = None
+            if payload is not None:
+                return payload
+        return bytes((TAG_JSON,)) + json.dumps(message).encode('utf-8')
+
+    def sequence(self, frame, seq):
+        return encode_raw_frame(SEQUENCED.pack(TAG_SEQUENCED, seq) + frame[HEADER.size:])
+
+    def encode_message(self, message):
+        if 'id' not in message:
+            return self.encode_send(TAG_SEND, message, 'receiver')
+        if len(message) != 5:
+            return None
+        message_id, sender, content = message.get('id'), message.get('sender'), message.get('content')
+        seconds = self.timestamp_seconds(message.get('timestamp'))
+        if type(message_id) is not int or type(sender) is not str or type(content) is not str or seconds is None:
+            return None
+        sender = sender.encode('utf-8')
+        return MESSAGE.pack(TAG_MESSAGE, message_id, seconds, len(sender)) + sender + content.encode('utf-8')
+
+    def encode_room_message(self, message):
+        if 'id' not in message:
+            return self.encode_send(TAG_ROOM_SEND, message, 'room')
+        if len(message) != 6:
+            return None
+        message_id, room, sender, content = (message.get('id'), message.get('room'), message.get('sender'),
+                                             message.get('content'))
+        seconds = self.timestamp_seconds(message.get('timestamp'))
+        if (type(message_id) is not int or type(room) is not str or type(sender) is not str
+                or type(content) is not str or seconds is None):
+            return None
+        room = room.encode('utf-8')
+        sender = sender.encode('utf-8')
+        return (ROOM_MESSAGE.pack(TAG_ROOM_MESSAGE, message_id, seconds, len(room), len(sender)) + room + sender
+                + content.encode('utf-8'))
+
+    def encode_send(self, tag, message, target_key):
+        flag, client_id = pack_client_id(message)
+        target, content = message.get(target_key), message.get('content')
+        if flag is None or type(target) is not str or type(content) is not str:
+            return None
+        if len(message) != (3 if flag == CLIENT_ID_ABSENT else 4):
+            return None
+        target = target.encode('utf-8')
+        return SEND.pack(tag, flag, client_id, len(target)) + target + content.encode('utf-8')
+
+    def encode_ack(self, message):
+        flag, client_id = pack_client_id(message)
+        message_id = message.get('id')
+        if flag is None or flag == CLIENT_ID_ABSENT or type(message_id) is not int or len(message) != 3:
+            return None
+        return ACK.pack(TAG_ACK, message_id, flag, client_id)
+
+    def timestamp_seconds(self, timestamp):
+        # Returns None unless the string round-trips exactly.
+        last_timestamp, last_seconds = self.last_timestamp
+        if timestamp == last_timestamp:
+            return last_seconds
+        if type(timestamp) is not str:
+            return None
+        try:
+            seconds = calendar.timegm(time.strptime(timestamp, TIMESTAMP_FORMAT))
+        except ValueError:
+            return None
+        if not 0 <= seconds <= 0xFFFFFFFF or self.timestamp_string(seconds) != timestamp:
+            return None
+        self.last_timestamp = (timestamp, seconds)
+        return seconds
+
+    def timestamp_string(self, seconds):
+        last_seconds, last_timestamp = self.last_seconds
+        if seconds == last_seconds:
+            return last_timestamp
+        timestamp = time.strftime(TIMESTAMP_FORMAT, time.gmtime(seconds))
+        self.last_seconds = (seconds, timestamp)
+        return timestamp
+
+    def decode(self, payload):
+        if not payload:
+            raise CodecError("Empty payload")
+        tag = payload[0]
+        if tag == TAG_JSON:
+            return json.loads(payload[1:])
+        try:
+            if tag == TAG_SEQUENCED:
+                _, seq = SEQUENCED.unpack_from(payload)
+                message = self.decode(payload[SEQUENCED.size:])
+                message['seq'] = seq
+                return message
+            if tag == TAG_MESSAGE:
+                _, message_id, seconds, sender_length = MESSAGE.unpack_from(payload)
+                start = MESSAGE.size
+                return {
+                    'type': 'message',
+                    'id': message_id,
+                    'sender': payload[start:start + sender_length].decode('utf-8'),
+                    'content': payload[start + sender_length:].decode('utf-8'),
+                    'timestamp': self.timestamp_string(seconds)
+                }
+            if tag == TAG_ROOM_MESSAGE:
+                _, message_id, seconds, room_length, sender_length = ROOM_MESSAGE.unpack_from(payload)
+                start = ROOM_MESSAGE.size
+                sender_start = start + room_length
+                return {
+                    'type': 'room_message',
+                    'id': message_id,
+                    'room': payload[start:sender_start].decode('utf-8'),
+                    'sender': payload[sender_start:sender_start + sender_length].decode('utf-8'),
+                    'content': payload[sender_start + sender_length:].decode('utf-8'),
+                    'timestamp': self.timestamp_string(seconds)
+                }
+            if tag == TAG_ACK:
+                _, message_id, flag, client_id = ACK.unpack_from(payload)
+                return unpack_client_id({'type': 'ack', 'id': message_id}, flag, client_id)
+            if tag in (TAG_SEND, TAG_ROOM_SEND):
+                _, flag, client_id, target_length = SEND.unpack_from(payload)
+                start = SEND.size
+                target = payload[start:start + target_length].decode('utf-8')
+                content = payload[start + target_length:].decode('utf-8')
+                if tag == TAG_SEND:
+                    message = {'type': 'message', 'receiver': target, 'content': content}
+                else:
+                    message = {'type': 'room_message', 'room': target, 'content': content}
+                return unpack_client_id(message, flag, client_id)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise CodecError(f"Malformed binary frame: {e}")
+        raise CodecError(f"Unknown binary frame tag {tag}")
+
+
+JSON_CODEC = JSONCodec()
+CODECS = {codec.name: codec for codec in (JSON_CODEC, BinaryCodec())}
+
+
+def get_codec(name):
+    return CODECS.get(name, JSON_CODEC)
+
+
+def choose_codec(offered):
+    # The client lists codecs in order of preference.
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return JSON_CODEC
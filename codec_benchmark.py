@@ -0,0 +1,48 @@
+import argparse
+import json
+
+from codec import CODECS
+from compression_benchmark import sample_frames, time_per_call
+
+
+def codec_frames(seed=0):
+    # The compression samples plus the small frames that dominate a busy
+    # server: acks, and messages in both directions for 1:1 chats and rooms.
+    frames = sample_frames(seed)
+    message = frames['message']
+    frames.update({
+        'send': {'type': 'message', 'receiver': 'user_2', 'content': message['content'], 'client_id': 7},
+        'ack': {'type': 'ack', 'id': 123456, 'client_id': 7},
+        'room_send': {'type': 'room_message', 'room': 'general', 'content': message['content'], 'client_id': 8},
+        'room_message': dict(message, type='room_message', room='general'),
+    })
+    return frames
+
+
+def measure(codec, message, iterations):
+    payload = codec.encode(message)
+    if codec.decode(payload) != message:
+        raise AssertionError(f"{codec.name} does not round-trip {message.get('type')}")
+    return {
+        'bytes': len(payload),
+        'encode_us': round(time_per_call(lambda: codec.encode(message), iterations), 2),
+        'decode_us': round(time_per_call(lambda: codec.decode(payload), iterations), 2),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare frame codecs by size and encode/decode time")
+    parser.add_argument('--iterations', type=int, default=2000, help="timing iterations per frame")
+    parser.add_argument('--output', help="also write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = {name: {codec_name: measure(codec, message, args.iterations) for codec_name, codec in CODECS.items()}
+               for name, message in codec_frames().items()}
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
@@ -0,0 +1,90 @@
+import argparse
+import json
+import random
+import time
+import zlib
+
+from protocol import COMPRESSION_LEVEL, HEADER, FrameDecoder, compress_frame, encode_frame
+
+WORDS = ('hey', 'are', 'we', 'still', 'on', 'for', 'lunch', 'tomorrow', 'the', 'build', 'is', 'green',
+         'again', 'thanks', 'see', 'you', 'at', 'standup', 'can', 'review', 'my', 'branch', 'later', 'ok')
+
+
+def chat_text(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))
+
+
+def timestamp(rng):
+    return f"2026-10-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}"
+
+
+def sample_frames(seed=0):
+    # Representative server-to-client frames, from a single message up to
+    # the large backlog and presence frames compression is meant for.
+    rng = random.Random(seed)
+    users = [f"user_{index}" for index in range(1000)]
+    messages = [{'id': 1000 + index, 'sender': rng.choice(users[:20]), 'content': chat_text(rng),
+                 'timestamp': timestamp(rng)} for index in range(200)]
+    return {
+        'message': {'type': 'message', 'id': 1, 'sender': 'user_1', 'content': chat_text(rng),
+                    'timestamp': timestamp(rng)},
+        'history_page_50': {'type': 'history_page', 'with': 'user_2', 'cursor': 1000,
+                            'messages': [dict(message, receiver='user_2') for message in messages[:50]],
+                            'more': True},
+        'unread_page_200': {'type': 'unread_page', 'messages': messages, 'cursor': 1199, 'more': False},
+        'room_unread_page_200': {'type': 'room_unread_page', 'room': 'general', 'messages': messages,
+                                 'cursor': 1199, 'more': False},
+        'presence_snapshot_1000': {'type': 'presence_snapshot', 'version': 42, 'users': users},
+        'presence_delta_50': {'type': 'presence_delta', 'version': 43, 'user_joined': users[:25],
+                              'user_left': users[500:525]},
+    }
+
+
+def time_per_call(func, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def decode_all(frame):
+    decoder = FrameDecoder()
+    decoder.feed(frame)
+    return decoder.next_frame()
+
+
+def deflate_without_dictionary(frame):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+    return compressor.compress(frame[HEADER.size:]) + compressor.flush()
+
+
+def measure(message, iterations):
+    plain = encode_frame(message)
+    compressed = encode_frame(message, compress=True)
+    return {
+        'plain_bytes': len(plain),
+        'deflate_bytes': len(compressed),
+        'deflate_no_dictionary_bytes': HEADER.size + len(deflate_without_dictionary(plain)),
+        'ratio': round(len(compressed) / len(plain), 3),
+        'encode_plain_us': round(time_per_call(lambda: encode_frame(message), iterations), 1),
+        'compress_us': round(time_per_call(lambda: compress_frame(plain), iterations), 1),
+        'decode_plain_us': round(time_per_call(lambda: decode_all(plain), iterations), 1),
+        'decode_deflate_us': round(time_per_call(lambda: decode_all(compressed), iterations), 1),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare plain and deflate-compressed frames")
+    parser.add_argument('--iterations', type=int, default=200, help="timing iterations per frame")
+    parser.add_argument('--output', help="also write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = {name: measure(message, args.iterations) for name, message in sample_frames().items()}
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
@@ -0,0 +1,208 @@
+import asyncio
+import collections
+import socket
+import threading
+import time
+
+from codec import JSON_CODEC
+
+OUTBOUND_QUEUE_SIZE = 4096
+# Upper bound on frames handed to one sendmsg()/writelines() call.
+MAX_WRITE_BATCH = 64
+
+OVERFLOW_DROP = 'drop'
+OVERFLOW_DISCONNECT = 'disconnect'
+OVERFLOW_SPILL = 'spill'
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_DISCONNECT, OVERFLOW_SPILL)
+
+
+class OutboundQueue:
+    # Bounded per-connection queue of encoded frames, drained by a writer that
+    # belongs to this connection only. Senders never touch the socket, so a
+    # stalled receiver fills its own queue instead of blocking other clients.
+    #
+    # Frames that carry a message_id are chat messages already stored as read;
+    # if they never reach the socket they are handed to on_spill so the
+    # server can put them back into the unread store.
+    def __init__(self, max_size=OUTBOUND_QUEUE_SIZE, overflow=OVERFLOW_SPILL, on_spill=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.max_size = max_size
+        self.overflow = overflow
+        self.on_spill = on_spill
+        self.frames = collections.deque()
+        self.in_flight = []
+        self.closed = False
+        self.dropped = 0
+        # Both are switched by the handshake to what the client negotiated.
+        self.codec = JSON_CODEC
+        self.compressor = None
+        # Set by the reader on every inbound frame.
+        self.last_received = time.monotonic()
+
+    @property
+    def depth(self):
+        return len(self.frames)
+
+    def send_message(self, message, message_id=None):
+        return self.send_frame(self.codec.encode_frame(message), message_id)
+
+    def send_frame(self, frame, message_id=None):
+        if self.closed:
+            self.spill([message_id])
+            return False
+        if len(self.frames) >= self.max_size:
+            self.dropped += 1
+            if self.overflow == OVERFLOW_SPILL:
+                self.spill([message_id])
+            elif self.overflow == OVERFLOW_DISCONNECT:
+                self.spill([message_id])
+                self.close()
+            return False
+        if self.compressor is not None:
+            frame = self.compressor.compress(frame)
+        self.frames.append((frame, message_id))
+        self.wake_writer()
+        return True
+
+    def take_batch(self):
+        batch = []
+        while self.frames and len(batch) < MAX_WRITE_BATCH:
+            batch.append(self.frames.popleft())
+        self.in_flight = batch
+        return [frame for frame, _ in batch]
+
+    def spill(self, message_ids):
+        message_ids = [message_id for message_id in message_ids if message_id is not None]
+        if message_ids and self.on_spill:
+            self.on_spill(message_ids)
+
+    def discard_pending(self):
+        pending = [message_id for _, message_id in self.in_flight]
+        pending.extend(message_id for _, message_id in self.frames)
+        self.in_flight = []
+        self.frames.clear()
+        return pending
+
+    def wake_writer(self):
+        raise NotImplementedError
+
+    def abort(self):
+        # For a peer that stopped answering: also ends a read blocked on it.
+        self.close()
+
+
+class ThreadedClientConnection(OutboundQueue):
+    def __init__(self, sock, **kwargs):
+        super().__init__(**kwargs)
+        self.sock = sock
+        # Re-entrant because the disconnect policy closes from inside send_frame.
+        self.condition = threading.Condition(threading.RLock())
+        self.writer_thread = threading.Thread(target=self.writer_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def send_frame(self, frame, message_id=None):
+        with self.condition:
+            return super().send_frame(frame, message_id)
+
+    def wake_writer(self):
+        self.condition.notify_all()
+
+    def writer_loop(self):
+        while True:
+            with self.condition:
+                while not self.frames and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                frames = self.take_batch()
+            try:
+                self.write_frames(frames)
+            except OSError:
+                self.close()
+                return
+            with self.condition:
+                self.in_flight = []
+                self.condition.notify_all()
+
+    def write_frames(self, frames):
+        if not hasattr(self.sock, 'sendmsg'):
+            self.sock.sendall(b''.join(frames))
+            return
+        while frames:
+            sent = self.sock.sendmsg(frames)
+            while frames and sent >= len(frames[0]):
+                sent -= len(frames[0])
+                frames.pop(0)
+            if frames and sent:
+                frames[0] = memoryview(frames[0])[sent:]
+
+    def flush(self):
+        # Blocks until everything queued so far reached the socket; returns
+        # False if the connection closed first.
+        with self.condition:
+            while (self.frames or self.in_flight) and not self.closed:
+                self.condition.wait()
+            return not self.closed
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            pending = self.discard_pending()
+            self.condition.notify_all()
+        try:
+            # Unblocks a writer stuck in sendmsg() and the reader in recv().
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.spill(pending)
+
+
+class AsyncClientConnection(OutboundQueue):
+    def __init__(self, writer, **kwargs):
+        super().__init__(**kwargs)
+        self.writer = writer
+        self.ready = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.writer_task = asyncio.get_running_loop().create_task(self.writer_loop())
+
+    def wake_writer(self):
+        self.idle.clear()
+        self.ready.set()
+
+    async def writer_loop(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.frames and not self.closed:
+                    self.writer.writelines(self.take_batch())
+                    await self.writer.drain()
+                    self.in_flight = []
+                self.idle.set()
+        except (ConnectionError, OSError):
+            self.close()
+
+    async def flush(self):
+        await self.idle.wait()
+        return not self.closed
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        pending = self.discard_pending()
+        self.ready.set()
+        self.idle.set()
+        self.writer.close()
+        self.spill(pending)
+
+    def abort(self):
+        # close() would wait for the transport to hand its buffer to a peer
+        # that is gone; this drops it, which also ends the pending read.
+        self.close()
+        self.writer.transport.abort()
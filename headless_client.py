@@ -0,0 +1,158 @@
+import asyncio
+
+from codec import CODEC_JSON, JSON_CODEC, get_codec
+from protocol import COMPRESSION_DEFLATE, PONG, FrameDecoder, compress_frame, encode_frame, read_frame
+
+
+class AuthenticationError(Exception):
+    pass
+
+
+class RoomError(Exception):
+    pass
+
+
+class HeadlessClient:
+    # Speaks the same protocol as ModernUI (register/login, then 'message'
+    # frames) without any UI, for load generation and scripted tests.
+    def __init__(self, host, port, username, password, compression=False, codec=CODEC_JSON, sync=False):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.compression = compression
+        self.compress = False
+        self.codec_name = codec
+        # Until the auth response says otherwise.
+        self.codec = JSON_CODEC
+        self.sync = sync
+        self.session = None
+        self.last_seq = 0
+        self.reader = None
+        self.writer = None
+        self.decoder = FrameDecoder()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def authenticate(self, action):
+        auth_data = {'action': action, 'username': self.username, 'password': self.password}
+        if self.codec_name != CODEC_JSON:
+            auth_data['codec'] = [self.codec_name]
+        if self.sync:
+            auth_data['sync'] = True
+        response = await self.send_auth(auth_data)
+        self.session = response.get('session')
+        self.last_seq = 0
+        return response
+
+    async def resume(self):
+        # Picks the session back up on a new connection (call connect()
+        # first); deliveries after last_seq follow the response.
+        return await self.send_auth({'action': 'resume', 'username': self.username, 'session': self.session,
+                                     'seq': self.last_seq})
+
+    async def send_auth(self, auth_data):
+        if self.compression:
+            auth_data['compression'] = [COMPRESSION_DEFLATE]
+        self.codec = JSON_CODEC
+        self.compress = False
+        self.decoder = FrameDecoder()
+        self.writer.write(encode_frame(auth_data))
+        await self.writer.drain()
+        response = await self.recv()
+        if response is None:
+            raise AuthenticationError("Connection closed during authentication")
+        if response.get('status') != 'success':
+            raise AuthenticationError(response.get('message', 'Unknown error'))
+        self.compress = response.get('compression') == COMPRESSION_DEFLATE
+        self.codec = get_codec(response.get('codec'))
+        return response
+
+    async def register(self):
+        return await self.authenticate('register')
+
+    async def login(self):
+        return await self.authenticate('login')
+
+    async def register_or_login(self):
+        # Benchmarks reuse usernames across runs, so an existing account is
+        # not an error.
+        try:
+            return await self.register()
+        except AuthenticationError:
+            await self.close()
+            await self.connect()
+            return await self.login()
+
+    def write(self, message):
+        frame = self.codec.encode_frame(message)
+        self.writer.write(compress_frame(frame) if self.compress else frame)
+
+    def send_message(self, receiver, content, client_id=None):
+        message = {'type': 'message', 'receiver': receiver, 'content': content}
+        if client_id is not None:
+            message['client_id'] = client_id
+        self.write(message)
+
+    def send_room_message(self, room, content, client_id=None):
+        message = {'type': 'room_message', 'room': room, 'content': content}
+        if client_id is not None:
+            message['client_id'] = client_id
+        self.write(message)
+
+    async def enter_room(self, room):
+        # Creates the room, or joins it if someone else got there first.
+        # Must run before anything else reads from the connection.
+        for request in ('create_room', 'join_room'):
+            self.write({'type': request, 'room': room})
+            await self.writer.drain()
+            while True:
+                response = await self.recv()
+                if response is None:
+                    raise ConnectionError("Connection closed while entering room")
+                if response.get('type') in ('room_joined', 'room_error') and response.get('room') == room:
+                    break
+            if response['type'] == 'room_joined':
+                return response
+        raise RoomError(response.get('message', 'Unknown error'))
+
+    def leave_room(self, room):
+        self.write({'type': 'leave_room', 'room': room})
+
+    def request_history(self, other, before=None):
+        self.write({'type': 'history', 'with': other, 'before': before})
+
+    def search(self, query, offset=0):
+        self.write({'type': 'search', 'query': query, 'offset': offset})
+
+    def ack(self):
+        # Lets the server drop what it keeps for replay up to last_seq.
+        self.write({'type': 'sync_ack', 'seq': self.last_seq})
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def recv(self):
+        # Heartbeats are answered here and never returned.
+        while True:
+            payload = await read_frame(self.reader, self.decoder)
+            if payload is None:
+                return None
+            message = self.codec.decode(payload)
+            if message.get('type') == 'ping':
+                self.write(PONG)
+            elif message.get('type') != 'pong':
+                break
+        if 'seq' in message:
+            self.last_seq = message['seq']
+        return message
+
+    async def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
@@ -0,0 +1,281 @@
+import bisect
+import collections
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+
+from storage import (HISTORY_PAGE_SIZE, MAX_MESSAGE_ID, SEARCH_MAX_RESULTS, SEARCH_PAGE_SIZE, UNREAD_PAGE_SIZE,
+                     StorageBackend, conversation_key, rank_search_results, search_terms, search_tokens)
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def completed(result=None):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def failed(error):
+    future = Future()
+    future.set_exception(error)
+    return future
+
+
+def as_text(value):
+    # What SQLite stores in a TEXT NOT NULL column: numbers become their
+    # text, None and anything it can't bind are refused.
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        if not -2 ** 63 <= value < 2 ** 63:
+            raise OverflowError("Python int too large to convert to SQLite INTEGER")
+        return str(value)
+    if isinstance(value, float):
+        return str(value)
+    if value is None:
+        raise ValueError("NOT NULL constraint failed")
+    raise TypeError(f"Unsupported type {type(value).__name__}")
+
+
+def utc_timestamp():
+    # The same form as SQLite's CURRENT_TIMESTAMP.
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime())
+
+
+def contains_phrase(tokens, phrase, prefix):
+    # Whether phrase (a list of tokens) occurs in tokens; with prefix its
+    # last token only has to start a word, like an FTS5 "phrase" * query.
+    last = len(phrase) - 1
+    for start in range(len(tokens) - last):
+        if tokens[start:start + last] != phrase[:last]:
+            continue
+        word = tokens[start + last]
+        if word == phrase[last] or prefix and word.startswith(phrase[last]):
+            return True
+    return False
+
+
+class MemoryStorage(StorageBackend):
+    # Keeps everything in process memory and loses it on exit. Every write
+    # is applied before its future is returned, already resolved, so load
+    # tests measure the network and serialization path without the
+    # database, and tests run fast and in a fixed order.
+    #
+    # Each query has its own index: ids come from one counter, so the
+    # per-conversation and per-room lists are sorted by appending and pages
+    # are a bisect and a slice; a receiver's unread ids are a deque that
+    # mark_read pops from the left.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}  # username: [password, last_seen]
+        self.messages = {}  # id: (sender, receiver, content, timestamp)
+        self.message_ids = itertools.count(1)
+        self.unread = collections.defaultdict(collections.deque)  # receiver: unread ids, ascending
+        self.unread_ids = set()
+        self.conversations = collections.defaultdict(list)  # conversation_key: ids, ascending
+        self.timelines = collections.defaultdict(list)  # username: ids sent or received, ascending
+        self.rooms = {}  # name: creator
+        self.room_members = collections.defaultdict(dict)  # room: {username: last_read_id}
+        self.user_rooms = collections.defaultdict(set)
+        self.room_messages = collections.defaultdict(list)  # room: [(id, sender, content, timestamp)]
+        self.room_message_ids = itertools.count(1)
+
+    def setup_metrics(self, metrics):
+        metrics.gauge('chat_memory_messages', 'Messages held by the in-memory storage engine',
+                      lambda: len(self.messages))
+
+    def register_user(self, username, password):
+        with self.lock:
+            if username in self.users:
+                return False
+            self.users[username] = [password, datetime.now().isoformat()]
+            return True
+
+    def get_password(self, username):
+        with self.lock:
+            user = self.users.get(username)
+            return user[0] if user else None
+
+    def set_password(self, username, password):
+        with self.lock:
+            if username in self.users:
+                self.users[username][0] = password
+        return completed()
+
+    def update_last_seen(self, username):
+        with self.lock:
+            if username in self.users:
+                self.users[username][1] = datetime.now().isoformat()
+        return completed()
+
+    def save_message(self, sender, receiver, content, is_read=False):
+        try:
+            sender, receiver, content = as_text(sender), as_text(receiver), as_text(content)
+        except (OverflowError, TypeError, ValueError) as e:
+            return failed(e)
+        with self.lock:
+            message_id = next(self.message_ids)
+            self.messages[message_id] = (sender, receiver, content, utc_timestamp())
+            if not is_read:
+                self.unread[receiver].append(message_id)
+                self.unread_ids.add(message_id)
+            self.conversations[conversation_key(sender, receiver)].append(message_id)
+            self.timelines[sender].append(message_id)
+            if receiver != sender:
+                self.timelines[receiver].append(message_id)
+        return completed(message_id)
+
+    def message_row(self, message_id):
+        sender, receiver, content, timestamp = self.messages[message_id]
+        return {'id': message_id, 'sender': sender, 'receiver': receiver, 'content': content, 'timestamp': timestamp}
+
+    def get_unread_page(self, username, after_id=0, limit=UNREAD_PAGE_SIZE):
+        with self.lock:
+            unread = self.unread.get(username, ())
+            page_ids = itertools.islice((message_id for message_id in unread if message_id > after_id), limit)
+            page = []
+            for message_id in page_ids:
+                sender, _, content, timestamp = self.messages[message_id]
+                page.append({'id': message_id, 'sender': sender, 'content': content, 'timestamp': timestamp})
+            return page
+
+    def mark_read(self, username, up_to_id):
+        with self.lock:
+            unread = self.unread.get(username)
+            marked = 0
+            while unread and unread[0] <= up_to_id:
+                self.unread_ids.discard(unread.popleft())
+                marked += 1
+        return completed(marked)
+
+    def mark_unread(self, message_ids):
+        with self.lock:
+            returned = collections.defaultdict(list)
+            for message_id in message_ids:
+                if message_id in self.messages and message_id not in self.unread_ids:
+                    self.unread_ids.add(message_id)
+                    returned[self.messages[message_id][1]].append(message_id)
+            # Rare (undelivered messages only), so re-sorting is fine.
+            for receiver, ids in returned.items():
+                self.unread[receiver] = collections.deque(sorted(itertools.chain(self.unread[receiver], ids)))
+        return completed()
+
+    def get_history_page(self, user, other, before_id=None, limit=HISTORY_PAGE_SIZE):
+        upper = before_id if before_id is not None else MAX_MESSAGE_ID
+        with self.lock:
+            ids = self.conversations.get(conversation_key(user, other), [])
+            end = bisect.bisect_left(ids, upper)
+            page_ids = ids[max(0, end - limit - 1):end]
+            more = len(page_ids) > limit
+            return [self.message_row(message_id) for message_id in page_ids[-limit:] if limit], more
+
+    def search_messages(self, username, query, offset=0, limit=SEARCH_PAGE_SIZE):
+        # Same contract as SQLiteStorage.search_messages: the newest
+        # SEARCH_MAX_RESULTS matches, ranked, then paged. There is no
+        # full-text index; the requester's own messages are scanned newest
+        # first.
+        terms = search_terms(query)
+        if not terms:
+            return None
+        limit = max(0, min(limit, SEARCH_MAX_RESULTS - offset))
+        if limit == 0:
+            return [], False
+        # FTS5 drops a phrase with no tokens in it, and matches nothing
+        # when that leaves no phrases at all.
+        phrases = [(tokens, prefix) for tokens, prefix in
+                   ((search_tokens(text), prefix) for text, prefix in terms) if tokens]
+        rows = []
+        with self.lock:
+            for message_id in reversed(self.timelines.get(username, []) if phrases else []):
+                sender, receiver, content, timestamp = self.messages[message_id]
+                tokens = search_tokens(content)
+                if all(contains_phrase(tokens, phrase, prefix) for phrase, prefix in phrases):
+                    rows.append((message_id, sender, receiver, content, timestamp))
+                    if len(rows) == SEARCH_MAX_RESULTS:
+                        break
+        rows = rank_search_results(rows, terms)[offset:offset + limit + 1]
+        messages = [
+            {'id': msg_id, 'sender': sender, 'receiver': receiver, 'content': content, 'timestamp': timestamp}
+            for msg_id, sender, receiver, content, timestamp in rows[:limit]
+        ]
+        return messages, len(rows) > limit
+
+    def create_room(self, room, creator):
+        with self.lock:
+            if room in self.rooms:
+                return completed(False)
+            self.rooms[room] = creator
+            self.room_members[room][creator] = 0
+            self.user_rooms[creator].add(room)
+        return completed(True)
+
+    def join_room(self, room, username):
+        # New members start at the room's current head rather than its
+        # whole history.
+        with self.lock:
+            members = self.room_members[room]
+            if username not in members:
+                messages = self.room_messages.get(room)
+                members[username] = messages[-1][0] if messages else 0
+                self.user_rooms[username].add(room)
+        return completed()
+
+    def leave_room(self, room, username):
+        with self.lock:
+            self.room_members[room].pop(username, None)
+            self.user_rooms[username].discard(room)
+        return completed()
+
+    def load_rooms(self):
+        with self.lock:
+            memberships = {room: [] for room in self.rooms}
+            for room, members in self.room_members.items():
+                if members:
+                    memberships[room] = list(members)
+            heads = {room: messages[-1][0] for room, messages in self.room_messages.items() if messages}
+            return memberships, heads
+
+    def save_room_message(self, room, sender, content):
+        try:
+            room, sender, content = as_text(room), as_text(sender), as_text(content)
+        except (OverflowError, TypeError, ValueError) as e:
+            return failed(e)
+        with self.lock:
+            message_id = next(self.room_message_ids)
+            self.room_messages[room].append((message_id, sender, content, utc_timestamp()))
+        return completed(message_id)
+
+    def get_room_cursors(self, username):
+        with self.lock:
+            return {room: self.room_members[room][username] for room in self.user_rooms.get(username, ())}
+
+    def get_room_page(self, room, after_id, up_to_id, limit=UNREAD_PAGE_SIZE):
+        with self.lock:
+            messages = self.room_messages.get(room, [])
+            start = bisect.bisect_right(messages, after_id, key=lambda message: message[0])
+            page = []
+            for message_id, sender, content, timestamp in messages[start:start + limit]:
+                if message_id > up_to_id:
+                    break
+                page.append({'id': message_id, 'sender': sender, 'content': content, 'timestamp': timestamp})
+            return page
+
+    def advance_room_cursor(self, room, username, up_to_id):
+        with self.lock:
+            members = self.room_members.get(room, {})
+            if username in members:
+                members[username] = max(members[username], up_to_id)
+        return completed()
+
+    def set_room_cursors(self, username, cursors):
+        with self.lock:
+            for room, last_read_id in cursors.items():
+                members = self.room_members.get(room, {})
+                if username in members:
+                    members[username] = last_read_id
+        return completed()
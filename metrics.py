@@ -0,0 +1,213 @@
+import bisect
+import collections
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, from 50us to 5s.
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PROFILER_INTERVAL = 0.005
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value}"
+        ]
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def render(self):
+        with self.lock:
+            counts = list(self.counts)
+            total_sum = self.sum
+            total_count = self.count
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {total_count}')
+        lines.append(f"{self.name}_sum {total_sum}")
+        lines.append(f"{self.name}_count {total_count}")
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class CallbackMetric:
+    # Value is read from the owning object at scrape time, so gauges such as
+    # connected clients or queue depth cost nothing on the hot path.
+    def __init__(self, name, help_text, read_value, kind='gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.read_value = read_value
+        self.kind = kind
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.kind}",
+            f"{self.name} {self.read_value()}"
+        ]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text):
+        return self.register(Counter(name, help_text))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def gauge(self, name, help_text, read_value):
+        return self.register(CallbackMetric(name, help_text, read_value))
+
+    def counter_func(self, name, help_text, read_value):
+        return self.register(CallbackMetric(name, help_text, read_value, kind='counter'))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    # Samples every thread's stack at a fixed interval and aggregates them as
+    # collapsed stacks (one "frame;frame;frame count" line per stack), the
+    # input format of flamegraph tools. Costs nothing while stopped.
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.samples = collections.Counter()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.samples.clear()
+            self.thread = threading.Thread(target=self.sample_loop, name='sampling-profiler')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+
+    def sample_loop(self):
+        own_id = threading.get_ident()
+        while self.running:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.reverse()
+                with self.lock:
+                    self.samples[';'.join(stack)] += 1
+            time.sleep(self.interval)
+
+    def render(self):
+        with self.lock:
+            return ''.join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        routes = {
+            '/metrics': lambda: self.server.registry.render(),
+            '/profile': lambda: self.server.profiler.render(),
+            '/profile/start': lambda: self.toggle_profiler(True),
+            '/profile/stop': lambda: self.toggle_profiler(False),
+        }
+        route = routes.get(self.path.split('?', 1)[0])
+        if route is None:
+            self.send_error(404)
+            return
+        body = route().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def toggle_profiler(self, enabled):
+        if enabled:
+            self.server.profiler.start()
+            return "profiler started\n"
+        self.server.profiler.stop()
+        return "profiler stopped\n"
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(registry, profiler, host, port):
+    # Serves /metrics in Prometheus text format plus /profile, /profile/start
+    # and /profile/stop for the runtime sampling profiler.
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    http_server.registry = registry
+    http_server.profiler = profiler
+    thread = threading.Thread(target=http_server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    return http_server
@@ -0,0 +1,74 @@
+import threading
+import time
+
+PRESENCE_COALESCE_WINDOW = 0.05
+
+
+def schedule_with_timer(delay, callback):
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+class PresenceTracker:
+    # Keeps the set of online users and publishes changes as versioned deltas.
+    # Joins and leaves within one coalescing window are folded into a single
+    # 'presence_delta' frame, so a reconnect storm costs one frame per window
+    # per client instead of a full user list per event.
+    def __init__(self, get_connections, window=PRESENCE_COALESCE_WINDOW, schedule=schedule_with_timer,
+                 flush_latency=None):
+        self.get_connections = get_connections
+        self.flush_latency = flush_latency
+        self.window = window
+        self.schedule = schedule
+        self.lock = threading.Lock()
+        self.online = set()
+        self.published = set()
+        self.version = 0
+        self.flush_pending = False
+
+    def join(self, username, connection=None):
+        # connection is None for users connected to another worker process;
+        # they only need to show up in other clients' deltas.
+        with self.lock:
+            self.online.add(username)
+            # The snapshot and every later delta are queued under the same lock,
+            # so the new client always sees them in version order.
+            if connection is not None:
+                snapshot = {'type': 'presence_snapshot', 'version': self.version, 'users': sorted(self.published)}
+                connection.send_message(snapshot)
+            self.request_flush()
+
+    def leave(self, username):
+        with self.lock:
+            self.online.discard(username)
+            self.request_flush()
+
+    def request_flush(self):
+        if not self.flush_pending:
+            self.flush_pending = True
+            self.schedule(self.window, self.flush)
+
+    def flush(self):
+        started = time.perf_counter()
+        with self.lock:
+            self.flush_pending = False
+            joined = self.online - self.published
+            left = self.published - self.online
+            if not joined and not left:
+                return
+            self.version += 1
+            self.published = set(self.online)
+            delta = {
+                'type': 'presence_delta',
+                'version': self.version,
+                'user_joined': sorted(joined),
+                'user_left': sorted(left)
+            }
+            # Enqueue only: a slow client can't hold the lock up. The delta
+            # is encoded once per codec, not once per client.
+            for connection in self.get_connections():
+                connection.send_message(delta)
+        if self.flush_latency is not None:
+            self.flush_latency.observe(time.perf_counter() - started)
@@ -0,0 +1,187 @@
+import json
+import struct
+import zlib
+
+# Every frame on the wire is a 4-byte big-endian payload length followed by
+# the payload itself (a UTF-8 JSON object). If the top bit of the length is
+# set, the payload is raw deflate of that JSON, compressed against
+# PRESET_DICTIONARY.
+HEADER = struct.Struct('!I')
+COMPRESSED_FLAG = 0x80000000
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_BUFFER_SIZE = 64 * 1024
+# Consumed bytes are only trimmed from the front of the buffer once this many
+# have piled up, so small frames don't each pay for a memmove.
+COMPACT_THRESHOLD = 64 * 1024
+
+COMPRESSION_DEFLATE = 'deflate'
+# Payloads smaller than this go out plain: deflate can't win much on them.
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_LEVEL = 6
+# Both ends prime deflate with these bytes, so even the first occurrence of
+# a key or frame type in a payload is a back-reference. zlib favours the end
+# of the dictionary, so the most common strings come last.
+PRESET_DICTIONARY = (
+    b'"user_joined": [], "user_left": [], "users": [], "version": '
+    b'{"type": "presence_snapshot", {"type": "presence_delta", '
+    b'{"type": "room_unread_page", "room": {"type": "room_message", '
+    b'{"type": "history_page", "with": {"type": "unread_page", "messages": [{"id": '
+    b'"cursor": , "more": true}, "more": false}, "client_id": {"type": "ack", "id": '
+    b', "receiver": "{"type": "message", "id": , "sender": '
+    b'", "content": "", "timestamp": "'
+)
+
+# Either side pings once it has heard nothing from the other for
+# PING_INTERVAL seconds and gives up on a peer that stays silent for
+# IDLE_TIMEOUT; any frame, not just a pong, counts as a sign of life.
+PING_INTERVAL = 30
+IDLE_TIMEOUT = 90
+PING = {'type': 'ping'}
+PONG = {'type': 'pong'}
+
+
+class FrameError(ValueError):
+    pass
+
+
+def encode_frame(message, compress=False):
+    frame = encode_raw_frame(json.dumps(message).encode('utf-8'))
+    return compress_frame(frame) if compress else frame
+
+
+def encode_raw_frame(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+def compress_frame(frame, threshold=COMPRESSION_THRESHOLD):
+    # Takes an encoded plain frame; returns the compressed frame, or the
+    # same frame if it is too small or doesn't shrink.
+    if len(frame) - HEADER.size < threshold:
+        return frame
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15, zdict=PRESET_DICTIONARY)
+    payload = compressor.compress(memoryview(frame)[HEADER.size:]) + compressor.flush()
+    if len(payload) + HEADER.size >= len(frame):
+        return frame
+    return HEADER.pack(len(payload) | COMPRESSED_FLAG) + payload
+
+
+def decompress_payload(data, max_size=MAX_FRAME_SIZE):
+    decompressor = zlib.decompressobj(-15, zdict=PRESET_DICTIONARY)
+    try:
+        payload = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise FrameError(f"Corrupt compressed frame: {e}")
+    if decompressor.unconsumed_tail:
+        raise FrameError(f"Compressed frame expands beyond limit of {max_size}")
+    return payload
+
+
+class FrameCompressor:
+    # Shared by all connections that negotiated compression. Fan-out hands
+    # the same frame object to many connections in a row, so the last result
+    # is kept and reused: a room message is compressed once, not per member.
+    def __init__(self, threshold=COMPRESSION_THRESHOLD):
+        self.threshold = threshold
+        self.last = (None, None)
+        self.plain_bytes = 0
+        self.wire_bytes = 0
+
+    def compress(self, frame):
+        last_frame, last_result = self.last
+        if last_frame is frame:
+            result = last_result
+        else:
+            result = compress_frame(frame, self.threshold)
+            self.last = (frame, result)
+        self.plain_bytes += len(frame)
+        self.wire_bytes += len(result)
+        return result
+
+
+def decode_payload(payload):
+    return json.loads(payload)
+
+
+class FrameDecoder:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, recv_size=RECV_BUFFER_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.pos = 0
+        self.bytes_received = 0
+        # Scratch space for recv_into(), reused for every read on the socket.
+        # Only the threaded path reads into it, so it is allocated on the
+        # first read_from(): idle asyncio connections don't carry it.
+        self.recv_size = recv_size
+        self.chunk = None
+        self.chunk_view = None
+
+    def feed(self, data):
+        self.buffer += data
+        self.bytes_received += len(data)
+
+    def next_frame(self):
+        buffer = self.buffer
+        available = len(buffer) - self.pos
+        if available < HEADER.size:
+            return None
+
+        (length,) = HEADER.unpack_from(buffer, self.pos)
+        compressed = length & COMPRESSED_FLAG
+        length &= ~COMPRESSED_FLAG
+        if length > self.max_frame_size:
+            raise FrameError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+        if available < HEADER.size + length:
+            return None
+
+        start = self.pos + HEADER.size
+        end = start + length
+        payload = bytes(buffer[start:end])
+        self.pos = end
+
+        if self.pos == len(buffer):
+            buffer.clear()
+            self.pos = 0
+        elif self.pos >= COMPACT_THRESHOLD:
+            del buffer[:self.pos]
+            self.pos = 0
+        if compressed:
+            payload = decompress_payload(payload, self.max_frame_size)
+        return payload
+
+    def frames(self):
+        while True:
+            payload = self.next_frame()
+            if payload is None:
+                return
+            yield payload
+
+    def read_from(self, sock):
+        # Returns the number of bytes read; 0 means the peer closed the socket.
+        if self.chunk is None:
+            self.chunk = bytearray(self.recv_size)
+            self.chunk_view = memoryview(self.chunk)
+        received = sock.recv_into(self.chunk)
+        if received:
+            self.buffer += self.chunk_view[:received]
+            self.bytes_received += received
+        return received
+
+
+def recv_frame(sock, decoder):
+    while True:
+        payload = decoder.next_frame()
+        if payload is not None:
+            return payload
+        if not decoder.read_from(sock):
+            return None
+
+
+async def read_frame(reader, decoder):
+    while True:
+        payload = decoder.next_frame()
+        if payload is not None:
+            return payload
+        data = await reader.read(RECV_BUFFER_SIZE)
+        if not data:
+            return None
+        decoder.feed(data)
@@ -0,0 +1,121 @@
+import collections
+import threading
+
+ROOM_NAME_MAX_LENGTH = 64
+
+
+class RoomDirectory:
+    # In-memory index of room membership, loaded from SQLite at startup and
+    # kept in step with every create, join and leave. Member lists are
+    # tuples replaced on change, so fan-out iterates them without copying.
+    #
+    # Offline members get no per-message rows: room_members keeps one
+    # last_read_id cursor per membership. While a member is online it is
+    # only written when they go offline, as the room's head at that point,
+    # held back by anything they were not actually sent: the rest of a login
+    # backlog, or a live frame their outbound queue spilled.
+    def __init__(self):
+        # Held while a room message is fanned out and while a member's
+        # cursors are taken, so a message is either delivered live or below
+        # the cursor, never neither.
+        self.lock = threading.RLock()
+        self.members = {}  # room: tuple of usernames
+        self.user_rooms = collections.defaultdict(set)
+        self.heads = {}  # room: newest message id
+        self.floors = {}  # (room, username): (connection, first id sent live)
+        self.backlog = {}  # (room, username): first id of the login backlog not yet flushed
+        # Separate lock: spills are reported from inside a connection's own
+        # lock, which fan-out may already be waiting on.
+        self.gap_lock = threading.Lock()
+        self.gaps = {}  # (room, username): oldest spilled id
+
+    def load(self, memberships, heads):
+        with self.lock:
+            for room, usernames in memberships.items():
+                self.members[room] = tuple(usernames)
+                for username in usernames:
+                    self.user_rooms[username].add(room)
+            self.heads.update(heads)
+
+    def exists(self, room):
+        return room in self.members
+
+    def is_member(self, room, username):
+        return room in self.user_rooms.get(username, ())
+
+    def members_of(self, room):
+        return self.members.get(room, ())
+
+    def rooms_of(self, username):
+        return sorted(self.user_rooms.get(username, ()))
+
+    def add_member(self, room, username):
+        with self.lock:
+            members = self.members.get(room, ())
+            if username not in members:
+                self.members[room] = members + (username,)
+            self.user_rooms[username].add(room)
+
+    def remove_member(self, room, username):
+        with self.lock:
+            members = self.members.get(room, ())
+            if username in members:
+                self.members[room] = tuple(member for member in members if member != username)
+            rooms = self.user_rooms.get(username)
+            if rooms is not None:
+                rooms.discard(room)
+                if not rooms:
+                    del self.user_rooms[username]
+            self.floors.pop((room, username), None)
+            self.backlog.pop((room, username), None)
+        with self.gap_lock:
+            self.gaps.pop((room, username), None)
+
+    def advance_head(self, room, message_id):
+        if message_id > self.heads.get(room, 0):
+            self.heads[room] = message_id
+
+    def delivered_live(self, room, username, connection, message_id):
+        floor = self.floors.get((room, username))
+        if floor is None or floor[0] is not connection:
+            self.floors[(room, username)] = (connection, message_id)
+
+    def backlog_limit(self, room, username, connection):
+        # Newest id a login backlog may include: anything from the first
+        # live delivery on this connection onwards is already on its way.
+        with self.lock:
+            limit = self.heads.get(room, 0)
+            floor = self.floors.get((room, username))
+            if floor is not None and floor[0] is connection:
+                limit = min(limit, floor[1] - 1)
+            return limit
+
+    def backlog_pending(self, room, username, next_id):
+        with self.lock:
+            if next_id is None:
+                self.backlog.pop((room, username), None)
+            else:
+                self.backlog[(room, username)] = next_id
+
+    def note_gap(self, room, username, message_id):
+        with self.gap_lock:
+            gap = self.gaps.get((room, username))
+            if gap is None or message_id < gap:
+                self.gaps[(room, username)] = message_id
+
+    def offline_cursors(self, username):
+        cursors = {}
+        with self.lock:
+            for room in self.user_rooms.get(username, ()):
+                key = (room, username)
+                cursor = self.heads.get(room, 0)
+                self.floors.pop(key, None)
+                pending = self.backlog.pop(key, None)
+                if pending is not None:
+                    cursor = min(cursor, pending - 1)
+                with self.gap_lock:
+                    gap = self.gaps.pop(key, None)
+                if gap is not None:
+                    cursor = min(cursor, gap - 1)
+                cursors[room] = cursor
+        return cursors
@@ -5,9 +5,9 @@ import os
 import time
 import sys
 
-def start_server():
+def start_server(server_args=()):
     print("Starting server...")
-    server_process = subprocess.Popen([sys.executable, "server.py"])
+    server_process = subprocess.Popen([sys.executable, "server.py", *server_args])
     return server_process
 
 def start_client():
@@ -16,8 +16,8 @@ def start_client():
     return client_process
 
 if __name__ == "__main__":
-    # Start the server first
-    server = start_server()
+    # Start the server first; extra arguments (e.g. --mode asyncio, --workers 4) go to server.py
+    server = start_server(sys.argv[1:])
     
     # Wait a moment for the server to initialize
     time.sleep(1)
@@ -0,0 +1,105 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+
+from benchmark import summarize_latencies
+from storage import SQLiteStorage
+
+# Word frequencies follow a rough Zipf curve, like real chat text: a few
+# words are in most messages and most words are rare.
+VOCABULARY_SIZE = 50000
+INSERT_BATCH_SIZE = 50000
+
+
+def make_vocabulary(rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add(''.join(rng.choice(letters) for _ in range(rng.randint(3, 10))))
+    words = sorted(words)
+    rng.shuffle(words)
+    weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(words))))
+    return words, weights
+
+
+def populate(storage, config, rng, words, weights):
+    # Bulk-inserts straight into the messages table, then indexes it with
+    # the same rebuild an existing deployment would run.
+    users = [f"user_{index}" for index in range(config['users'])]
+    conn = storage.reader()
+    inserted = 0
+    while inserted < config['messages']:
+        count = min(INSERT_BATCH_SIZE, config['messages'] - inserted)
+        rows = []
+        for _ in range(count):
+            sender, receiver = rng.sample(users, 2)
+            content = ' '.join(rng.choices(words, cum_weights=weights, k=rng.randint(3, 20)))
+            rows.append((sender, receiver, content))
+        conn.execute("BEGIN")
+        conn.executemany("INSERT INTO messages (sender, receiver, content, is_read) VALUES (?, ?, ?, 1)", rows)
+        conn.execute("COMMIT")
+        inserted += count
+    started = time.perf_counter()
+    storage.rebuild_search_index()
+    return users, time.perf_counter() - started
+
+
+def run_queries(storage, config, rng, users, words, weights):
+    # Mixes common and rare terms, two-word queries and prefix queries,
+    # each for a random user, paging like a client pressing "More".
+    latencies = []
+    hits = 0
+    for index in range(config['queries']):
+        terms = rng.choices(words, cum_weights=weights, k=1 + index % 2)
+        if index % 5 == 0:
+            terms = [terms[0][:3] + '*']
+        offset = 0 if index % 4 else 20
+        started = time.perf_counter()
+        messages, _ = storage.search_messages(rng.choice(users), ' '.join(terms), offset)
+        latencies.append((time.perf_counter() - started) * 1000)
+        hits += len(messages)
+    return latencies, hits
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure full-text search latency over a generated message store")
+    parser.add_argument('--db', default='search_benchmark.db', help="SQLite file to create (reused if it exists)")
+    parser.add_argument('--messages', type=int, default=1000000, help="messages to generate")
+    parser.add_argument('--users', type=int, default=10000, help="distinct users sending them")
+    parser.add_argument('--queries', type=int, default=2000, help="search queries to time")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="also write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = vars(args).copy()
+    output = config.pop('output')
+    rng = random.Random(config['seed'])
+    words, weights = make_vocabulary(rng)
+    existing = os.path.exists(config['db'])
+    storage = SQLiteStorage(config['db'], archive_dir=config['db'] + '.archive')
+    try:
+        if existing:
+            users = [f"user_{index}" for index in range(config['users'])]
+            config['messages'] = storage.reader().execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            index_seconds = None
+        else:
+            users, index_seconds = populate(storage, config, rng, words, weights)
+        latencies, hits = run_queries(storage, config, rng, users, words, weights)
+    finally:
+        storage.close()
+    report = json.dumps({
+        'config': config,
+        'index_seconds': index_seconds,
+        'results_returned': hits,
+        'latency_ms': summarize_latencies(latencies)
+    }, indent=2)
+    print(report)
+    if output:
+        with open(output, 'w') as f:
+            f.write(report + '\n')
@@ -1,50 +1,110 @@
 import socket
 import threading
-import sqlite3
 import json
 import time
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from archive import ARCHIVE_DIR
+from auth import PasswordHasher, needs_rehash
+from codec import CodecError, choose_codec
+from connection import OUTBOUND_QUEUE_SIZE, OVERFLOW_SPILL, OVERFLOW_POLICIES, AsyncClientConnection, ThreadedClientConnection
+from metrics import MetricsRegistry, SamplingProfiler, start_metrics_server
+from protocol import (COMPRESSION_DEFLATE, IDLE_TIMEOUT, PING, PING_INTERVAL, PONG, FrameCompressor, FrameDecoder,
+                      FrameError, decode_payload, encode_frame, read_frame, recv_frame)
+from presence import PresenceTracker
+from rooms import ROOM_NAME_MAX_LENGTH, RoomDirectory
+from sessions import SESSION_RESUME_WINDOW, Session
+from memory_storage import MemoryStorage
+from storage import DB_PATH, HISTORY_PAGE_SIZE, MAX_MESSAGE_ID, SEARCH_PAGE_SIZE, STORAGE_ENGINES, STORAGE_MEMORY, STORAGE_SQLITE, SQLiteStorage
+from timerwheel import TimerWheel
+
+LISTEN_BACKLOG = 4096
+ASYNC_DB_WORKERS = 4
+ROOM_REQUESTS = ('create_room', 'join_room', 'leave_room', 'room_message')
+SEARCH_QUERY_MAX_LENGTH = 256
+
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5555):
+    def __init__(self, host='0.0.0.0', port=5555, queue_size=OUTBOUND_QUEUE_SIZE, overflow=OVERFLOW_SPILL,
+                 metrics_host='127.0.0.1', metrics_port=None, reuse_port=False, compression=True,
+                 archive_dir=ARCHIVE_DIR, archive_after=None, resume_window=SESSION_RESUME_WINDOW,
+                 ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT, storage=STORAGE_SQLITE, db_path=DB_PATH):
         self.host = host
         self.port = port
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.compressor = FrameCompressor() if compression else None
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Lets several worker processes bind the same port; the kernel
+            # spreads incoming connections across them.
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.clients = {}  # username: (connection, address)
-        self.setup_database()
-        
-    def setup_database(self):
-        conn = sqlite3.connect('chat_app.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            last_seen TEXT
-        )
-        ''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sender TEXT NOT NULL,
-            receiver TEXT NOT NULL,
-            content TEXT NOT NULL,
-            timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
-            is_read BOOLEAN DEFAULT 0
-        )
-        ''')
+        self.clients = {}  # username: (connection or Session, address)
+        self.sessions = {}  # username: Session
+        self.resume_window = resume_window
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        # Every heartbeat check and resume window runs off one wheel.
+        self.timers = TimerWheel()
+        self.schedule = self.timers.schedule
+        self.delivery_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='delivery')
+        self.storage = open_storage(storage, db_path, archive_dir, archive_after)
+        self.passwords = PasswordHasher()
+        self.rooms = RoomDirectory()
+        self.rooms.load(*self.storage.load_rooms())
+        self.setup_metrics()
+        self.presence = PresenceTracker(self.connected_clients, flush_latency=self.presence_latency)
         
-        conn.commit()
-        conn.close()
+    def setup_metrics(self):
+        self.metrics = MetricsRegistry()
+        self.profiler = SamplingProfiler()
+        metrics = self.metrics
+        self.auth_latency = metrics.histogram('chat_auth_seconds', 'Time to register or authenticate a user')
+        self.auth_failures = metrics.counter('chat_auth_failures_total', 'Rejected registrations and logins')
+        self.decode_latency = metrics.histogram('chat_decode_seconds', 'Time to decode one inbound frame')
+        self.messages_received = metrics.counter('chat_messages_total', 'Chat messages received from clients')
+        self.save_latency = metrics.histogram('chat_save_message_seconds', 'Time from queuing a message to its durable commit')
+        self.forward_latency = metrics.histogram('chat_forward_seconds', 'Time to encode and queue a forwarded message')
+        self.presence_latency = metrics.histogram('chat_presence_flush_seconds', 'Time to publish one presence delta')
+        self.spilled_messages = metrics.counter('chat_spilled_messages_total', 'Messages returned to the unread store undelivered')
+        self.room_fanout = metrics.histogram('chat_room_fanout_seconds', 'Time to queue one room message for every online member')
+        self.search_latency = metrics.histogram('chat_search_seconds', 'Time to run one full-text search query')
+        self.session_resumes = metrics.counter('chat_session_resumes_total', 'Dropped sync sessions resumed without a login')
+        self.idle_disconnects = metrics.counter('chat_idle_disconnects_total', 'Connections closed for not answering pings')
+        metrics.gauge('chat_connected_clients', 'Authenticated connections', lambda: len(self.clients))
+        metrics.gauge('chat_sync_sessions', 'Sync sessions, attached or waiting to be resumed', lambda: len(self.sessions))
+        metrics.gauge('chat_pending_timers', 'Heartbeat checks and resume windows waiting on the timer wheel',
+                      lambda: len(self.timers))
+        metrics.gauge('chat_outbound_queued_frames', 'Frames waiting in all outbound queues',
+                      lambda: sum(self.queue_depths().values()))
+        metrics.gauge('chat_outbound_queued_frames_max', 'Frames waiting in the deepest outbound queue',
+                      lambda: max(self.queue_depths().values(), default=0))
+        metrics.counter_func('chat_password_hashes_total', 'Password KDF runs (registrations and uncached logins)',
+                             lambda: self.passwords.hashes)
+        metrics.counter_func('chat_session_cache_hits_total', 'Logins verified from the session cache without the KDF',
+                             lambda: self.passwords.cache_hits)
+        metrics.counter_func('chat_compression_plain_bytes_total', 'Bytes queued to compressing clients before compression',
+                             lambda: self.compressor.plain_bytes if self.compressor else 0)
+        metrics.counter_func('chat_compression_wire_bytes_total', 'Bytes queued to compressing clients after compression',
+                             lambda: self.compressor.wire_bytes if self.compressor else 0)
+        self.storage.setup_metrics(metrics)
+    
+    def start_metrics(self):
+        if self.metrics_port is not None:
+            start_metrics_server(self.metrics, self.profiler, self.metrics_host, self.metrics_port)
+            print(f"Metrics available on http://{self.metrics_host}:{self.metrics_port}/metrics")
         
     def start(self):
-        self.server_socket.listen(5)
+        self.server_socket.listen(LISTEN_BACKLOG)
         print(f"Server started on {self.host}:{self.port}")
+        self.start_metrics()
+        self.timers.start()
         
         try:
             while True:
@@ -56,157 +116,859 @@ class ChatServer:
             print("Server shutting down...")
         finally:
             self.server_socket.close()
+            self.storage.close()
+            self.passwords.close()
+            self.delivery_executor.shutdown(wait=False)
     
     def handle_client(self, client_socket, address):
+        connection = ThreadedClientConnection(client_socket, **self.queue_options())
+        self.watch_connection(connection)
+        decoder = FrameDecoder()
+        username = None
+        delivery = None
         try:
-            auth_data = client_socket.recv(1024).decode('utf-8')
-            auth_info = json.loads(auth_data)
-            
-            username = auth_info.get('username')
-            password = auth_info.get('password')
-            action = auth_info.get('action', 'login')
+            auth_data = recv_frame(client_socket, decoder)
+            if auth_data is None:
+                return
+            connection.last_received = time.monotonic()
+            auth_info = decode_payload(auth_data)
+            action, username, password = self.read_credentials(connection, auth_info)
             
-            if action == 'register':
-                success = self.register_user(username, password)
-                if success:
-                    self.clients[username] = (client_socket, address)
-                    response = {'status': 'success', 'message': 'Registration successful'}
+            if action in ('register', 'login'):
+                if action == 'register':
+                    success = self.register_user(username, password)
                 else:
-                    response = {'status': 'error', 'message': 'Username already exists'}
-                client_socket.send(json.dumps(response).encode('utf-8'))
+                    success = self.authenticate_user(username, password)
+                delivery, spilled = self.auth_result(connection, auth_info, action, username, success)
+                if delivery is not None:
+                    if spilled is not None:
+                        spilled.result()
+                    # Only now can other clients' messages be queued behind
+                    # the response.
+                    self.clients[username] = (delivery, address)
+                    if action == 'login':
+                        self.send_unread_backlog(delivery, username)
+                        self.send_room_backlog(delivery, username)
             
-            elif action == 'login':
-                success = self.authenticate_user(username, password)
-                if success:
-                    self.clients[username] = (client_socket, address)
-                    response = {'status': 'success', 'message': 'Login successful'}
-                    unread_messages = self.get_unread_messages(username)
-                    response['unread_messages'] = unread_messages
-                else:
-                    response = {'status': 'error', 'message': 'Invalid credentials'}
-                client_socket.send(json.dumps(response).encode('utf-8'))
+            elif action == 'resume':
+                delivery = self.resume_session(connection, auth_info)
             
-            if username in self.clients:
-                self.broadcast_active_users()
+            if delivery is not None and self.clients.get(username, (None,))[0] is delivery:
+                self.session_started(username, delivery, action)
                 
                 while True:
                     try:
-                        message_data = client_socket.recv(4096).decode('utf-8')
-                        if not message_data:
+                        message_data = recv_frame(client_socket, decoder)
+                        if message_data is None:
                             break
+                        connection.last_received = time.monotonic()
                         
-                        message_obj = json.loads(message_data)
-                        
-                        if message_obj.get('type') == 'message':
-                            receiver = message_obj.get('receiver')
-                            content = message_obj.get('content')
-                            
-                            self.save_message(username, receiver, content)
-                            
-                            if receiver in self.clients:
-                                receiver_socket = self.clients[receiver][0]
-                                forward_message = {
-                                    'type': 'message',
-                                    'sender': username,
-                                    'content': content,
-                                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                                }
-                                try:
-                                    receiver_socket.send(json.dumps(forward_message).encode('utf-8'))
-                                except (ConnectionResetError, BrokenPipeError):
-                                    print(f"Failed to send message to {receiver} (disconnected)")
-                                    
-                    except json.JSONDecodeError:
+                        message_obj = self.decode_message(connection, message_data)
+                        self.dispatch(connection, username, delivery, message_obj)
+                    except (json.JSONDecodeError, CodecError):
                         continue
-                    except (ConnectionResetError, BrokenPipeError):
+                    except (ConnectionResetError, BrokenPipeError, FrameError):
                         break
+            else:
+                # Let the error reply reach the client before closing.
+                connection.flush()
                     
         except Exception as e:
             print(f"Error handling client {address}: {e}")
         finally:
-            if username in self.clients:
-                del self.clients[username]
-                self.update_last_seen(username)
-                self.broadcast_active_users()
+            # Closed first so anything still queued is reported as spilled
+            # before user_offline records where the user got up to.
+            connection.close()
+            if username is not None:
+                self.client_disconnected(username, connection)
             client_socket.close()
     
-    def register_user(self, username, password):
-        try:
-            conn = sqlite3.connect('chat_app.db')
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO users (username, password, last_seen) VALUES (?, ?, ?)",
-                (username, password, datetime.now().isoformat()))
-            conn.commit()
-            conn.close()
-            return True
-        except sqlite3.IntegrityError:
+    def watch_connection(self, connection):
+        self.timers.schedule(self.ping_interval, lambda: self.check_heartbeat(connection))
+    
+    def check_heartbeat(self, connection):
+        # Pings a connection once it has gone quiet and closes it when it
+        # stays silent past idle_timeout. The blocked read then ends and the
+        # handler cleans up as for any disconnect: user_offline,
+        # update_last_seen, spilling what was still queued.
+        if connection.closed:
+            return
+        idle = time.monotonic() - connection.last_received
+        if idle >= self.idle_timeout:
+            self.idle_disconnects.inc()
+            connection.abort()
+            return
+        if idle >= self.ping_interval:
+            connection.send_message(PING)
+            delay = min(self.ping_interval, self.idle_timeout - idle)
+        else:
+            delay = self.ping_interval - idle
+        self.timers.schedule(delay, lambda: self.check_heartbeat(connection))
+    
+    def open_delivery(self, connection, username, auth_info, response):
+        # Returns what deliveries to username go through from now on: a new
+        # Session if the client asked for sync, otherwise the connection
+        # itself, plus a future (or None) for handing back what the user's
+        # previous session still held, which a login backlog must wait for.
+        spilled = self.replace_session(username)
+        if not auth_info.get('sync'):
+            return connection, spilled
+        session = Session(username, connection, self.spill_messages)
+        self.sessions[username] = session
+        response['session'] = session.token
+        return session, spilled
+    
+    def replace_session(self, username):
+        session = self.sessions.pop(username, None)
+        if session is not None:
+            return self.spill_messages(session.end() or [])
+        return None
+    
+    def resume_session(self, connection, auth_info):
+        # A reconnecting sync client presents its session token and the last
+        # seq it processed instead of a password. Returns the session, now
+        # carried by connection, or None once an error reply is queued.
+        session = self.sessions.get(auth_info.get('username'))
+        if session is not None and session.matches(auth_info.get('session')):
+            response = {'status': 'success', 'message': 'Session resumed', 'codec': session.codec.name}
+            connection.codec = session.codec
+            self.negotiate_compression(connection, auth_info, response)
+            resumed, previous = session.attach(connection, auth_info.get('seq'), encode_frame(response))
+            if resumed:
+                if previous is not None:
+                    # The old socket was still open, most likely half-dead.
+                    previous.close()
+                self.session_resumes.inc()
+                return session
+        connection.send_frame(encode_frame({'status': 'error', 'message': 'Session expired'}))
+        return None
+    
+    def session_started(self, username, delivery, action):
+        if action == 'resume':
+            # Everyone else still sees the user online; only this client
+            # needs the current list.
+            self.presence.join(username, delivery)
+        else:
+            self.user_online(username, delivery)
+    
+    def acknowledge_deliveries(self, delivery, message_obj):
+        seq = message_obj.get('seq')
+        if isinstance(delivery, Session) and type(seq) is int:
+            delivery.acknowledge(seq)
+    
+    def client_disconnected(self, username, connection):
+        delivery = self.local_connection(username)
+        if delivery is connection:
+            del self.clients[username]
+            self.update_last_seen(username)
+            self.user_offline(username)
+        elif isinstance(delivery, Session):
+            generation = delivery.detach(connection)
+            if generation is not None:
+                # Still online, and still collecting deliveries, until the
+                # window runs out without a resume.
+                self.schedule(self.resume_window, lambda: self.expire_session(delivery, generation))
+    
+    def expire_session(self, session, generation):
+        message_ids = session.end(generation)
+        if message_ids is None:
+            return
+        username = session.username
+        if self.sessions.get(username) is session:
+            del self.sessions[username]
+        # Before user_offline, which turns room spills into cursors.
+        self.spill_messages(message_ids)
+        if self.local_connection(username) is session:
+            del self.clients[username]
+            self.update_last_seen(username)
+            self.user_offline(username)
+    
+    def negotiate(self, connection, auth_info, response):
+        # The response itself still goes out as JSON; everything after it
+        # uses what was agreed here.
+        self.negotiate_codec(connection, auth_info, response)
+        self.negotiate_compression(connection, auth_info, response)
+    
+    def negotiate_codec(self, connection, auth_info, response):
+        codec = choose_codec(auth_info.get('codec'))
+        response['codec'] = codec.name
+        connection.codec = codec
+    
+    def negotiate_compression(self, connection, auth_info, response):
+        # The client lists what it can decode; frames to it are compressed
+        # from the next one on, once above the size threshold.
+        offered = auth_info.get('compression') or []
+        if self.compressor is not None and COMPRESSION_DEFLATE in offered:
+            response['compression'] = COMPRESSION_DEFLATE
+            connection.compressor = self.compressor
+    
+    def valid_credentials(self, action, username, password):
+        # A resume presents a session token in place of the password.
+        if not isinstance(username, str) or not username:
             return False
+        return action == 'resume' or isinstance(password, str)
+    
+    def read_credentials(self, connection, auth_info):
+        # Returns (action, username, password); all None once malformed
+        # credentials have been answered, which were never hashed or looked
+        # up and leave nothing to clean up after.
+        username = auth_info.get('username')
+        password = auth_info.get('password')
+        action = auth_info.get('action', 'login')
+        if not self.valid_credentials(action, username, password):
+            self.auth_failures.inc()
+            connection.send_frame(encode_frame({'status': 'error', 'message': 'Invalid username or password'}))
+            return None, None, None
+        return action, username, password
+    
+    def auth_result(self, connection, auth_info, action, username, success):
+        # Answers a register or login. On success the delivery is opened
+        # before the response is queued, and (delivery, spilled) is returned
+        # as from open_delivery; otherwise (None, None).
+        if not success:
+            message = 'Username already exists' if action == 'register' else 'Invalid credentials'
+            connection.send_frame(encode_frame({'status': 'error', 'message': message}))
+            return None, None
+        message = 'Registration successful' if action == 'register' else 'Login successful'
+        response = {'status': 'success', 'message': message}
+        self.negotiate(connection, auth_info, response)
+        delivery, spilled = self.open_delivery(connection, username, auth_info, response)
+        connection.send_frame(encode_frame(response))
+        return delivery, spilled
+    
+    def register_user(self, username, password):
+        with self.auth_latency.time():
+            # Taken names are rejected before paying for the KDF; the UNIQUE
+            # constraint still settles concurrent registrations.
+            if self.storage.get_password(username) is not None:
+                success = False
+            else:
+                password_hash = self.passwords.hash(password).result()
+                success = self.storage.register_user(username, password_hash)
+        return self.registered(username, password, success)
+    
+    def registered(self, username, password, success):
+        if success:
+            self.passwords.remember(username, password, True)
+        else:
+            self.auth_failures.inc()
+        return success
     
     def authenticate_user(self, username, password):
-        conn = sqlite3.connect('chat_app.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT password FROM users WHERE username = ?", (username,))
-        result = cursor.fetchone()
-        conn.close()
-        
-        if result and result[0] == password:
-            self.update_last_seen(username)
-            return True
-        return False
+        with self.auth_latency.time():
+            stored_password = self.storage.get_password(username)
+            verified = self.passwords.verify(username, password, stored_password).result()
+        return self.authenticated(username, password, stored_password, verified)
+    
+    def authenticated(self, username, password, stored_password, verified):
+        if not verified:
+            self.auth_failures.inc()
+            return False
+        self.update_last_seen(username)
+        if needs_rehash(stored_password):
+            # Plaintext row from before hashing: replace it now that we know
+            # the password, off the login path.
+            self.passwords.hash(password).add_done_callback(
+                lambda future: self.storage.set_password(username, future.result()))
+        return True
+    
+    def decode_message(self, connection, data):
+        with self.decode_latency.time():
+            return connection.codec.decode(data)
+    
+    def dispatch(self, connection, username, delivery, message_obj):
+        # Handles one frame from a signed-in client. Requests that read
+        # storage return their handler's result, which the asyncio engine
+        # awaits before reading the next frame.
+        message_type = message_obj.get('type')
+        if message_type == 'message':
+            self.handle_chat_message(connection, username, message_obj)
+        elif message_type == 'history':
+            return self.send_history_page(connection, username, message_obj)
+        elif message_type == 'search':
+            return self.send_search_results(connection, username, message_obj)
+        elif message_type in ROOM_REQUESTS:
+            self.handle_room_request(connection, username, message_obj)
+        elif message_type == 'sync_ack':
+            self.acknowledge_deliveries(delivery, message_obj)
+        elif message_type == 'ping':
+            connection.send_message(PONG)
+        return None
     
     def update_last_seen(self, username):
-        conn = sqlite3.connect('chat_app.db')
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET last_seen = ? WHERE username = ?",
-               (datetime.now().isoformat(), username))
-        conn.commit()
-        conn.close()
-    
-    def save_message(self, sender, receiver, content):
-        conn = sqlite3.connect('chat_app.db')
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO messages (sender, receiver, content) VALUES (?, ?, ?)",
-                      (sender, receiver, content))
-        conn.commit()
-        conn.close()
-    
-    def get_unread_messages(self, username):
-        conn = sqlite3.connect('chat_app.db')
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, sender, content, timestamp FROM messages 
-            WHERE receiver = ? AND is_read = 0
-            ORDER BY timestamp
-        """, (username,))
+        self.storage.update_last_seen(username)
+    
+    def save_message(self, sender, receiver, content, is_read=False):
+        # Returns a future that resolves with the row id once the message's
+        # group commit is durable.
+        return self.storage.save_message(sender, receiver, content, is_read)
+    
+    def handle_chat_message(self, connection, username, message_obj):
+        receiver = message_obj.get('receiver')
+        content = message_obj.get('content')
+        if not isinstance(receiver, str) or not isinstance(content, str):
+            connection.send_message(self.build_message_error(message_obj, 'Invalid message'))
+            return
+        receiver_connection = self.online_connection(receiver)
+        self.messages_received.inc()
+        queued_at = time.perf_counter()
+        future = self.save_message(username, receiver, content, is_read=receiver_connection is not None)
         
-        messages = []
-        for msg_id, sender, content, timestamp in cursor.fetchall():
-            messages.append({
-                'id': msg_id,
-                'sender': sender,
-                'content': content,
-                'timestamp': timestamp
-            })
-            cursor.execute("UPDATE messages SET is_read = 1 WHERE id = ?", (msg_id,))
+        # The reader moves on to the next frame straight away; the ack and
+        # the forward follow once the commit lands. Commits complete in
+        # submission order, so per-sender ordering is kept.
+        def on_saved(future):
+            try:
+                message_id = future.result()
+            except Exception as e:
+                print(f"Failed to save message from {username}: {e}")
+                return
+            self.save_latency.observe(time.perf_counter() - queued_at)
+            connection.send_message(self.build_ack(message_id, message_obj))
+            self.forward_message(receiver_connection, message_id, username, content)
+        future.add_done_callback(lambda future: self.call_soon(on_saved, future))
+    
+    def call_soon(self, callback, *args):
+        # Storage callbacks arrive on the writer thread. Acks, forwards and
+        # room fan-out are handed to the delivery thread so the next group
+        # commit doesn't wait on them; it is a single thread, so they still
+        # run in commit order.
+        self.delivery_executor.submit(self.run_callback, callback, *args)
+    
+    def run_callback(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception as e:
+            print(f"Error in storage callback: {e}")
+    
+    def get_unread_page(self, username, after_id=0):
+        return self.storage.get_unread_page(username, after_id)
+    
+    def send_unread_backlog(self, connection, username):
+        # Streams the backlog in keyset pages after 'Login successful'. Each
+        # page is marked read only after the writer handed it to the socket,
+        # so a dropped connection gets the remainder on its next login.
+        page = self.get_unread_page(username)
+        while page:
+            cursor = page[-1]['id']
+            next_page = self.get_unread_page(username, cursor)
+            connection.send_message(self.build_unread_page(page, cursor, bool(next_page)), self.page_ids(page))
+            if not connection.flush():
+                break
+            self.storage.mark_read(username, cursor)
+            page = next_page
+    
+    def get_history_page(self, username, message_obj):
+        # Returns the history_page frame, or a history_error frame for a
+        # malformed request. Only ever the requester's own conversation with
+        # 'with', so a client can't read anyone else's messages.
+        other = message_obj.get('with')
+        before = message_obj.get('before')
+        valid_before = before is None or type(before) is int and 0 <= before <= MAX_MESSAGE_ID
+        if not isinstance(other, str) or not valid_before:
+            return {'type': 'history_error', 'with': other, 'message': 'Invalid history request'}
+        messages, more = self.storage.get_history_page(username, other, before, HISTORY_PAGE_SIZE)
+        return self.build_history_page(other, messages, more)
+    
+    def send_history_page(self, connection, username, message_obj):
+        connection.send_message(self.get_history_page(username, message_obj))
+    
+    def search_messages(self, username, message_obj):
+        # Returns the search_results frame, or a search_error frame for a
+        # request with nothing searchable in it.
+        query = message_obj.get('query')
+        offset = message_obj.get('offset') or 0
+        result = None
+        valid = isinstance(query, str) and len(query) <= SEARCH_QUERY_MAX_LENGTH
+        if valid and type(offset) is int and offset >= 0:
+            with self.search_latency.time():
+                result = self.storage.search_messages(username, query, offset, SEARCH_PAGE_SIZE)
+        if result is None:
+            return {'type': 'search_error', 'query': query, 'message': 'Invalid search'}
+        messages, more = result
+        return self.build_search_results(query, messages, offset + len(messages) if more else None, more)
+    
+    def send_search_results(self, connection, username, message_obj):
+        connection.send_message(self.search_messages(username, message_obj))
+    
+    def send_room_backlog(self, connection, username):
+        # Same paging as the 1:1 backlog, one room at a time, advancing the
+        # member's room cursor as each page is flushed.
+        connection.send_message({'type': 'room_list', 'rooms': self.rooms.rooms_of(username)})
+        for room, after_id in self.storage.get_room_cursors(username).items():
+            self.rooms.backlog_pending(room, username, after_id + 1)
+            page = self.get_room_page(connection, username, room, after_id)
+            while page:
+                cursor = page[-1]['id']
+                next_page = self.get_room_page(connection, username, room, cursor)
+                connection.send_message(self.build_room_page(room, page, cursor, bool(next_page)),
+                                        (room, username, page[0]['id']))
+                if not connection.flush():
+                    return
+                self.storage.advance_room_cursor(room, username, cursor)
+                self.rooms.backlog_pending(room, username, cursor + 1)
+                page = next_page
+            self.rooms.backlog_pending(room, username, None)
+    
+    def get_room_page(self, connection, username, room, after_id):
+        up_to_id = self.rooms.backlog_limit(room, username, connection)
+        return self.storage.get_room_page(room, after_id, up_to_id)
+    
+    def build_room_page(self, room, page, cursor, more):
+        return {'type': 'room_unread_page', 'room': room, 'messages': page, 'cursor': cursor, 'more': more}
+    
+    def handle_room_request(self, connection, username, message_obj):
+        request = message_obj.get('type')
+        room = message_obj.get('room')
+        if not isinstance(room, str) or not room or len(room) > ROOM_NAME_MAX_LENGTH:
+            self.send_room_error(connection, room, 'Invalid room name')
+        elif request == 'room_message':
+            self.handle_room_message(connection, username, room, message_obj)
+        elif request == 'create_room':
+            self.create_room(connection, username, room)
+        elif request == 'join_room':
+            self.join_room(connection, username, room)
+        elif request == 'leave_room':
+            self.leave_room(connection, username, room)
+    
+    def after_commit(self, future, callback, description):
+        # Runs callback(result) through call_soon once the write is durable.
+        def on_done(future):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Failed to {description}: {e}")
+                return
+            callback(result)
+        future.add_done_callback(lambda future: self.call_soon(on_done, future))
+    
+    def create_room(self, connection, username, room):
+        if self.rooms.exists(room):
+            self.send_room_error(connection, room, 'Room already exists')
+            return
         
-        conn.commit()
-        conn.close()
-        return messages
+        def on_created(created):
+            if not created:
+                self.send_room_error(connection, room, 'Room already exists')
+                return
+            self.add_room_member(room, username)
+            connection.send_message(self.build_room_joined(room))
+        self.after_commit(self.storage.create_room(room, username), on_created, f"create room {room}")
     
-    def broadcast_active_users(self):
-        active_users = list(self.clients.keys())
+    def join_room(self, connection, username, room):
+        if not self.rooms.exists(room):
+            self.send_room_error(connection, room, 'No such room')
+            return
+        if self.rooms.is_member(room, username):
+            connection.send_message(self.build_room_joined(room))
+            return
         
-        for username, (client_socket, _) in self.clients.items():
-            try:
-                message = {
-                    'type': 'active_users',
-                    'users': active_users
-                }
-                client_socket.send(json.dumps(message).encode('utf-8'))
-            except:
-                pass
+        def on_joined(_):
+            self.add_room_member(room, username)
+            connection.send_message(self.build_room_joined(room))
+        self.after_commit(self.storage.join_room(room, username), on_joined, f"join room {room}")
+    
+    def leave_room(self, connection, username, room):
+        if self.rooms.is_member(room, username):
+            self.remove_room_member(room, username)
+            self.storage.leave_room(room, username)
+        connection.send_message({'type': 'room_left', 'room': room})
+    
+    def add_room_member(self, room, username):
+        self.rooms.add_member(room, username)
+    
+    def remove_room_member(self, room, username):
+        self.rooms.remove_member(room, username)
+    
+    def handle_room_message(self, connection, username, room, message_obj):
+        client_id = message_obj.get('client_id')
+        if not self.rooms.is_member(room, username):
+            self.send_room_error(connection, room, 'Not a member of this room', client_id)
+            return
+        content = message_obj.get('content')
+        if not isinstance(content, str):
+            self.send_room_error(connection, room, 'Invalid message', client_id)
+            return
+        self.messages_received.inc()
+        queued_at = time.perf_counter()
+        
+        def on_saved(message_id):
+            self.save_latency.observe(time.perf_counter() - queued_at)
+            connection.send_message(self.build_ack(message_id, message_obj))
+            message = self.build_room_message(room, message_id, username, content)
+            self.fan_out_room(room, message_id, username, message)
+        self.after_commit(self.storage.save_room_message(room, username, content), on_saved,
+                          f"save room message from {username}")
+    
+    def fan_out_room(self, room, message_id, sender, message):
+        # Every member gets the same dict, so it is encoded once per codec
+        # and members on the same codec share the same bytes.
+        with self.room_fanout.time(), self.rooms.lock:
+            self.rooms.advance_head(room, message_id)
+            self.deliver_room_message(room, message_id, sender, message)
+    
+    def deliver_room_message(self, room, message_id, sender, message):
+        for member in self.rooms.members_of(room):
+            if member == sender:
+                continue
+            connection = self.local_connection(member)
+            if connection is not None:
+                self.rooms.delivered_live(room, member, connection, message_id)
+                connection.send_message(message, (room, member, message_id))
+    
+    def build_room_message(self, room, message_id, sender, content):
+        return {
+            'type': 'room_message',
+            'id': message_id,
+            'room': room,
+            'sender': sender,
+            'content': content,
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+    
+    def build_room_joined(self, room):
+        return {'type': 'room_joined', 'room': room, 'members': list(self.rooms.members_of(room))}
+    
+    def send_room_error(self, connection, room, message, client_id=None):
+        # client_id is echoed for a rejected room_message, like an ack.
+        error = {'type': 'room_error', 'room': room, 'message': message}
+        if client_id is not None:
+            error['client_id'] = client_id
+        connection.send_message(error)
+    
+    def build_history_page(self, other, messages, more):
+        # cursor is the oldest id on the page; sent back as 'before' it
+        # fetches the page preceding this one.
+        cursor = messages[0]['id'] if messages else None
+        return {'type': 'history_page', 'with': other, 'messages': messages, 'cursor': cursor, 'more': more}
+    
+    def build_search_results(self, query, messages, cursor, more):
+        # cursor is the offset to send back for the next page.
+        return {'type': 'search_results', 'query': query, 'messages': messages, 'cursor': cursor, 'more': more}
+    
+    def build_unread_page(self, page, cursor, more):
+        return {'type': 'unread_page', 'messages': page, 'cursor': cursor, 'more': more}
+    
+    def page_ids(self, page):
+        return [message['id'] for message in page]
+    
+    def build_message_error(self, message_obj, message):
+        return {'type': 'message_error', 'client_id': message_obj.get('client_id'), 'message': message}
+    
+    def build_ack(self, message_id, message_obj):
+        # Sent to the sender once the message is durable; client_id lets a
+        # pipelining client match acks to what it sent.
+        return {'type': 'ack', 'id': message_id, 'client_id': message_obj.get('client_id')}
+    
+    def user_online(self, username, connection):
+        self.presence.join(username, connection)
+    
+    def user_offline(self, username):
+        self.presence.leave(username)
+        cursors = self.rooms.offline_cursors(username)
+        if cursors:
+            self.storage.set_room_cursors(username, cursors)
+    
+    def online_connection(self, username):
+        return self.local_connection(username)
+    
+    def local_connection(self, username):
+        entry = self.clients.get(username)
+        return entry[0] if entry else None
+    
+    def forward_message(self, receiver_connection, message_id, sender, content):
+        if receiver_connection is None:
+            return
+        with self.forward_latency.time():
+            forward_message = {
+                'type': 'message',
+                'id': message_id,
+                'sender': sender,
+                'content': content,
+                'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+            # Never blocks: the frame goes onto the receiver's own queue. If it
+            # can't be delivered, the queue hands message_id back via spill_messages.
+            receiver_connection.send_message(forward_message, message_id)
+    
+    def spill_messages(self, message_ids):
+        # Ints are 1:1 messages stored as read and lists the ids on an unread
+        # page; (room, member, id) tuples are room frames, which hold that
+        # member's room cursor back instead. Returns the future of putting
+        # the 1:1 messages back, or None.
+        self.spilled_messages.inc(len(message_ids))
+        direct = []
+        for message_id in message_ids:
+            if isinstance(message_id, tuple):
+                self.rooms.note_gap(*message_id)
+            elif isinstance(message_id, list):
+                direct.extend(message_id)
+            else:
+                direct.append(message_id)
+        if direct:
+            return self.storage.mark_unread(direct)
+        return None
+    
+    def queue_options(self):
+        return {'max_size': self.queue_size, 'overflow': self.overflow, 'on_spill': self.spill_messages}
+    
+    def queue_depths(self):
+        return {username: connection.depth for username, (connection, _) in list(self.clients.items())}
+    
+    def connected_clients(self):
+        return [connection for connection, _ in list(self.clients.values())]
+
+
+class AsyncChatServer(ChatServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # SQLite calls are still blocking, so they run on a small fixed pool
+        # instead of one thread per connection.
+        self.db_executor = ThreadPoolExecutor(max_workers=ASYNC_DB_WORKERS)
+        self.loop = None
+
+    def start(self):
+        self.server_socket.listen(LISTEN_BACKLOG)
+        self.server_socket.setblocking(False)
+        print(f"Server started on {self.host}:{self.port} (asyncio)")
+        self.start_metrics()
+
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Server shutting down...")
+        finally:
+            self.server_socket.close()
+            self.storage.close()
+            self.passwords.close()
+            self.db_executor.shutdown(wait=False)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.presence.schedule = self.loop.call_later
+        self.loop.create_task(self.drive_timers())
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server_socket)
+        async with server:
+            await server.serve_forever()
+
+    async def drive_timers(self):
+        # Timer callbacks run on the loop, like everything else here.
+        while True:
+            await asyncio.sleep(self.timers.next_tick())
+            self.timers.advance()
+
+    def call_soon(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    async def run_blocking(self, func, *args):
+        return await self.loop.run_in_executor(self.db_executor, func, *args)
+
+    async def register_user_async(self, username, password):
+        # The KDF runs on the hasher's pool; only the INSERT uses a DB worker.
+        with self.auth_latency.time():
+            if await self.run_blocking(self.storage.get_password, username) is not None:
+                success = False
+            else:
+                password_hash = await asyncio.wrap_future(self.passwords.hash(password))
+                success = await self.run_blocking(self.storage.register_user, username, password_hash)
+        return self.registered(username, password, success)
+
+    async def authenticate_user_async(self, username, password):
+        with self.auth_latency.time():
+            stored_password = await self.run_blocking(self.storage.get_password, username)
+            verified = await asyncio.wrap_future(self.passwords.verify(username, password, stored_password))
+        return self.authenticated(username, password, stored_password, verified)
+
+    async def send_unread_backlog_async(self, connection, username):
+        page = await self.run_blocking(self.get_unread_page, username)
+        while page:
+            cursor = page[-1]['id']
+            next_page = await self.run_blocking(self.get_unread_page, username, cursor)
+            connection.send_message(self.build_unread_page(page, cursor, bool(next_page)), self.page_ids(page))
+            # Wait for the queue to drain so a huge backlog never sits in
+            # memory all at once.
+            if not await connection.flush():
+                break
+            self.storage.mark_read(username, cursor)
+            page = next_page
+
+    async def send_room_backlog_async(self, connection, username):
+        connection.send_message({'type': 'room_list', 'rooms': self.rooms.rooms_of(username)})
+        cursors = await self.run_blocking(self.storage.get_room_cursors, username)
+        for room, after_id in cursors.items():
+            self.rooms.backlog_pending(room, username, after_id + 1)
+            page = await self.run_blocking(self.get_room_page, connection, username, room, after_id)
+            while page:
+                cursor = page[-1]['id']
+                next_page = await self.run_blocking(self.get_room_page, connection, username, room, cursor)
+                connection.send_message(self.build_room_page(room, page, cursor, bool(next_page)),
+                                        (room, username, page[0]['id']))
+                if not await connection.flush():
+                    return
+                self.storage.advance_room_cursor(room, username, cursor)
+                self.rooms.backlog_pending(room, username, cursor + 1)
+                page = next_page
+            self.rooms.backlog_pending(room, username, None)
+
+    async def send_history_page(self, connection, username, message_obj):
+        connection.send_message(await self.run_blocking(self.get_history_page, username, message_obj))
+
+    async def send_search_results(self, connection, username, message_obj):
+        connection.send_message(await self.run_blocking(self.search_messages, username, message_obj))
+
+    async def handle_client_async(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        connection = AsyncClientConnection(writer, **self.queue_options())
+        self.watch_connection(connection)
+        decoder = FrameDecoder()
+        username = None
+        delivery = None
+        try:
+            auth_data = await read_frame(reader, decoder)
+            if auth_data is None:
+                return
+            connection.last_received = time.monotonic()
+            auth_info = decode_payload(auth_data)
+            action, username, password = self.read_credentials(connection, auth_info)
+
+            if action in ('register', 'login'):
+                if action == 'register':
+                    success = await self.register_user_async(username, password)
+                else:
+                    success = await self.authenticate_user_async(username, password)
+                delivery, spilled = self.auth_result(connection, auth_info, action, username, success)
+                if delivery is not None:
+                    if spilled is not None:
+                        await asyncio.wrap_future(spilled)
+                    self.clients[username] = (delivery, address)
+                    if action == 'login':
+                        await self.send_unread_backlog_async(delivery, username)
+                        await self.send_room_backlog_async(delivery, username)
+
+            elif action == 'resume':
+                delivery = self.resume_session(connection, auth_info)
+
+            if delivery is not None and self.clients.get(username, (None,))[0] is delivery:
+                self.session_started(username, delivery, action)
+
+                while True:
+                    try:
+                        message_data = await read_frame(reader, decoder)
+                        if message_data is None:
+                            break
+                        connection.last_received = time.monotonic()
+
+                        message_obj = self.decode_message(connection, message_data)
+                        pending = self.dispatch(connection, username, delivery, message_obj)
+                        if pending is not None:
+                            await pending
+                    except (json.JSONDecodeError, CodecError):
+                        continue
+                    except (ConnectionResetError, BrokenPipeError, FrameError):
+                        break
+            else:
+                await connection.flush()
+
+        except Exception as e:
+            print(f"Error handling client {address}: {e}")
+        finally:
+            connection.close()
+            if username is not None:
+                self.client_disconnected(username, connection)
+
+
+SERVER_MODES = {
+    'threaded': ChatServer,
+    'asyncio': AsyncChatServer,
+}
+
+
+def open_storage(engine, db_path=DB_PATH, archive_dir=ARCHIVE_DIR, archive_after=None):
+    if engine == STORAGE_MEMORY:
+        return MemoryStorage()
+    return SQLiteStorage(db_path, archive_dir=archive_dir, archive_after=archive_after)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--mode', choices=sorted(SERVER_MODES), default='threaded',
+                        help="connection engine: one thread per client or a single asyncio event loop")
+    parser.add_argument('--queue-size', type=int, default=OUTBOUND_QUEUE_SIZE,
+                        help="maximum frames queued for one client before the overflow policy applies")
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default=OVERFLOW_SPILL,
+                        help="what to do when a client's outbound queue is full")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="run this many asyncio worker processes sharing the port (SO_REUSEPORT)")
+    parser.add_argument('--no-compression', dest='compression', action='store_false',
+                        help="never compress frames, even for clients that offer it")
+    parser.add_argument('--storage', choices=STORAGE_ENGINES, default=STORAGE_SQLITE,
+                        help="where users and messages are kept; memory loses everything on exit and is meant "
+                             "for benchmarks and tests")
+    parser.add_argument('--db', dest='db_path', default=DB_PATH, help="SQLite database file")
+    parser.add_argument('--archive-after', type=float,
+                        help="move read messages older than this many seconds into archive segment files")
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR, help="directory for archive segment files")
+    parser.add_argument('--rebuild-search-index', action='store_true',
+                        help="index every stored message for search, then exit (safe while a server is running)")
+    parser.add_argument('--resume-window', type=float, default=SESSION_RESUME_WINDOW,
+                        help="seconds a dropped sync client has to resume its session before going offline")
+    parser.add_argument('--ping-interval', type=float, default=PING_INTERVAL,
+                        help="seconds of silence from a client before it is pinged")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="seconds of silence after which a client is disconnected")
+    parser.add_argument('--metrics-host', default='127.0.0.1')
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve Prometheus metrics and profiler controls over HTTP on this port "
+                             "(worker N of a multi-worker server uses this port + N)")
+    args = parser.parse_args(argv)
+    if args.storage == STORAGE_MEMORY:
+        # Nothing to share between processes, archive or index.
+        if args.workers > 1:
+            parser.error("--workers needs the sqlite storage engine")
+        if args.archive_after is not None:
+            parser.error("--archive-after needs the sqlite storage engine")
+        if args.rebuild_search_index:
+            parser.error("--rebuild-search-index needs the sqlite storage engine")
+    return args
+
+
+def rebuild_search_index(db_path, archive_dir):
+    storage = SQLiteStorage(db_path, archive_dir=archive_dir)
+    started = time.perf_counter()
+    try:
+        indexed = storage.rebuild_search_index()
+    finally:
+        storage.close()
+    print(f"Indexed {indexed} messages in {time.perf_counter() - started:.1f}s")
 
 
 if __name__ == "__main__":
-    server = ChatServer()
-    server.start()
+    args = parse_args()
+    if args.rebuild_search_index:
+        rebuild_search_index(args.db_path, args.archive_dir)
+        raise SystemExit
+    options = {
+        'host': args.host,
+        'port': args.port,
+        'queue_size': args.queue_size,
+        'overflow': args.overflow,
+        'metrics_host': args.metrics_host,
+        'metrics_port': args.metrics_port,
+        'compression': args.compression,
+        'archive_dir': args.archive_dir,
+        'archive_after': args.archive_after,
+        'resume_window': args.resume_window,
+        'ping_interval': args.ping_interval,
+        'idle_timeout': args.idle_timeout,
+        'storage': args.storage,
+        'db_path': args.db_path
+    }
+    if args.workers > 1:
+        # workers.py imports this module, so it is only loaded when needed.
+        from workers import run_cluster
+        run_cluster(args.workers, **options)
+    else:
+        server = SERVER_MODES[args.mode](**options)
+        server.start()
@@ -0,0 +1,128 @@
+import collections
+import hmac
+import secrets
+import threading
+
+# A sync session whose connection drops stays resumable this long; only
+# then does the user go offline and what it held go back to storage.
+SESSION_RESUME_WINDOW = 30
+# Unacknowledged deliveries kept for replay, per session.
+REPLAY_BUFFER_SIZE = 1024
+SESSION_TOKEN_BYTES = 32
+
+
+class Session:
+    # The delivery stream of a client that negotiated sync. Every delivery
+    # (a frame sent with a message_id, the same ones a connection would spill)
+    # gets the next per-user seq and is kept until the client acknowledges
+    # it, so the stream outlives any one connection: after a drop the client
+    # resumes with the last seq it processed and is sent exactly what came
+    # after, including whatever went into a socket that was already dead.
+    #
+    # It stands in for the connection in ChatServer.clients, so while
+    # detached it keeps collecting deliveries for the resume to replay.
+    # Other frames (presence, acks, pages of requests) only go to a live
+    # connection.
+    def __init__(self, username, connection, on_spill, max_unacked=REPLAY_BUFFER_SIZE):
+        self.username = username
+        self.token = secrets.token_urlsafe(SESSION_TOKEN_BYTES)
+        # Fixed for the session's life: buffered frames are already encoded.
+        self.codec = connection.codec
+        self.on_spill = on_spill
+        self.max_unacked = max_unacked
+        self.lock = threading.RLock()
+        self.connection = connection  # None while detached
+        self.last_connection = connection
+        self.seq = 0
+        self.unacked = collections.deque()  # (seq, frame, message_id)
+        self.resumable_from = 0  # a resume has to have seen at least this seq
+        self.generation = 0
+        self.ended = False
+
+    @property
+    def depth(self):
+        return self.last_connection.depth
+
+    def matches(self, token):
+        return isinstance(token, str) and hmac.compare_digest(self.token.encode(), token.encode('utf-8'))
+
+    def send_message(self, message, message_id=None):
+        return self.send_frame(self.codec.encode_frame(message), message_id)
+
+    def send_frame(self, frame, message_id=None):
+        with self.lock:
+            connection = self.connection
+            if message_id is None:
+                return connection is not None and connection.send_frame(frame)
+            if self.ended:
+                self.on_spill([message_id])
+                return False
+            self.seq += 1
+            frame = self.codec.sequence(frame, self.seq)
+            self.unacked.append((self.seq, frame, message_id))
+            if len(self.unacked) > self.max_unacked:
+                self.evict()
+            if connection is None or connection.send_frame(frame) or connection.closed:
+                return True
+            # A full outbound queue dropped it: it is handed back like any
+            # other overflow, and left out of the replay.
+            self.unacked.pop()
+            self.on_spill([message_id])
+            return False
+
+    def evict(self):
+        # Makes room by dropping the oldest delivery. A live connection was
+        # already handed it; a detached session hands it back to storage.
+        # Either way a resume from before it is refused from now on, and the
+        # client falls back to a full login.
+        seq, _, message_id = self.unacked.popleft()
+        self.resumable_from = seq
+        if self.connection is None:
+            self.on_spill([message_id])
+
+    def acknowledge(self, seq):
+        with self.lock:
+            while self.unacked and self.unacked[0][0] <= seq:
+                self.unacked.popleft()
+
+    def flush(self):
+        return self.last_connection.flush()
+
+    def attach(self, connection, last_seq, response_frame):
+        # Moves the stream to connection: the response goes first, then
+        # every delivery after last_seq. Returns (resumed, previous
+        # connection to close).
+        with self.lock:
+            if self.ended or type(last_seq) is not int or not self.resumable_from <= last_seq <= self.seq:
+                return False, None
+            previous = self.connection
+            self.connection = self.last_connection = connection
+            self.generation += 1
+            connection.send_frame(response_frame)
+            self.acknowledge(last_seq)
+            for _, frame, _ in self.unacked:
+                connection.send_frame(frame)
+            return True, previous
+
+    def detach(self, connection):
+        # Returns the generation to hand to end() once the resume window
+        # is over, or None if connection no longer carries this session.
+        with self.lock:
+            if self.ended or self.connection is not connection:
+                return None
+            self.connection = None
+            self.generation += 1
+            return self.generation
+
+    def end(self, generation=None):
+        # Returns the message_ids of everything unacknowledged, for the
+        # caller to spill, or None if the session already ended or (with
+        # generation) was resumed since.
+        with self.lock:
+            if self.ended or generation is not None and (generation != self.generation or self.connection is not None):
+                return None
+            self.ended = True
+            self.connection = None
+            message_ids = [message_id for _, _, message_id in self.unacked]
+            self.unacked.clear()
+            return message_ids
@@ -0,0 +1,814 @@
+import collections
+import math
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future
+from datetime import datetime
+
+from archive import ARCHIVE_DIR, MessageArchive
+
+DB_PATH = 'chat_app.db'
+STORAGE_SQLITE = 'sqlite'
+STORAGE_MEMORY = 'memory'  # nothing persists; for benchmarks and tests
+STORAGE_ENGINES = (STORAGE_SQLITE, STORAGE_MEMORY)
+# Queued writes are grouped into one transaction for up to this long, or until
+# the batch reaches WRITE_BATCH_SIZE operations, whichever comes first.
+COMMIT_INTERVAL = 0.002
+WRITE_BATCH_SIZE = 512
+UNREAD_PAGE_SIZE = 200
+HISTORY_PAGE_SIZE = 50
+HISTORY_CACHE_SIZE = 1024
+MAX_MESSAGE_ID = 2 ** 63 - 1
+# Compaction wakes up this often and moves rows in batches of this size,
+# waiting for each batch's delete to commit before reading the next.
+ARCHIVE_INTERVAL = 600
+ARCHIVE_BATCH_SIZE = 500
+SEARCH_PAGE_SIZE = 20
+# A search ranks the newest SEARCH_MAX_RESULTS matches and pages through
+# them by offset.
+SEARCH_MAX_RESULTS = 200
+SEARCH_MAX_TERMS = 16
+SEARCH_REBUILD_BATCH_SIZE = 10000
+# BM25 parameters, the same as FTS5's built-in bm25().
+BM25_K1 = 1.2
+BM25_B = 0.75
+SEARCH_TOKEN = re.compile(r'[^\W_]+')
+
+
+def conversation_key(user, other):
+    return (user, other) if user <= other else (other, user)
+
+
+def party_token(username):
+    # A username as one FTS token: hex keeps any name intact through the
+    # tokenizer, and the prefix keeps it from matching a content word.
+    return 'u' + username.encode('utf-8').hex()
+
+
+def search_parties(sender, receiver):
+    return f"{party_token(sender)} {party_token(receiver)}"
+
+
+def search_terms(query):
+    # Returns (text, prefix) for each whitespace-separated term; a trailing
+    # * asks for a prefix match.
+    terms = []
+    for term in query.split()[:SEARCH_MAX_TERMS]:
+        text = term.rstrip('*')
+        if text:
+            terms.append((text, text != term))
+    return terms
+
+
+def search_expression(username, terms):
+    # Each term becomes a quoted FTS5 string, so user input can never reach
+    # the query syntax or lift the restriction to username's own
+    # conversations.
+    quoted = ['"' + text.replace('"', '""') + '"' + (' *' if prefix else '') for text, prefix in terms]
+    return f"content : ({' '.join(quoted)}) AND parties : {party_token(username)}"
+
+
+def search_tokens(text):
+    # Close to what the unicode61 tokenizer with remove_diacritics produces.
+    if not text.isascii():
+        text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    return SEARCH_TOKEN.findall(text.casefold())
+
+
+def rank_search_results(rows, terms):
+    # Orders (id, sender, receiver, content, timestamp) rows by BM25, best
+    # first and newest first among equals. FTS5's own bm25() would weigh
+    # each term against the whole index, which means reading every row
+    # that contains a common word on every query; here the statistics come
+    # from the candidate rows instead, which is what the requester sees.
+    query = [(token, prefix) for text, prefix in terms for token in search_tokens(text)]
+    if not rows or not query:
+        return rows
+    documents = [collections.Counter(search_tokens(row[3])) for row in rows]
+    lengths = [sum(document.values()) for document in documents]
+    average_length = sum(lengths) / len(lengths) or 1
+    frequencies = []
+    for token, prefix in query:
+        if prefix:
+            frequencies.append([sum(count for word, count in document.items() if word.startswith(token))
+                                for document in documents])
+        else:
+            frequencies.append([document[token] for document in documents])
+    weights = []
+    for counts in frequencies:
+        containing = sum(1 for count in counts if count)
+        weights.append(math.log((len(rows) - containing + 0.5) / (containing + 0.5) + 1))
+    scores = []
+    for index, length in enumerate(lengths):
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+        score = 0
+        for weight, counts in zip(weights, frequencies):
+            count = counts[index]
+            score += weight * count * (BM25_K1 + 1) / (count + norm)
+        scores.append((-score, -rows[index][0]))
+    order = sorted(range(len(rows)), key=scores.__getitem__)
+    return [rows[index] for index in order]
+
+
+class HistoryCache:
+    # Bounded LRU of history pages keyed by (conversation, before_id, limit).
+    # Each conversation has a generation number that save_message bumps; a
+    # reader only stores its page if the generation it started from is still
+    # current, so a page read just before a commit can't be cached stale.
+    def __init__(self, max_pages=HISTORY_CACHE_SIZE):
+        self.max_pages = max_pages
+        self.lock = threading.Lock()
+        self.pages = collections.OrderedDict()
+        self.keys_by_conversation = collections.defaultdict(set)
+        self.generations = collections.Counter()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page is None:
+                self.misses += 1
+                return None
+            self.pages.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def generation(self, conversation):
+        with self.lock:
+            return self.generations[conversation]
+
+    def put(self, key, page, generation):
+        conversation = key[0]
+        with self.lock:
+            if self.generations[conversation] != generation:
+                return
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            self.keys_by_conversation[conversation].add(key)
+            while len(self.pages) > self.max_pages:
+                old_key, _ = self.pages.popitem(last=False)
+                self.forget_key(old_key)
+
+    def invalidate(self, conversation):
+        with self.lock:
+            self.generations[conversation] += 1
+            for key in self.keys_by_conversation.pop(conversation, ()):
+                self.pages.pop(key, None)
+
+    def forget_key(self, key):
+        keys = self.keys_by_conversation.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_conversation[key[0]]
+
+
+class StorageBackend:
+    # Everything the server keeps across connections: users, 1:1 messages
+    # and their read state, rooms and their cursors. Reads return their
+    # result and may be called from any thread. Writes return a
+    # concurrent.futures.Future that resolves (to the new id, a flag or a
+    # row count) once the write is committed; callbacks on it may run on
+    # any thread, or inline if it already has.
+    def setup_metrics(self, metrics):
+        pass
+
+    def close(self):
+        pass
+
+    def register_user(self, username, password):
+        # Returns False if the name is taken.
+        raise NotImplementedError
+
+    def get_password(self, username):
+        raise NotImplementedError
+
+    def set_password(self, username, password):
+        raise NotImplementedError
+
+    def update_last_seen(self, username):
+        raise NotImplementedError
+
+    def save_message(self, sender, receiver, content, is_read=False):
+        raise NotImplementedError
+
+    def get_unread_page(self, username, after_id=0, limit=UNREAD_PAGE_SIZE):
+        raise NotImplementedError
+
+    def get_history_page(self, user, other, before_id=None, limit=HISTORY_PAGE_SIZE):
+        raise NotImplementedError
+
+    def search_messages(self, username, query, offset=0, limit=SEARCH_PAGE_SIZE):
+        raise NotImplementedError
+
+    def mark_read(self, username, up_to_id):
+        raise NotImplementedError
+
+    def mark_unread(self, message_ids):
+        raise NotImplementedError
+
+    def create_room(self, room, creator):
+        raise NotImplementedError
+
+    def join_room(self, room, username):
+        raise NotImplementedError
+
+    def leave_room(self, room, username):
+        raise NotImplementedError
+
+    def load_rooms(self):
+        # Returns ({room: [members]}, {room: newest message id}).
+        raise NotImplementedError
+
+    def save_room_message(self, room, sender, content):
+        raise NotImplementedError
+
+    def get_room_cursors(self, username):
+        raise NotImplementedError
+
+    def get_room_page(self, room, after_id, up_to_id, limit=UNREAD_PAGE_SIZE):
+        raise NotImplementedError
+
+    def advance_room_cursor(self, room, username, up_to_id):
+        raise NotImplementedError
+
+    def set_room_cursors(self, username, cursors):
+        raise NotImplementedError
+
+
+class SQLiteStorage(StorageBackend):
+    def __init__(self, db_path=DB_PATH, commit_interval=COMMIT_INTERVAL, batch_size=WRITE_BATCH_SIZE,
+                 archive_dir=ARCHIVE_DIR, archive_after=None, archive_interval=ARCHIVE_INTERVAL):
+        self.db_path = db_path
+        self.commit_interval = commit_interval
+        self.batch_size = batch_size
+        self.local = threading.local()
+        self.write_queue = queue.Queue()
+        self.history_cache = HistoryCache()
+        self.last_batch_size = 0
+        self.commits = 0
+        self.committed_operations = 0
+        # Always opened so earlier archives stay readable; only compacted
+        # into when archive_after (seconds) is set.
+        self.archive = MessageArchive(archive_dir)
+        self.archive_after = archive_after
+        self.archive_interval = archive_interval
+        self.archived_messages = 0
+        self.stopping = threading.Event()
+
+        self.writer_conn = self.connect()
+        self.writer_conn.execute("PRAGMA journal_mode=WAL")
+        self.setup_database()
+
+        self.writer_thread = threading.Thread(target=self.writer_loop, name='sqlite-writer')
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+        if archive_after is not None:
+            self.archive_thread = threading.Thread(target=self.archive_loop, name='message-archiver')
+            self.archive_thread.daemon = True
+            self.archive_thread.start()
+
+    def setup_metrics(self, metrics):
+        metrics.gauge('chat_db_write_queue_depth', 'Operations waiting for the SQLite writer',
+                      lambda: self.write_queue.qsize())
+        metrics.gauge('chat_db_last_batch_size', 'Operations in the most recent group commit',
+                      lambda: self.last_batch_size)
+        metrics.counter_func('chat_db_commits_total', 'Group commits performed', lambda: self.commits)
+        metrics.counter_func('chat_db_committed_operations_total', 'Operations committed across all batches',
+                             lambda: self.committed_operations)
+        metrics.counter_func('chat_history_cache_hits_total', 'History pages served from the LRU cache',
+                             lambda: self.history_cache.hits)
+        metrics.counter_func('chat_history_cache_misses_total', 'History pages read from SQLite',
+                             lambda: self.history_cache.misses)
+        metrics.counter_func('chat_archived_messages_total', 'Messages moved from SQLite into archive segments',
+                             lambda: self.archived_messages)
+        metrics.counter_func('chat_archive_reads_total', 'History pages that continued into the archive',
+                             lambda: self.archive.reads)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+        conn.create_function('search_parties', 2, search_parties, deterministic=True)
+        # FULL keeps each group commit durable across power loss; the cost is
+        # one fsync per batch rather than one per message.
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def reader(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.connect()
+            self.local.conn = conn
+        return conn
+
+    def setup_database(self):
+        cursor = self.writer_conn.cursor()
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            last_seen TEXT
+        )
+        ''')
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT NOT NULL,
+            receiver TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+            is_read BOOLEAN DEFAULT 0
+        )
+        ''')
+
+        # Partial index: only unread rows are indexed, so it stays small and
+        # a receiver's backlog is a single range scan ordered by id.
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_unread
+        ON messages (receiver, id) WHERE is_read = 0
+        ''')
+
+        # One direction of a conversation is a single range on this index, so
+        # a history page is two bounded backward scans, never an OFFSET.
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation
+        ON messages (sender, receiver, id)
+        ''')
+
+        # Full-text index of 1:1 messages. The rowid is MAX_MESSAGE_ID minus
+        # the message id, so walking an index list forwards, which FTS5 does
+        # far faster than backwards, yields the newest messages first. It
+        # keeps its own copy of each message so results need no second lookup and
+        # still cover messages that were moved to the archive. `parties`
+        # holds a token per participant, which is how a search is limited
+        # to the requester's own conversations. The prefix indexes keep short
+        # prefix queries from merging the lists of every matching word.
+        cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(
+            content, parties, sender UNINDEXED, receiver UNINDEXED, timestamp UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4'
+        )
+        ''')
+
+        # Conversations (as conversation_key pairs) with an archive segment,
+        # so a history read only continues into the archive where there is
+        # one. Kept here rather than found by looking for the file, which
+        # would cost every short conversation a stat.
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_conversations (
+            user TEXT NOT NULL,
+            other TEXT NOT NULL,
+            PRIMARY KEY (user, other)
+        ) WITHOUT ROWID
+        ''')
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rooms (
+            name TEXT PRIMARY KEY,
+            created_by TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+        # One row per membership; last_read_id replaces a per-member copy of
+        # every room message.
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS room_members (
+            room TEXT NOT NULL,
+            username TEXT NOT NULL,
+            last_read_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (room, username)
+        ) WITHOUT ROWID
+        ''')
+
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_room_members_user
+        ON room_members (username)
+        ''')
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS room_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_room_messages_room
+        ON room_messages (room, id)
+        ''')
+
+    def submit(self, operation):
+        # operation(cursor) runs on the writer thread; the returned future
+        # resolves with its result once the enclosing transaction is committed.
+        future = Future()
+        self.write_queue.put((operation, future))
+        return future
+
+    def writer_loop(self):
+        running = True
+        while running:
+            item = self.write_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        item = self.write_queue.get(timeout=timeout)
+                    else:
+                        item = self.write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            try:
+                self.commit_batch(batch)
+            except Exception as e:
+                # Never let the writer die: every later write would hang.
+                print(f"SQLite writer error: {e}")
+        self.writer_conn.close()
+
+    def commit_batch(self, batch):
+        cursor = self.writer_conn.cursor()
+        results = []
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for operation, future in batch:
+                # Each operation runs in its own savepoint, so one that fails
+                # partway (whatever it raised) leaves none of its writes
+                # behind and doesn't abort the rest of the batch.
+                cursor.execute("SAVEPOINT op")
+                try:
+                    results.append((future, operation(cursor), None))
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO op")
+                    results.append((future, None, e))
+                cursor.execute("RELEASE op")
+            cursor.execute("COMMIT")
+        except Exception as e:
+            if self.writer_conn.in_transaction:
+                self.writer_conn.rollback()
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.last_batch_size = len(batch)
+        self.commits += 1
+        self.committed_operations += len(batch)
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        self.stopping.set()
+        self.write_queue.put(None)
+        self.writer_thread.join()
+
+    def register_user(self, username, password):
+        def insert_user(cursor):
+            cursor.execute("INSERT INTO users (username, password, last_seen) VALUES (?, ?, ?)",
+                (username, password, datetime.now().isoformat()))
+        try:
+            self.submit(insert_user).result()
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def get_password(self, username):
+        cursor = self.reader().cursor()
+        cursor.execute("SELECT password FROM users WHERE username = ?", (username,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+    def set_password(self, username, password):
+        def update(cursor):
+            cursor.execute("UPDATE users SET password = ? WHERE username = ?", (password, username))
+        return self.submit(update)
+
+    def update_last_seen(self, username):
+        def update(cursor):
+            cursor.execute("UPDATE users SET last_seen = ? WHERE username = ?",
+                (datetime.now().isoformat(), username))
+        return self.submit(update)
+
+    def save_message(self, sender, receiver, content, is_read=False):
+        # is_read is set when the message is handed straight to an online
+        # receiver; mark_unread undoes it if that delivery never happens.
+        def insert_message(cursor):
+            cursor.execute("INSERT INTO messages (sender, receiver, content, is_read) VALUES (?, ?, ?, ?)",
+                (sender, receiver, content, int(is_read)))
+            message_id = cursor.lastrowid
+            # Same transaction, so a saved message is always searchable.
+            # Built from the stored row, which holds text whatever was passed.
+            cursor.execute("""
+                INSERT INTO message_search (rowid, content, parties, sender, receiver, timestamp)
+                SELECT ? - id, content, search_parties(sender, receiver), sender, receiver, timestamp
+                FROM messages WHERE id = ?
+            """, (MAX_MESSAGE_ID, message_id))
+            return message_id
+        def invalidate(future):
+            # A failed insert changed nothing (and may not have a valid key).
+            if future.exception() is None:
+                self.history_cache.invalidate(conversation_key(sender, receiver))
+        future = self.submit(insert_message)
+        # Registered before the caller sees the future, so the cache is
+        # invalidated before anyone is told the message was saved.
+        future.add_done_callback(invalidate)
+        return future
+
+    def get_unread_page(self, username, after_id=0, limit=UNREAD_PAGE_SIZE):
+        cursor = self.reader().cursor()
+        cursor.execute("""
+            SELECT id, sender, content, timestamp FROM messages
+            WHERE receiver = ? AND is_read = 0 AND id > ?
+            ORDER BY id
+            LIMIT ?
+        """, (username, after_id, limit))
+
+        return [
+            {'id': msg_id, 'sender': sender, 'content': content, 'timestamp': timestamp}
+            for msg_id, sender, content, timestamp in cursor.fetchall()
+        ]
+
+    def get_history_page(self, user, other, before_id=None, limit=HISTORY_PAGE_SIZE):
+        # Returns (messages, more): up to `limit` messages between the two
+        # users older than before_id (the latest ones when None), oldest
+        # first. One extra row is read to tell whether an older page exists.
+        conversation = conversation_key(user, other)
+        key = (conversation, before_id, limit)
+        page = self.history_cache.get(key)
+        if page is not None:
+            return page
+
+        generation = self.history_cache.generation(conversation)
+        upper = before_id if before_id is not None else MAX_MESSAGE_ID
+        cursor = self.reader().cursor()
+        cursor.execute("""
+            SELECT id, sender, receiver, content, timestamp FROM (
+                SELECT * FROM (
+                    SELECT id, sender, receiver, content, timestamp FROM messages
+                    WHERE sender = ? AND receiver = ? AND id < ?
+                    ORDER BY id DESC LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT id, sender, receiver, content, timestamp FROM messages
+                    WHERE sender = ? AND receiver = ? AND id < ? AND sender != receiver
+                    ORDER BY id DESC LIMIT ?
+                )
+            )
+            ORDER BY id DESC LIMIT ?
+        """, (user, other, upper, limit + 1, other, user, upper, limit + 1, limit + 1))
+
+        rows = cursor.fetchall()
+        if len(rows) <= limit and self.has_archive(conversation):
+            # The live table ran out: older messages, if any, were archived.
+            # Everything archived is older than what is still live.
+            oldest = rows[-1][0] if rows else upper
+            rows.extend(self.archive.read_before(conversation, oldest, limit + 1 - len(rows)))
+        messages = [
+            {'id': msg_id, 'sender': sender, 'receiver': receiver, 'content': content, 'timestamp': timestamp}
+            for msg_id, sender, receiver, content, timestamp in rows[:limit]
+        ]
+        messages.reverse()
+        page = (messages, len(rows) > limit)
+        self.history_cache.put(key, page, generation)
+        return page
+
+    def has_archive(self, conversation):
+        cursor = self.reader().cursor()
+        cursor.execute("SELECT 1 FROM archived_conversations WHERE user = ? AND other = ?", conversation)
+        return cursor.fetchone() is not None
+
+    def search_messages(self, username, query, offset=0, limit=SEARCH_PAGE_SIZE):
+        # Returns (messages, more): one page of username's messages matching
+        # query, best first. Returns None if query has no terms.
+        terms = search_terms(query)
+        if not terms:
+            return None
+        limit = max(0, min(limit, SEARCH_MAX_RESULTS - offset))
+        if limit == 0:
+            return [], False
+        cursor = self.reader().cursor()
+        cursor.execute("""
+            SELECT ? - rowid, sender, receiver, content, timestamp FROM message_search
+            WHERE message_search MATCH ?
+            ORDER BY rowid
+            LIMIT ?
+        """, (MAX_MESSAGE_ID, search_expression(username, terms), SEARCH_MAX_RESULTS))
+        rows = rank_search_results(cursor.fetchall(), terms)[offset:offset + limit + 1]
+        messages = [
+            {'id': msg_id, 'sender': sender, 'receiver': receiver, 'content': content, 'timestamp': timestamp}
+            for msg_id, sender, receiver, content, timestamp in rows[:limit]
+        ]
+        return messages, len(rows) > limit
+
+    def rebuild_search_index(self, batch_size=SEARCH_REBUILD_BATCH_SIZE):
+        # (Re)indexes every message still in the live table, a batch per
+        # write so it can run next to live traffic, then merges the index
+        # into one segment. Archived messages keep their existing entries.
+        # Returns the number of messages indexed.
+        def index_batch(after_id):
+            def operation(cursor):
+                cursor.execute("""
+                    SELECT MAX(id), COUNT(*) FROM (SELECT id FROM messages WHERE id > ? ORDER BY id LIMIT ?)
+                """, (after_id, batch_size))
+                last_id, count = cursor.fetchone()
+                if count:
+                    cursor.execute("""
+                        INSERT OR REPLACE INTO message_search (rowid, content, parties, sender, receiver, timestamp)
+                        SELECT ? - id, content, search_parties(sender, receiver), sender, receiver, timestamp
+                        FROM messages WHERE id > ? AND id <= ?
+                    """, (MAX_MESSAGE_ID, after_id, last_id))
+                return last_id, count
+            return operation
+
+        def optimize(cursor):
+            cursor.execute("INSERT INTO message_search (message_search) VALUES ('optimize')")
+
+        after_id = 0
+        indexed = 0
+        while True:
+            last_id, count = self.submit(index_batch(after_id)).result()
+            indexed += count
+            if count < batch_size:
+                break
+            after_id = last_id
+        self.submit(optimize).result()
+        return indexed
+
+    def create_room(self, room, creator):
+        # Resolves to False if the name is taken.
+        def insert_room(cursor):
+            try:
+                cursor.execute("INSERT INTO rooms (name, created_by) VALUES (?, ?)", (room, creator))
+            except sqlite3.IntegrityError:
+                return False
+            cursor.execute("INSERT INTO room_members (room, username) VALUES (?, ?)", (room, creator))
+            return True
+        return self.submit(insert_room)
+
+    def join_room(self, room, username):
+        # New members start at the room's current head rather than its
+        # whole history.
+        def insert_member(cursor):
+            cursor.execute("""
+                INSERT OR IGNORE INTO room_members (room, username, last_read_id)
+                SELECT ?, ?, COALESCE((SELECT MAX(id) FROM room_messages WHERE room = ?), 0)
+            """, (room, username, room))
+        return self.submit(insert_member)
+
+    def leave_room(self, room, username):
+        def delete_member(cursor):
+            cursor.execute("DELETE FROM room_members WHERE room = ? AND username = ?", (room, username))
+        return self.submit(delete_member)
+
+    def load_rooms(self):
+        cursor = self.reader().cursor()
+        memberships = {}
+        cursor.execute("SELECT name FROM rooms")
+        for (room,) in cursor.fetchall():
+            memberships[room] = []
+        cursor.execute("SELECT room, username FROM room_members")
+        for room, username in cursor.fetchall():
+            memberships.setdefault(room, []).append(username)
+        cursor.execute("SELECT room, MAX(id) FROM room_messages GROUP BY room")
+        heads = dict(cursor.fetchall())
+        return memberships, heads
+
+    def save_room_message(self, room, sender, content):
+        def insert_message(cursor):
+            cursor.execute("INSERT INTO room_messages (room, sender, content) VALUES (?, ?, ?)",
+                (room, sender, content))
+            return cursor.lastrowid
+        return self.submit(insert_message)
+
+    def get_room_cursors(self, username):
+        cursor = self.reader().cursor()
+        cursor.execute("SELECT room, last_read_id FROM room_members WHERE username = ?", (username,))
+        return dict(cursor.fetchall())
+
+    def get_room_page(self, room, after_id, up_to_id, limit=UNREAD_PAGE_SIZE):
+        cursor = self.reader().cursor()
+        cursor.execute("""
+            SELECT id, sender, content, timestamp FROM room_messages
+            WHERE room = ? AND id > ? AND id <= ?
+            ORDER BY id
+            LIMIT ?
+        """, (room, after_id, up_to_id, limit))
+
+        return [
+            {'id': msg_id, 'sender': sender, 'content': content, 'timestamp': timestamp}
+            for msg_id, sender, content, timestamp in cursor.fetchall()
+        ]
+
+    def advance_room_cursor(self, room, username, up_to_id):
+        def update(cursor):
+            cursor.execute("""
+                UPDATE room_members SET last_read_id = MAX(last_read_id, ?)
+                WHERE room = ? AND username = ?
+            """, (up_to_id, room, username))
+        return self.submit(update)
+
+    def set_room_cursors(self, username, cursors):
+        def update(cursor):
+            cursor.executemany("UPDATE room_members SET last_read_id = ? WHERE room = ? AND username = ?",
+                [(last_read_id, room, username) for room, last_read_id in cursors.items()])
+        return self.submit(update)
+
+    def mark_read(self, username, up_to_id):
+        def update(cursor):
+            cursor.execute("""
+                UPDATE messages SET is_read = 1
+                WHERE receiver = ? AND is_read = 0 AND id <= ?
+            """, (username, up_to_id))
+            return cursor.rowcount
+        return self.submit(update)
+
+    def mark_unread(self, message_ids):
+        def update(cursor):
+            cursor.executemany("UPDATE messages SET is_read = 0 WHERE id = ?",
+                [(message_id,) for message_id in message_ids])
+        return self.submit(update)
+
+    def delete_messages(self, message_ids, archived_conversations=()):
+        # archived_conversations are marked as having a segment in the same
+        # transaction, so no history read can miss the moved rows.
+        def delete(cursor):
+            cursor.executemany("INSERT OR IGNORE INTO archived_conversations (user, other) VALUES (?, ?)",
+                list(archived_conversations))
+            cursor.executemany("DELETE FROM messages WHERE id = ?", [(message_id,) for message_id in message_ids])
+        return self.submit(delete)
+
+    def archive_loop(self):
+        while not self.stopping.wait(self.archive_interval):
+            try:
+                self.compact(self.archive_after)
+            except Exception as e:
+                print(f"Message archiving failed: {e}")
+
+    def compact(self, max_age, batch_size=ARCHIVE_BATCH_SIZE):
+        # Moves read messages older than max_age seconds into the archive,
+        # oldest first. Per conversation only a prefix moves: the first
+        # unread message holds back everything after it, so archived ids are
+        # always older than live ones and a history page can simply continue
+        # from the live table into the archive. Rows are written to their
+        # segments (durably) before the writer deletes them, so a crash in
+        # between leaves duplicates, never gaps; the next run skips the
+        # archived copies and finishes the delete. Returns the rows moved.
+        cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - max_age))
+        held_back = set()
+        after_id = 0
+        moved = 0
+        cursor = self.reader().cursor()
+        while not self.stopping.is_set():
+            cursor.execute("""
+                SELECT id, sender, receiver, content, timestamp, is_read FROM messages
+                WHERE id > ? ORDER BY id LIMIT ?
+            """, (after_id, batch_size))
+            rows = cursor.fetchall()
+            conversations = collections.defaultdict(list)
+            done = False
+            for msg_id, sender, receiver, content, timestamp, is_read in rows:
+                if timestamp is not None and timestamp >= cutoff:
+                    done = True
+                    break
+                after_id = msg_id
+                conversation = conversation_key(sender, receiver)
+                if conversation in held_back:
+                    continue
+                if not is_read or timestamp is None:
+                    held_back.add(conversation)
+                    continue
+                conversations[conversation].append((msg_id, sender, receiver, content, timestamp))
+
+            message_ids = []
+            for conversation, messages in conversations.items():
+                self.archive.append(conversation, messages)
+                message_ids.extend(msg_id for msg_id, _, _, _, _ in messages)
+            if message_ids:
+                self.delete_messages(message_ids, conversations).result()
+                moved += len(message_ids)
+                self.archived_messages += len(message_ids)
+            if done or len(rows) < batch_size:
+                break
+        return moved
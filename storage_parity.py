@@ -0,0 +1,136 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+from memory_storage import MemoryStorage
+from storage import SQLiteStorage
+
+USERS = ['alice', 'bob', 'carol', 'dave']
+ROOMS = ['general', 'random']
+# Diacritics, punctuation and near-duplicates exercise the search tokenizer.
+WORDS = ['hello', 'help', 'world', 'café', 'cafe', 'x-y', 'day', 'night']
+QUERIES = ['hel*', 'hello', 'cafe', 'x-y', '!!', 'da*', 'world', '"quoted"']
+# Values a client could get past a missing check: both engines have to
+# refuse or coerce them the same way.
+ODD_CONTENT = [None, 5, 1.5, True, 2 ** 70, ['list']]
+
+
+class Mismatch(Exception):
+    pass
+
+
+def outcome(value):
+    # A comparable form of a call's result: futures are resolved, failures
+    # reduced to "failed", and timestamps (set by each engine's clock) dropped.
+    if hasattr(value, 'result'):
+        if value.exception() is not None:
+            return 'failed'
+        value = value.result()
+    return strip_timestamps(value)
+
+
+def strip_timestamps(value):
+    if isinstance(value, dict):
+        return {key: strip_timestamps(item) for key, item in value.items() if key != 'timestamp'}
+    if isinstance(value, (list, tuple)):
+        return type(value)(strip_timestamps(item) for item in value)
+    return value
+
+
+def compare(engines, name, *args):
+    results = [outcome(getattr(engine, name)(*args)) for engine in engines]
+    if results[0] != results[1]:
+        raise Mismatch(f"{name}{args}:\n  sqlite: {results[0]}\n  memory: {results[1]}")
+
+
+def compare_rooms(engines):
+    results = []
+    for engine in engines:
+        memberships, heads = engine.load_rooms()
+        results.append(({room: sorted(members) for room, members in memberships.items()}, heads))
+    if results[0] != results[1]:
+        raise Mismatch(f"load_rooms():\n  sqlite: {results[0]}\n  memory: {results[1]}")
+
+
+def random_operation(rng):
+    # Returns (method name, args), weighted roughly like live traffic.
+    user, other = rng.choice(USERS), rng.choice(USERS)
+    room = rng.choice(ROOMS)
+    pick = rng.random()
+    if pick < 0.33:
+        content = ' '.join(rng.choices(WORDS, k=rng.randint(1, 5)))
+        return 'save_message', (user, other, content, rng.random() < 0.3)
+    if pick < 0.35:
+        return 'save_message', (user, rng.choice([other, None]), rng.choice(ODD_CONTENT))
+    if pick < 0.45:
+        return 'get_unread_page', (user, rng.randint(0, 50), rng.randint(1, 5))
+    if pick < 0.50:
+        return 'mark_read', (user, rng.randint(0, 400))
+    if pick < 0.55:
+        return 'mark_unread', (rng.sample(range(1, 400), 3),)
+    if pick < 0.65:
+        return 'get_history_page', (user, other, rng.choice([None, rng.randint(1, 400)]), rng.randint(0, 6))
+    if pick < 0.72:
+        query = ' '.join(rng.choices(QUERIES, k=rng.randint(1, 2)))
+        return 'search_messages', (user, query, rng.randint(0, 5), rng.randint(1, 5))
+    if pick < 0.74:
+        return 'create_room', (room, user)
+    if pick < 0.79:
+        return 'join_room', (room, user)
+    if pick < 0.81:
+        return 'leave_room', (room, user)
+    if pick < 0.87:
+        return 'save_room_message', (room, user, rng.choice(WORDS))
+    if pick < 0.89:
+        return 'advance_room_cursor', (room, user, rng.randint(0, 100))
+    if pick < 0.91:
+        return 'set_room_cursors', (user, {room: rng.randint(0, 100)})
+    if pick < 0.94:
+        return 'get_room_cursors', (user,)
+    if pick < 0.98:
+        return 'get_room_page', (room, rng.randint(0, 50), rng.randint(0, 100), rng.randint(1, 5))
+    return 'load_rooms', ()
+
+
+def run(engines, rng, operations):
+    for user in USERS:
+        compare(engines, 'register_user', user, 'password')
+    compare(engines, 'register_user', USERS[0], 'other password')
+    compare(engines, 'get_password', USERS[0])
+    # Rooms exist before anyone joins, as the server ensures.
+    for room, creator in zip(ROOMS, USERS):
+        compare(engines, 'create_room', room, creator)
+    for _ in range(operations):
+        name, args = random_operation(rng)
+        if name == 'load_rooms':
+            compare_rooms(engines)
+        else:
+            compare(engines, name, *args)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the same random operations against the SQLite and in-memory storage engines "
+                    "and check they return the same results")
+    parser.add_argument('--operations', type=int, default=3000, help="operations per seed")
+    parser.add_argument('--seeds', type=int, default=8, help="independent runs, each on fresh stores")
+    parser.add_argument('--seed', type=int, default=0, help="first seed")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        for seed in range(args.seed, args.seed + args.seeds):
+            db_path = os.path.join(directory, f'parity-{seed}.db')
+            sqlite = SQLiteStorage(db_path, archive_dir=os.path.join(directory, f'archive-{seed}'))
+            try:
+                run((sqlite, MemoryStorage()), random.Random(seed), args.operations)
+            except Mismatch as e:
+                print(f"Seed {seed}: mismatch after {e}")
+                sys.exit(1)
+            finally:
+                sqlite.close()
+            print(f"Seed {seed}: {args.operations} operations matched")
@@ -0,0 +1,38 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import SERVER_MODES
+from storage import STORAGE_MEMORY
+
+
+def wait_for_listener(port, timeout=5):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+@pytest.fixture(scope='module', params=sorted(SERVER_MODES))
+def server(request, tmp_path_factory):
+    # One server per engine for the module, on MemoryStorage and a free
+    # port. It runs on a daemon thread and goes away with the test process.
+    chat_server = SERVER_MODES[request.param](host='127.0.0.1', port=0, storage=STORAGE_MEMORY,
+                                              archive_dir=str(tmp_path_factory.mktemp('archive')))
+    thread = threading.Thread(target=chat_server.start)
+    thread.daemon = True
+    thread.start()
+    wait_for_listener(chat_server.server_socket.getsockname()[1])
+    return chat_server
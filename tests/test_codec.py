@@ -0,0 +1,97 @@
+import pytest
+
+from codec import (CODECS, TAG_ACK, TAG_JSON, TAG_MESSAGE, TAG_ROOM_MESSAGE, TAG_ROOM_SEND, TAG_SEND, BinaryCodec,
+                   CodecError, JSONCodec, choose_codec)
+from protocol import HEADER, FrameDecoder
+
+TIMESTAMP = '2024-03-05 17:04:09'
+
+PACKED = [
+    ({'type': 'message', 'id': 42, 'sender': 'alice', 'content': 'hello ü', 'timestamp': TIMESTAMP}, TAG_MESSAGE),
+    ({'type': 'room_message', 'id': 7, 'room': 'lobby', 'sender': 'bob', 'content': '', 'timestamp': TIMESTAMP},
+     TAG_ROOM_MESSAGE),
+    ({'type': 'ack', 'id': 3, 'client_id': 9}, TAG_ACK),
+    ({'type': 'ack', 'id': 3, 'client_id': None}, TAG_ACK),
+    ({'type': 'message', 'receiver': 'bob', 'content': 'hi'}, TAG_SEND),
+    ({'type': 'message', 'receiver': 'bob', 'content': 'hi', 'client_id': None}, TAG_SEND),
+    ({'type': 'message', 'receiver': 'bob', 'content': 'hi', 'client_id': -5}, TAG_SEND),
+    ({'type': 'room_message', 'room': 'lobby', 'content': 'hi all', 'client_id': 2 ** 40}, TAG_ROOM_SEND),
+]
+
+# Frames whose fields don't fit the packed layouts exactly, so they have to
+# travel as embedded JSON and still come back unchanged.
+FALLBACK = [
+    {'type': 'message', 'id': 42, 'sender': 'alice', 'content': 'hi', 'timestamp': '2024-03-05T17:04:09'},
+    {'type': 'message', 'id': 42, 'sender': 'alice', 'content': 'hi', 'timestamp': TIMESTAMP, 'seq': 1},
+    {'type': 'message', 'id': '42', 'sender': 'alice', 'content': 'hi', 'timestamp': TIMESTAMP},
+    {'type': 'message', 'receiver': 'bob', 'content': 5},
+    {'type': 'message', 'receiver': 'bob', 'content': 'hi', 'client_id': 'x'},
+    {'type': 'ack', 'id': 2 ** 63, 'client_id': 1},
+    {'type': 'ack', 'id': 1},
+    {'type': 'unread_page', 'messages': [{'id': 1, 'sender': 'a', 'content': 'x', 'timestamp': TIMESTAMP}],
+     'cursor': 1, 'more': False},
+    {'type': 'presence_delta', 'version': 3, 'user_joined': ['ünï'], 'user_left': []},
+]
+
+
+def payload(frame):
+    assert len(frame) - HEADER.size == HEADER.unpack_from(frame)[0]
+    return frame[HEADER.size:]
+
+
+@pytest.mark.parametrize('message', [message for message, _ in PACKED] + FALLBACK)
+def test_json_round_trip(message):
+    codec = JSONCodec()
+    assert codec.decode(payload(codec.encode_frame(message))) == message
+
+
+@pytest.mark.parametrize('message, tag', PACKED)
+def test_binary_packs_hot_frames(message, tag):
+    codec = BinaryCodec()
+    data = payload(codec.encode_frame(message))
+    assert data[0] == tag
+    assert len(data) < len(JSONCodec().encode(message))
+    assert BinaryCodec().decode(data) == message
+
+
+@pytest.mark.parametrize('message', FALLBACK)
+def test_binary_falls_back_to_json(message):
+    data = payload(BinaryCodec().encode_frame(message))
+    assert data[0] == TAG_JSON
+    assert BinaryCodec().decode(data) == message
+
+
+@pytest.mark.parametrize('name', sorted(CODECS))
+def test_sequence_adds_seq(name):
+    codec = CODECS[name]
+    message = {'type': 'message', 'id': 42, 'sender': 'alice', 'content': 'hello', 'timestamp': TIMESTAMP}
+    sequenced = codec.sequence(codec.encode_frame(message), 12)
+    assert codec.decode(payload(sequenced)) == dict(message, seq=12)
+
+
+@pytest.mark.parametrize('name', sorted(CODECS))
+def test_frames_decode_through_the_frame_decoder(name):
+    codec = CODECS[name]
+    messages = [message for message, _ in PACKED] + FALLBACK
+    decoder = FrameDecoder()
+    decoder.feed(b''.join(codec.encode_frame(message) for message in messages))
+    assert [codec.decode(data) for data in decoder.frames()] == messages
+
+
+def test_encode_frame_reuses_the_last_frame():
+    codec = BinaryCodec()
+    message = {'type': 'ack', 'id': 1, 'client_id': 1}
+    assert codec.encode_frame(message) is codec.encode_frame(message)
+
+
+@pytest.mark.parametrize('data', [b'', bytes((TAG_MESSAGE,)) + b'\x00', bytes((TAG_ACK, 0, 0)), b'\x63{}',
+                                  bytes((TAG_SEND, 2)) + b'\x00' * 8 + b'\x00\x01' + b'\xff'])
+def test_malformed_binary_payload(data):
+    with pytest.raises(CodecError):
+        BinaryCodec().decode(data)
+
+
+def test_choose_codec_takes_the_first_known():
+    assert choose_codec(['unknown', 'binary', 'json']).name == 'binary'
+    assert choose_codec(['unknown']).name == 'json'
+    assert choose_codec(None).name == 'json'
@@ -0,0 +1,107 @@
+import json
+import socket
+import struct
+
+import pytest
+
+from protocol import (COMPRESSED_FLAG, COMPRESSION_THRESHOLD, HEADER, FrameDecoder, FrameError, compress_frame,
+                      decode_payload, encode_frame, recv_frame)
+
+
+def history_page(count):
+    messages = [{'id': i, 'sender': 'alice', 'receiver': 'bob', 'content': f'message number {i}',
+                 'timestamp': '2024-01-01 12:00:00'} for i in range(count)]
+    return {'type': 'history_page', 'with': 'bob', 'messages': messages, 'cursor': 0, 'more': False}
+
+
+def is_compressed(frame):
+    return bool(HEADER.unpack_from(frame)[0] & COMPRESSED_FLAG)
+
+
+def test_large_frames_are_compressed_small_ones_are_not():
+    assert is_compressed(encode_frame(history_page(20), compress=True))
+    small = encode_frame({'type': 'ping'}, compress=True)
+    assert not is_compressed(small)
+    assert len(small) - HEADER.size < COMPRESSION_THRESHOLD
+
+
+def test_compressed_frame_split_across_reads():
+    message = history_page(20)
+    frame = encode_frame(message, compress=True)
+    decoder = FrameDecoder()
+    for byte in frame[:-1]:
+        decoder.feed(bytes((byte,)))
+        assert decoder.next_frame() is None
+    decoder.feed(frame[-1:])
+    assert decode_payload(decoder.next_frame()) == message
+    assert decoder.next_frame() is None
+
+
+def test_pipelined_frames_in_one_read():
+    messages = [history_page(20), {'type': 'ping'}, history_page(30), {'type': 'ack', 'id': 1, 'client_id': None}]
+    frames = [encode_frame(message, compress=True) for message in messages]
+    assert [is_compressed(frame) for frame in frames] == [True, False, True, False]
+    decoder = FrameDecoder()
+    decoder.feed(b''.join(frames))
+    assert [decode_payload(payload) for payload in decoder.frames()] == messages
+
+
+def test_pipelined_frames_ending_mid_frame():
+    messages = [history_page(20), history_page(25)]
+    data = b''.join(encode_frame(message, compress=True) for message in messages)
+    split = len(encode_frame(messages[0], compress=True)) + 7
+    decoder = FrameDecoder()
+    decoder.feed(data[:split])
+    assert [decode_payload(payload) for payload in decoder.frames()] == messages[:1]
+    decoder.feed(data[split:])
+    assert [decode_payload(payload) for payload in decoder.frames()] == messages[1:]
+
+
+def test_recv_frame_reads_split_and_pipelined_frames_from_a_socket():
+    messages = [history_page(20), {'type': 'ping'}, history_page(40)]
+    data = b''.join(encode_frame(message, compress=True) for message in messages)
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        # A short recv buffer forces frames to span several reads.
+        decoder = FrameDecoder(recv_size=16)
+        sender.sendall(data)
+        sender.shutdown(socket.SHUT_WR)
+        received = []
+        while True:
+            payload = recv_frame(receiver, decoder)
+            if payload is None:
+                break
+            received.append(decode_payload(payload))
+    assert received == messages
+    assert decoder.bytes_received == len(data)
+
+
+def test_frame_over_the_limit_is_refused():
+    decoder = FrameDecoder(max_frame_size=64)
+    decoder.feed(HEADER.pack(65))
+    with pytest.raises(FrameError):
+        decoder.next_frame()
+
+
+def test_compressed_frame_expanding_over_the_limit_is_refused():
+    frame = compress_frame(encode_frame({'content': 'x' * 4096}))
+    assert is_compressed(frame)
+    decoder = FrameDecoder(max_frame_size=1024)
+    decoder.feed(frame)
+    with pytest.raises(FrameError):
+        decoder.next_frame()
+
+
+def test_corrupt_compressed_frame_is_refused():
+    payload = b'\xff' * 32
+    decoder = FrameDecoder()
+    decoder.feed(struct.pack('!I', len(payload) | COMPRESSED_FLAG) + payload)
+    with pytest.raises(FrameError):
+        decoder.next_frame()
+
+
+def test_plain_frame_round_trip():
+    message = {'type': 'message', 'receiver': 'bob', 'content': 'héllo'}
+    decoder = FrameDecoder()
+    decoder.feed(encode_frame(message))
+    assert json.loads(decoder.next_frame()) == message
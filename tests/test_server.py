@@ -0,0 +1,198 @@
+import asyncio
+
+import pytest
+
+from headless_client import AuthenticationError, HeadlessClient
+
+TIMEOUT = 10
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, TIMEOUT))
+
+
+def client(server, username, **kwargs):
+    return HeadlessClient('127.0.0.1', server.server_socket.getsockname()[1], username, 'password', **kwargs)
+
+
+async def registered(server, username, **kwargs):
+    chat_client = client(server, username, **kwargs)
+    await chat_client.connect()
+    await chat_client.register()
+    return chat_client
+
+
+async def expect(chat_client, message_type):
+    # Skips presence and anything else the test isn't about.
+    while True:
+        message = await chat_client.recv()
+        assert message is not None, f"connection closed waiting for {message_type}"
+        if message.get('type') == message_type:
+            return message
+
+
+async def disconnected(server, chat_client):
+    await chat_client.close()
+    while chat_client.username in server.clients:
+        await asyncio.sleep(0.01)
+
+
+def test_register_and_login(server):
+    async def scenario():
+        alice = client(server, 'auth-alice')
+        await alice.connect()
+        assert (await alice.register())['message'] == 'Registration successful'
+        await alice.close()
+
+        again = client(server, 'auth-alice')
+        await again.connect()
+        with pytest.raises(AuthenticationError, match='Username already exists'):
+            await again.register()
+        await again.close()
+
+        wrong = HeadlessClient(alice.host, alice.port, 'auth-alice', 'wrong password')
+        await wrong.connect()
+        with pytest.raises(AuthenticationError, match='Invalid credentials'):
+            await wrong.login()
+        await wrong.close()
+
+        await alice.connect()
+        assert (await alice.login())['message'] == 'Login successful'
+        await alice.close()
+
+    run(scenario())
+
+
+def test_malformed_credentials_are_refused(server):
+    async def scenario():
+        chat_client = HeadlessClient('127.0.0.1', server.server_socket.getsockname()[1], 'auth-bad', None)
+        await chat_client.connect()
+        with pytest.raises(AuthenticationError, match='Invalid username or password'):
+            await chat_client.register()
+        assert await chat_client.recv() is None
+
+    run(scenario())
+
+
+def test_message_is_acked_and_delivered(server):
+    async def scenario():
+        alice = await registered(server, 'msg-alice')
+        bob = await registered(server, 'msg-bob')
+        alice.send_message(bob.username, 'hello bob', client_id=7)
+        ack = await expect(alice, 'ack')
+        assert ack['client_id'] == 7
+        message = await expect(bob, 'message')
+        assert (message['id'], message['sender'], message['content']) == (ack['id'], alice.username, 'hello bob')
+        await alice.close()
+        await bob.close()
+
+    run(scenario())
+
+
+def test_invalid_message_gets_message_error(server):
+    async def scenario():
+        alice = await registered(server, 'msgerr-alice')
+        alice.write({'type': 'message', 'receiver': 5, 'content': 'x', 'client_id': 1})
+        error = await expect(alice, 'message_error')
+        assert error['client_id'] == 1
+        await alice.close()
+
+    run(scenario())
+
+
+def test_offline_messages_arrive_at_login(server):
+    async def scenario():
+        alice = await registered(server, 'unread-alice')
+        bob = await registered(server, 'unread-bob')
+        await disconnected(server, bob)
+        for content in ('one', 'two'):
+            alice.send_message(bob.username, content)
+            await expect(alice, 'ack')
+
+        await bob.connect()
+        await bob.login()
+        page = await expect(bob, 'unread_page')
+        assert [message['content'] for message in page['messages']] == ['one', 'two']
+        await alice.close()
+        await bob.close()
+
+    run(scenario())
+
+
+def test_sync_ack_drops_acknowledged_deliveries(server):
+    async def scenario():
+        alice = await registered(server, 'sync-alice')
+        bob = await registered(server, 'sync-bob', sync=True)
+        for content in ('first', 'second'):
+            alice.send_message(bob.username, content)
+            assert (await expect(bob, 'message'))['content'] == content
+        bob.write({'type': 'sync_ack', 'seq': 1})
+        await bob.drain()
+        # A round trip, so the ack has been handled before the connection drops.
+        bob.request_history(alice.username)
+        await expect(bob, 'history_page')
+        await bob.close()
+
+        bob.last_seq = 0
+        await bob.connect()
+        assert (await bob.resume())['message'] == 'Session resumed'
+        replayed = await expect(bob, 'message')
+        assert (replayed['seq'], replayed['content']) == (2, 'second')
+        await alice.close()
+        await bob.close()
+
+    run(scenario())
+
+
+def test_history_pages(server):
+    async def scenario():
+        alice = await registered(server, 'hist-alice')
+        bob = await registered(server, 'hist-bob')
+        for content in ('a', 'b', 'c'):
+            alice.send_message(bob.username, content)
+            await expect(alice, 'ack')
+        bob.send_message(alice.username, 'd')
+        await expect(bob, 'ack')
+
+        alice.request_history(bob.username)
+        page = await expect(alice, 'history_page')
+        assert page['with'] == bob.username
+        assert [message['content'] for message in page['messages']] == ['a', 'b', 'c', 'd']
+        assert not page['more']
+
+        alice.request_history(bob.username, before=page['messages'][2]['id'])
+        page = await expect(alice, 'history_page')
+        assert [message['content'] for message in page['messages']] == ['a', 'b']
+
+        alice.write({'type': 'history', 'with': 5})
+        assert (await expect(alice, 'history_error'))['with'] == 5
+        await alice.close()
+        await bob.close()
+
+    run(scenario())
+
+
+def test_room_round_trip(server):
+    async def scenario():
+        alice = await registered(server, 'room-alice')
+        bob = await registered(server, 'room-bob')
+        assert (await alice.enter_room('lobby'))['members'] == [alice.username]
+        joined = await bob.enter_room('lobby')
+        assert sorted(joined['members']) == sorted([alice.username, bob.username])
+
+        alice.send_room_message('lobby', 'hi room', client_id=3)
+        ack = await expect(alice, 'ack')
+        assert ack['client_id'] == 3
+        message = await expect(bob, 'room_message')
+        assert (message['id'], message['room'], message['sender'], message['content']) == (
+            ack['id'], 'lobby', alice.username, 'hi room')
+
+        bob.leave_room('lobby')
+        assert (await expect(bob, 'room_left'))['room'] == 'lobby'
+        bob.send_room_message('lobby', 'not a member any more', client_id=4)
+        error = await expect(bob, 'room_error')
+        assert (error['message'], error['client_id']) == ('Not a member of this room', 4)
+        await alice.close()
+        await bob.close()
+
+    run(scenario())
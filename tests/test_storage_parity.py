@@ -0,0 +1,16 @@
+import random
+
+import pytest
+
+from memory_storage import MemoryStorage
+from storage import SQLiteStorage
+from storage_parity import run
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_memory_storage_matches_sqlite(tmp_path, seed):
+    sqlite = SQLiteStorage(str(tmp_path / 'parity.db'), archive_dir=str(tmp_path / 'archive'))
+    try:
+        run((sqlite, MemoryStorage()), random.Random(seed), 1000)
+    finally:
+        sqlite.close()
@@ -0,0 +1,125 @@
+from timerwheel import TimerWheel
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def wheel(slots=8, levels=3):
+    # Whole-second ticks on a fake clock, so every deadline is exact.
+    clock = FakeClock()
+    return TimerWheel(tick=1, slots=slots, levels=levels, clock=clock), clock
+
+
+def run_until(timers, clock, end):
+    while clock.now < end:
+        clock.now += 1
+        timers.advance()
+
+
+def test_timer_fires_once_at_its_deadline():
+    timers, clock = wheel()
+    fired = []
+    timers.schedule(5, lambda: fired.append(clock.now))
+    assert len(timers) == 1
+    clock.now = 4.5
+    timers.advance()
+    assert fired == []
+    clock.now = 5
+    timers.advance()
+    assert fired == [5]
+    clock.now = 50
+    timers.advance()
+    assert fired == [5]
+    assert len(timers) == 0
+
+
+def test_deadlines_round_up_to_whole_ticks():
+    timers, clock = wheel()
+    fired = []
+    timers.schedule(0.1, lambda: fired.append(('short', clock.now)))
+    timers.schedule(2.5, lambda: fired.append(('between ticks', clock.now)))
+    run_until(timers, clock, 5)
+    assert fired == [('short', 1), ('between ticks', 3)]
+
+
+def test_cancelled_timer_never_fires():
+    timers, clock = wheel()
+    fired = []
+    kept = timers.schedule(3, lambda: fired.append('kept'))
+    cancelled = timers.schedule(3, lambda: fired.append('cancelled'))
+    cancelled.cancel()
+    assert len(timers) == 1
+    # Cancelling twice, or after firing, is harmless.
+    cancelled.cancel()
+    clock.now = 10
+    timers.advance()
+    kept.cancel()
+    assert fired == ['kept']
+    assert len(timers) == 0
+
+
+def test_far_deadlines_cascade_down_and_fire_on_time():
+    # With 8 slots a level, 100 and 300 ticks start on the upper levels.
+    timers, clock = wheel()
+    fired = []
+    for delay in (300, 100, 7):
+        timers.schedule(delay, lambda delay=delay: fired.append((delay, clock.now)))
+    run_until(timers, clock, 400)
+    assert fired == [(7, 7), (100, 100), (300, 300)]
+
+
+def test_one_advance_runs_everything_that_came_due():
+    timers, clock = wheel()
+    fired = []
+    for delay in (1, 9, 70):
+        timers.schedule(delay, lambda delay=delay: fired.append(delay))
+    clock.now = 100
+    timers.advance()
+    assert sorted(fired) == [1, 9, 70]
+
+
+def test_deadline_beyond_the_wheel_is_placed_again():
+    # 2 levels of 4 slots cover 16 ticks; 40 ticks has to come round twice.
+    timers, clock = wheel(slots=4, levels=2)
+    fired = []
+    timers.schedule(40, lambda: fired.append(clock.now))
+    run_until(timers, clock, 50)
+    assert fired == [40]
+
+
+def test_cancel_a_cascaded_timer():
+    timers, clock = wheel()
+    fired = []
+    timer = timers.schedule(100, lambda: fired.append('late'))
+    run_until(timers, clock, 95)
+    timer.cancel()
+    run_until(timers, clock, 200)
+    assert fired == []
+    assert len(timers) == 0
+
+
+def test_callback_errors_do_not_stop_other_timers(capsys):
+    timers, clock = wheel()
+    fired = []
+
+    def broken():
+        raise RuntimeError('boom')
+
+    timers.schedule(1, broken)
+    timers.schedule(1, lambda: fired.append('ok'))
+    clock.now = 1
+    timers.advance()
+    assert fired == ['ok']
+    assert 'boom' in capsys.readouterr().out
+
+
+def test_next_tick_counts_down_to_the_boundary():
+    timers, clock = wheel()
+    assert timers.next_tick() == 1
+    clock.now = 0.25
+    assert timers.next_tick() == 0.75
@@ -0,0 +1,117 @@
+import math
+import threading
+import time
+
+TIMER_TICK = 0.1
+WHEEL_SLOTS = 64
+WHEEL_LEVELS = 4  # 64**4 ticks of 0.1s is about 19 days
+
+
+class Timer:
+    def __init__(self, wheel, callback):
+        self.wheel = wheel
+        self.callback = callback
+        self.expires = None  # in ticks
+        self.slot = None  # the set holding it while pending
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+
+class TimerWheel:
+    # Hierarchical timing wheel. Level 0 has one slot per tick, each level
+    # above one slot per full turn of the level below. Scheduling and
+    # cancelling are O(1); each tick empties one level 0 slot, and a timer
+    # is moved down a level at most WHEEL_LEVELS - 1 times in its life, so
+    # the cost per tick stays flat however many deadlines are pending
+    # (a heartbeat per connection, resume windows).
+    #
+    # Deadlines are rounded up to whole ticks. Callbacks run on whatever
+    # drives advance(): the thread from start(), or the asyncio loop.
+    def __init__(self, tick=TIMER_TICK, slots=WHEEL_SLOTS, levels=WHEEL_LEVELS, clock=time.monotonic):
+        self.tick = tick
+        self.slots = slots
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.levels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.spans = [slots ** level for level in range(levels + 1)]
+        self.started = clock()
+        self.current = 0  # ticks processed so far
+        self.pending = 0
+
+    def __len__(self):
+        return self.pending
+
+    def now(self):
+        return self.clock()
+
+    def schedule(self, delay, callback):
+        timer = Timer(self, callback)
+        with self.lock:
+            self.place(timer, self.current + max(1, math.ceil(delay / self.tick)))
+            self.pending += 1
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+                timer.slot = None
+                self.pending -= 1
+
+    def place(self, timer, expires):
+        timer.expires = expires
+        # Deadlines past the top level wait in its furthest slot and are
+        # placed again when it comes round.
+        delta = min(max(expires - self.current, 0), self.spans[-1] - 1)
+        level = 0
+        while delta >= self.spans[level + 1]:
+            level += 1
+        slot = self.levels[level][(self.current + delta) // self.spans[level] % self.slots]
+        slot.add(timer)
+        timer.slot = slot
+
+    def advance(self):
+        # Runs every callback that came due since the last call.
+        due = []
+        with self.lock:
+            target = int((self.clock() - self.started) / self.tick)
+            while self.current < target:
+                self.current += 1
+                # Highest level first, so a timer can fall through several
+                # levels within the same tick.
+                for level in range(len(self.levels) - 1, 0, -1):
+                    if self.current % self.spans[level] == 0:
+                        self.cascade(self.levels[level][self.current // self.spans[level] % self.slots])
+                slot = self.levels[0][self.current % self.slots]
+                for timer in slot:
+                    timer.slot = None
+                due.extend(timer for timer in slot)
+                self.pending -= len(slot)
+                slot.clear()
+        for timer in due:
+            try:
+                timer.callback()
+            except Exception as e:
+                print(f"Error in timer callback: {e}")
+
+    def cascade(self, slot):
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self.place(timer, timer.expires)
+
+    def next_tick(self):
+        # Seconds until the next tick boundary.
+        return max(0.0, self.started + (self.current + 1) * self.tick - self.clock())
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self):
+        while True:
+            time.sleep(self.next_tick())
+            self.advance()
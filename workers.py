@@ -0,0 +1,232 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+
+from codec import JSON_CODEC
+from connection import AsyncClientConnection
+from protocol import FrameDecoder, decode_payload, encode_frame, encode_raw_frame, read_frame
+from server import AsyncChatServer
+from storage import conversation_key
+
+PEER_QUEUE_SIZE = 65536
+PEER_RETRY_INTERVAL = 0.1
+
+
+class RemoteConnection:
+    # Stands in for a client connected to another worker: messages for it go
+    # over the local bus, as JSON, to the worker that owns the socket.
+    def __init__(self, link, username):
+        self.link = link
+        self.username = username
+
+    def send_message(self, message, message_id=None):
+        header = encode_frame({'op': 'deliver', 'receiver': self.username, 'message_id': message_id})
+        return self.link.send_frame(header + JSON_CODEC.encode_frame(message), message_id)
+
+
+class ClusterChatServer(AsyncChatServer):
+    # One of several worker processes sharing the listen port via SO_REUSEPORT.
+    # Workers form a full mesh of Unix socket links: each one announces its
+    # users' joins and leaves to every peer, so all of them keep a local copy
+    # of the directory and route a message straight to the receiver's owner.
+    def __init__(self, worker_id, worker_count, socket_dir, *args, **kwargs):
+        kwargs['reuse_port'] = True
+        super().__init__(*args, **kwargs)
+        self.worker_id = worker_id
+        self.worker_count = worker_count
+        self.socket_dir = socket_dir
+        self.peers = {}  # worker_id: outbound link
+        self.directory = {}  # username: worker_id, for users on other workers
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.socket_dir, f'worker-{worker_id}.sock')
+
+    async def serve(self):
+        await asyncio.start_unix_server(self.handle_peer, path=self.socket_path(self.worker_id))
+        for peer_id in range(self.worker_count):
+            if peer_id != self.worker_id:
+                asyncio.ensure_future(self.maintain_peer_link(peer_id))
+        await super().serve()
+
+    async def maintain_peer_link(self, peer_id):
+        path = self.socket_path(peer_id)
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(PEER_RETRY_INTERVAL)
+                continue
+
+            link = AsyncClientConnection(writer, max_size=PEER_QUEUE_SIZE, on_spill=self.spill_messages)
+            self.peers[peer_id] = link
+            link.send_frame(encode_frame({'op': 'hello', 'worker': self.worker_id, 'users': list(self.clients)}))
+
+            # Nothing is ever sent back on this link; EOF or a reset means
+            # the peer died.
+            try:
+                await reader.read()
+            except ConnectionError:
+                pass
+            link.close()
+            if self.peers.get(peer_id) is link:
+                del self.peers[peer_id]
+            await asyncio.sleep(PEER_RETRY_INTERVAL)
+
+    async def handle_peer(self, reader, writer):
+        decoder = FrameDecoder()
+        peer_id = None
+        try:
+            while True:
+                payload = await read_frame(reader, decoder)
+                if payload is None:
+                    break
+                event = decode_payload(payload)
+                op = event.get('op')
+
+                if op == 'deliver':
+                    inner = await read_frame(reader, decoder)
+                    if inner is None:
+                        break
+                    self.deliver_local(event['receiver'], inner, event.get('message_id'))
+                elif op == 'room_deliver':
+                    inner = await read_frame(reader, decoder)
+                    if inner is None:
+                        break
+                    with self.rooms.lock:
+                        self.rooms.advance_head(event['room'], event['message_id'])
+                        self.deliver_room_message(event['room'], event['message_id'], event['sender'],
+                                                  decode_payload(inner))
+                elif op == 'room_member':
+                    if event['joined']:
+                        self.rooms.add_member(event['room'], event['username'])
+                    else:
+                        self.rooms.remove_member(event['room'], event['username'])
+                elif op == 'hello':
+                    peer_id = event['worker']
+                    for username in event.get('users', []):
+                        self.remote_join(username, peer_id)
+                elif op == 'join':
+                    self.remote_join(event['username'], event['worker'])
+                elif op == 'leave':
+                    self.remote_leave(event['username'], event['worker'])
+                elif op == 'invalidate':
+                    self.storage.history_cache.invalidate(conversation_key(*event['conversation']))
+        finally:
+            if peer_id is not None:
+                for username, owner in list(self.directory.items()):
+                    if owner == peer_id:
+                        self.remote_leave(username, peer_id)
+            writer.close()
+
+    def broadcast_to_peers(self, event):
+        self.broadcast_raw_to_peers(encode_frame(event))
+
+    def broadcast_raw_to_peers(self, frame):
+        for link in list(self.peers.values()):
+            link.send_frame(frame)
+
+    def user_online(self, username, connection):
+        super().user_online(username, connection)
+        self.broadcast_to_peers({'op': 'join', 'username': username, 'worker': self.worker_id})
+
+    def user_offline(self, username):
+        super().user_offline(username)
+        self.broadcast_to_peers({'op': 'leave', 'username': username, 'worker': self.worker_id})
+
+    def save_message(self, sender, receiver, content, is_read=False):
+        future = super().save_message(sender, receiver, content, is_read)
+        # Every worker keeps its own history cache, so the others have to
+        # drop their pages of this conversation too.
+        event = {'op': 'invalidate', 'conversation': [sender, receiver]}
+        future.add_done_callback(lambda _: self.call_soon(self.broadcast_to_peers, event))
+        return future
+
+    def add_room_member(self, room, username):
+        super().add_room_member(room, username)
+        self.broadcast_to_peers({'op': 'room_member', 'room': room, 'username': username, 'joined': True})
+
+    def remove_room_member(self, room, username):
+        super().remove_room_member(room, username)
+        self.broadcast_to_peers({'op': 'room_member', 'room': room, 'username': username, 'joined': False})
+
+    def fan_out_room(self, room, message_id, sender, message):
+        # Local members are served here; every other worker gets the message
+        # once and fans it out to its own clients. Workers with no online
+        # members still need it to keep their room heads current, since a
+        # member may log in there next.
+        super().fan_out_room(room, message_id, sender, message)
+        header = encode_frame({'op': 'room_deliver', 'room': room, 'message_id': message_id, 'sender': sender})
+        self.broadcast_raw_to_peers(header + JSON_CODEC.encode_frame(message))
+
+    def remote_join(self, username, worker_id):
+        self.directory[username] = worker_id
+        self.presence.join(username)
+
+    def remote_leave(self, username, worker_id):
+        if self.directory.get(username) == worker_id:
+            del self.directory[username]
+            if username not in self.clients:
+                self.presence.leave(username)
+
+    def online_connection(self, username):
+        connection = super().online_connection(username)
+        if connection is None and username in self.directory:
+            link = self.peers.get(self.directory[username])
+            if link is not None:
+                return RemoteConnection(link, username)
+        return connection
+
+    def deliver_local(self, username, payload, message_id):
+        # payload arrives as JSON; clients on that codec get it as is.
+        connection = self.local_connection(username)
+        if connection is not None and connection.codec is JSON_CODEC:
+            connection.send_frame(encode_raw_frame(payload), message_id)
+        elif connection is not None:
+            connection.send_message(decode_payload(payload), message_id)
+        elif message_id is not None:
+            self.spill_messages([message_id])
+
+
+def run_worker(worker_id, worker_count, socket_dir, options):
+    options = dict(options)
+    if options.get('metrics_port') is not None:
+        options['metrics_port'] += worker_id
+    if worker_id != 0:
+        # Segments have a single appender; the other workers only read them.
+        options['archive_after'] = None
+    server = ClusterChatServer(worker_id, worker_count, socket_dir, **options)
+    server.start()
+
+
+def stop_cluster(signum, frame):
+    sys.exit(0)
+
+
+def run_cluster(worker_count, **options):
+    socket_dir = tempfile.mkdtemp(prefix='chat-bus-')
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(worker_id, worker_count, socket_dir, options))
+        for worker_id in range(worker_count)
+    ]
+    for process in processes:
+        process.start()
+    # Installed after forking so workers keep the default handler. SIGTERM
+    # unwinds through the finally below, so workers never outlive the
+    # supervisor.
+    signal.signal(signal.SIGTERM, stop_cluster)
+    print(f"Started {worker_count} workers on {options.get('host')}:{options.get('port')}")
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("Shutting down workers...")
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree(socket_dir, ignore_errors=True)